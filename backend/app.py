@@ -7,15 +7,21 @@ import os
 from datetime import datetime
 import logging
 
-from service.doc_analyst import send_chat_message
+from service.doc_analyst import send_chat_message, stream_chat_message
 from gpt.parsing import process_files
-from service.doc_audit import send_audit_message
-from service.s3_client import delete_uploaded_file, get_download_urls, get_file_like_object_from_s3, get_presigned_url, get_uploaded_filenames
+from gpt.retrieval import RETRIEVAL_TOKEN_BUDGET, select_relevant_passages
+from service.s3_client import delete_uploaded_file, fetch_uploaded_files, get_presigned_url, get_uploaded_filenames
 from model.query import QueryRequest, QueryResponse
 from config import Config, load_environment_variables
 from authorizer import check_auth_token
 from model.feedback import CreateFeedbackRequest, CreateFeedbackResponse
+from model.job import JobRequest, JobResponse, SummariseRequest
 from service.smtp_client import SmtpClient
+from service.metrics import metrics
+from service.runpod_warmer import runpod_wait_message, warm_keeper
+from service.job_queue import FINISHED_STATES, JOB_WORKERS_IN_PROCESS, job_kinds, job_queue, job_workers
+import service.jobs  # registers the audit and summarise job handlers
+from service.single_flight import FlightFinishedError, SingleFlight
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -27,6 +33,45 @@ app = Flask(__name__, static_folder='../frontend/build')
 app.config.from_object(Config)
 CORS(app)
 smtp_client = SmtpClient()
+query_flights = SingleFlight("query")
+
+
+@app.before_request
+def start_background_threads():
+    """
+    Start the runpod warm-keeper (and the job workers, if they run in this process) with the
+    first request rather than on import, so importing the app for a script or test starts nothing
+    """
+    warm_keeper.start()
+    if JOB_WORKERS_IN_PROCESS:
+        job_workers.start()
+
+
+def _name_set(names):
+    return frozenset(name.strip() for name in names.split(",") if name.strip())
+
+
+def audit_job_key(doc_audit_request):
+    return json.dumps([
+        doc_audit_request.userid,
+        sorted(_name_set(doc_audit_request.file_name)),
+        sorted(_name_set(doc_audit_request.style_guide_file_names)),
+        doc_audit_request.ai_provider,
+        doc_audit_request.concurrent,
+        doc_audit_request.ordered,
+        doc_audit_request.bypass_cache,
+    ])
+
+
+def query_flight_key(query_request, mode):
+    return (
+        mode,
+        query_request.userid,
+        _name_set(query_request.file_names),
+        query_request.user_input,
+        query_request.ai_provider,
+        query_request.bypass_cache,
+    )
 
 @check_auth_token
 @app.route('/api/feedback', methods=['POST'])
@@ -137,61 +182,39 @@ def ai_doc_audit_route(*args, **kw):
         logger.error(f"Unexpected error during request parsing: {str(e)}")
         return jsonify({'message': 'Internal server error'}), 500
 
-    def generate():
-        with app.app_context():
-            try:
-                logger.info(f"AI Doc Audit: userid: {doc_audit_request.userid}, file_name: {doc_audit_request.file_name}, template_name: {doc_audit_request.template_name}, style_guide_file_names: {doc_audit_request.style_guide_file_names}")
-                download_urls, file_keys = get_download_urls(doc_audit_request.userid, doc_audit_request.file_name)
-                uploaded_files = []
-                for download_url, file_key in zip(download_urls, file_keys):
-                    try:
-                        logger.info(f"Fetching from URL: {download_url}")
-                        file_like_object = get_file_like_object_from_s3(download_url)
-                        file_like_object.name = file_key
-                        uploaded_files.append(file_like_object)
-                    except Exception as e:
-                        logger.error(f"Failed to fetch or process the file at {download_url}: {str(e)}")
-                        continue
-
-                logger.debug(f"First 50 chars of first 5 file contents: {[f.read(50) for f in uploaded_files[:5]]}") 
-                file_contents, rimon_template_contents, total_tokens = process_files(uploaded_files)
-                logger.info(f"Total tokens: {total_tokens}")
-
-                if total_tokens > 60000:
-                    logger.warning(f"Total tokens exceed 60000, likely failure ahead. Total tokens: {total_tokens}")  
-
-                doc_audit_response = DocAuditResponse(
-                    status='100',
-                    ai_response=f"{doc_audit_request.ai_provider} starting"
-                )
-                doc_audit_response_dict = doc_audit_response.model_dump()
-                # print(f"doc_audit_response_dict: {doc_audit_response_dict}")  
-                yield "event: message\n"
-                yield f"data: {json.dumps(doc_audit_response_dict)}\n\n"
-
-                response = send_audit_message(
-                    style_guides_filter=doc_audit_request.style_guide_file_names, 
-                    additional_context=file_contents,
-                    ai_provider=doc_audit_request.ai_provider)
-                for interim_result in response:
-                    doc_audit_response = DocAuditResponse(
-                        status='200',
-                        ai_response=interim_result
-                    )
-                    doc_audit_response_dict = doc_audit_response.model_dump()
-                    # print(f"doc_audit_response_dict: {doc_audit_response_dict}")  
-                    yield "event: message\n"
-                    yield f"data: {json.dumps(doc_audit_response_dict)}\n\n"
+    # The audit runs as a background job, so it carries on if this connection drops. A duplicate
+    # request (double click, EventSource reconnect) follows the audit job already running.
+    job_id, submitted = job_queue.submit_unless_active(
+        "audit", doc_audit_request.model_dump(), owner=doc_audit_request.userid,
+        dedupe_key=audit_job_key(doc_audit_request))
+    after = 0
+    if not submitted:
+        logger.info(f"Following the audit job {job_id} already running")
+        after = event_id_after()
+        if after is None:
+            return jsonify({'message': 'Last-Event-ID must be a whole number'}), 400
 
-            except Exception as e:
-                logger.error(f"Error processing request: {e}")
-                query_response = QueryResponse(
-                    status = '500',
-                    ai_response = f"Internal server error: {e}"
-                )
-                doc_audit_response_dict = query_response.model_dump()
-                yield "event: error\n"
-                yield f"data: {json.dumps(doc_audit_response_dict)}\n\n"
+    def generate():
+        if not after:
+            doc_audit_response = DocAuditResponse(
+                status='100',
+                ai_response=f"Audit queued as job {job_id}",
+                job_id=job_id
+            )
+            yield "event: message\n"
+            yield f"data: {json.dumps(doc_audit_response.model_dump())}\n\n"
+
+        yield from job_event_stream(job_id, after)
+
+        job = job_queue.get(job_id)
+        if job is not None and job.error:
+            logger.error(f"Error processing request: {job.error}")
+            query_response = QueryResponse(
+                status = '500',
+                ai_response = f"Internal server error: {job.error}"
+            )
+            yield "event: error\n"
+            yield f"data: {json.dumps(query_response.model_dump())}\n\n"
 
     return Response(generate(), mimetype="text/event-stream")
 
@@ -251,6 +274,26 @@ def ai_doc_audit_route(*args, **kw):
 #         doc_audit_response_dict = query_response.model_dump()
 #         return jsonify(doc_audit_response_dict), 500
 
+def load_query_files(query_request):
+    """
+    Fetch and extract the files a query refers to, keeping only the passages relevant to the
+    question when they are too large to send whole
+    """
+    uploaded_files = fetch_uploaded_files(query_request.userid, query_request.file_names)
+
+    logger.debug(f"First 50 chars of first 5 file contents: {[f.read(50) for f in uploaded_files[:5]]}") 
+    file_contents, rimon_template_contents, total_tokens = process_files(uploaded_files, as_list=True)
+    logger.info(f"Total tokens: {total_tokens}")
+
+    if total_tokens > 60000:
+        logger.warning(f"Total tokens exceed 60000, likely failure ahead. Total tokens: {total_tokens}")  
+
+    if total_tokens > RETRIEVAL_TOKEN_BUDGET:
+        file_contents, retrieval_report = select_relevant_passages(query_request.user_input, file_contents)
+        logger.info(retrieval_report)
+    return file_contents
+
+
 @check_auth_token
 @app.route('/api/ai-query', methods=['POST'])
 def ai_query_route(*args, **kw):
@@ -266,28 +309,15 @@ def ai_query_route(*args, **kw):
 
     try:
         logger.info(f"AI Query: userid: {query_request.userid}, user_input: {query_request.user_input}, template_name: {query_request.template_name}, file_names: {query_request.file_names}")
-        download_urls, file_keys = get_download_urls(query_request.userid, query_request.file_names)
-        uploaded_files = []
-        for download_url, file_key in zip(download_urls, file_keys):
-            try:
-                logger.info(f"Fetching from URL: {download_url}")
-                file_like_object = get_file_like_object_from_s3(download_url)
-                file_like_object.name = file_key
-                uploaded_files.append(file_like_object)
-            except Exception as e:
-                logger.error(f"Failed to fetch or process the file at {download_url}: {str(e)}")
-                continue
-
-        logger.debug(f"First 50 chars of first 5 file contents: {[f.read(50) for f in uploaded_files[:5]]}") 
-        file_contents, rimon_template_contents, total_tokens = process_files(uploaded_files)
-        logger.info(f"Total tokens: {total_tokens}")
 
-        if total_tokens > 60000:
-            logger.warning(f"Total tokens exceed 60000, likely failure ahead. Total tokens: {total_tokens}")  
+        def answer():
+            file_contents = load_query_files(query_request)
+            messages = [{"role": "user", "content": query_request.user_input}]
+            logger.info(f"Sending AI Query: {messages}")
+            return send_chat_message(messages, "nothing uploaded", file_contents, use_cache=not query_request.bypass_cache)
 
-        messages = [{"role": "user", "content": query_request.user_input}]
-        logger.info(f"Sending AI Query: {messages}")
-        response = send_chat_message(messages, "nothing uploaded", file_contents)
+        # Identical questions already being answered share that answer
+        response = query_flights.call(query_flight_key(query_request, "answer"), answer)
         logger.info(f"Received AI response: {response}")
 
         query_response = QueryResponse(
@@ -308,8 +338,226 @@ def ai_query_route(*args, **kw):
         )
         query_response_dict = query_response.model_dump()
         return jsonify(query_response_dict), 500
+
+
+@check_auth_token
+@app.route('/api/ai-query', methods=['GET'])
+def ai_query_stream_route(*args, **kw):
+    """
+    Streaming mode of ai-query: the request is passed as ?payload=, like ai-doc-audit, and the answer
+    is sent as server-sent events. Status 100 events report progress, each status 206 event carries
+    the next piece of the answer, and the final status 200 event carries the whole answer.
+    """
+    data = json.loads(request.args.get("payload"))
+    try:
+        query_request = QueryRequest(**data)
+    except ValidationError as e:
+        logger.error(f"Validation error: {str(e)}")
+        return jsonify({'message': 'Invalid request data', 'details': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Unexpected error during request parsing: {str(e)}")
+        return jsonify({'message': 'Internal server error'}), 500
+
+    after = event_id_after()
+    if after is None:
+        return jsonify({'message': 'Last-Event-ID must be a whole number'}), 400
+
+    def generate():
+        with app.app_context():
+            try:
+                logger.info(f"AI Query (streaming): userid: {query_request.userid}, user_input: {query_request.user_input}, template_name: {query_request.template_name}, file_names: {query_request.file_names}")
+                file_contents = load_query_files(query_request)
+
+                query_response = QueryResponse(
+                    status='100',
+                    ai_response=f"{query_request.ai_provider} starting"
+                )
+                yield "message", query_response.model_dump()
+
+                wait_message = runpod_wait_message(query_request.ai_provider)
+                if wait_message:
+                    query_response = QueryResponse(status='100', ai_response=wait_message)
+                    yield "message", query_response.model_dump()
+
+                messages = [{"role": "user", "content": query_request.user_input}]
+                tokens, cached = stream_chat_message(
+                    messages, "nothing uploaded", file_contents, query_request.ai_provider,
+                    use_cache=not query_request.bypass_cache)
+                if cached:
+                    query_response = QueryResponse(
+                        status='100',
+                        ai_response="Answered from the cache of identical earlier questions",
+                        cached=True
+                    )
+                    yield "message", query_response.model_dump()
+
+                response = []
+                for token in tokens:
+                    response.append(token)
+                    query_response = QueryResponse(
+                        status='206',
+                        ai_response=token,
+                        cached=cached
+                    )
+                    yield "message", query_response.model_dump()
+
+                query_response = QueryResponse(
+                    status='200',
+                    ai_response="".join(response),
+                    cached=cached
+                )
+                yield "message", query_response.model_dump()
+
+            except Exception as e:
+                logger.error(f"Error generating ai query response: {e}")
+                query_response = QueryResponse(
+                    status = '500',
+                    ai_response = f"Internal server error: {e}"
+                )
+                yield "error", query_response.model_dump()
+
+    # Identical questions share one answer; a reconnecting EventSource resumes after Last-Event-ID
+    try:
+        events = query_flights.stream(query_flight_key(query_request, "stream"), generate, after)
+    except FlightFinishedError as e:
+        # Starting again would resend ids the client already has, so tell it the stream is over instead
+        logger.info(f"Not resuming the query stream: {e}")
+        query_response = QueryResponse(
+            status='410',
+            ai_response="This answer has already finished streaming, ask again to get the whole answer"
+        )
+        events = [(after, ("done", query_response.model_dump()))]
+    return Response(numbered_event_stream(events), mimetype="text/event-stream")
     
 
+JOB_PAYLOAD_MODELS = {"audit": DocAuditRequest, "summarise": SummariseRequest}
+
+
+def event_id_after():
+    """
+    The id of the last event a reconnecting client received (Last-Event-ID, or ?after=<id>), 0 if
+    it has none, or None if it is not a whole number
+    """
+    value = request.headers.get("Last-Event-ID") or request.args.get("after") or "0"
+    try:
+        after = int(value)
+    except ValueError:
+        return None
+    return after if after >= 0 else None
+
+
+def numbered_event_stream(events):
+    """
+    Server-sent events for (id, (event type, data)) pairs
+    """
+    for sequence, (event, data) in events:
+        yield f"id: {sequence}\n"
+        yield f"event: {event}\n"
+        yield f"data: {json.dumps(data)}\n\n"
+
+
+def job_event_stream(job_id, after):
+    """
+    Server-sent events for the job's events after id after, as they are emitted, until it finishes.
+    Each event has an id, so a reconnecting EventSource sends the last one back as Last-Event-ID.
+    """
+    for event in job_queue.follow(job_id, after):
+        yield f"id: {event.sequence}\n"
+        yield "event: message\n"
+        yield f"data: {json.dumps(event.event)}\n\n"
+
+
+def job_response(job):
+    return JobResponse(
+        job_id=job.id,
+        kind=job.kind,
+        status=job.status,
+        attempts=job.attempts,
+        created=job.created,
+        started=job.started,
+        finished=job.finished,
+        result=job.result,
+        error=job.error
+    )
+
+
+@check_auth_token
+@app.route('/api/jobs', methods=['POST'])
+def submit_job_route(*args, **kw):
+    """
+    Queue an audit or summarisation to run in the background, and return its job id straight away
+    """
+    try:
+        job_request = JobRequest(**request.get_json())
+        if job_request.kind not in JOB_PAYLOAD_MODELS:
+            return jsonify({'message': f"Unknown job kind, expected one of {', '.join(job_kinds())}"}), 400
+        userid = JOB_PAYLOAD_MODELS[job_request.kind](**job_request.payload).userid
+        if not userid:
+            return jsonify({'message': 'Invalid request data', 'details': 'payload.userid is required'}), 400
+    except ValidationError as e:
+        logger.error(f"Validation error: {str(e)}")
+        return jsonify({'message': 'Invalid request data', 'details': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Unexpected error during request parsing: {str(e)}")
+        return jsonify({'message': 'Internal server error'}), 500
+
+    job_id = job_queue.submit(job_request.kind, job_request.payload, owner=userid)
+    return jsonify(job_response(job_queue.get(job_id)).model_dump()), 202
+
+
+@check_auth_token
+@app.route('/api/jobs/<string:userid>/<job_id>', methods=['GET'])
+def get_job_route(userid, job_id, *args, **kw):
+    job = job_queue.get(job_id, owner=userid)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job_response(job).model_dump()), 200
+
+
+@check_auth_token
+@app.route('/api/jobs/<string:userid>/<job_id>/result', methods=['GET'])
+def get_job_result_route(userid, job_id, *args, **kw):
+    """
+    The job's result once it has completed; the job's status with 202 while it is still running
+    """
+    job = job_queue.get(job_id, owner=userid)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    if job.status not in FINISHED_STATES:
+        return jsonify(job_response(job).model_dump()), 202
+    if job.error:
+        return jsonify({'message': job.error}), 500
+    return jsonify(job.result), 200
+
+
+@check_auth_token
+@app.route('/api/jobs/<string:userid>/<job_id>/events', methods=['GET'])
+def job_events_route(userid, job_id, *args, **kw):
+    """
+    The job's progress as server-sent events, the same events ai-doc-audit sends, followed by a
+    done event with the finished job. Each event has an id, so a reconnecting EventSource resumes
+    after the last event it received (or pass ?after=<id>).
+    """
+    if job_queue.get(job_id, owner=userid) is None:
+        return jsonify({'message': 'Job not found'}), 404
+    after = event_id_after()
+    if after is None:
+        return jsonify({'message': 'Last-Event-ID and after must be whole numbers'}), 400
+
+    def generate():
+        yield from job_event_stream(job_id, after)
+        yield "event: done\n"
+        yield f"data: {json.dumps(job_response(job_queue.get(job_id)).model_dump())}\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+@check_auth_token
+@app.route('/api/metrics', methods=['GET'])
+def metrics_route(*args, **kw):
+    return jsonify(metrics.snapshot()), 200
+
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 # @check_auth_token
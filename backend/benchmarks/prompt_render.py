@@ -0,0 +1,46 @@
+"""
+Benchmark rendering the doc audit prompt around a 200k character context: PromptTemplate's single
+join against the chained str.replace calls it replaced.
+
+    python -m benchmarks.prompt_render
+"""
+
+import timeit
+import tracemalloc
+
+from gpt.prompts import DOC_AUDIT_PROMPT_WITH_FILES, DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE
+
+# A 200k character context, with placeholder-like text in the user's input
+USER_INPUT = "Does my doc follow the <rdti-template> section on headings?"
+STYLE_GUIDE = "Use plain English and short sentences. " * 2500
+DOCUMENT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 2000
+
+
+def render_with_replace() -> str:
+    return (
+        DOC_AUDIT_PROMPT_WITH_FILES.replace("<user-input>", USER_INPUT)
+        .replace("<rdti-template>", STYLE_GUIDE)
+        .replace("<additional-context>", DOCUMENT)
+    )
+
+
+def render_with_template() -> str:
+    return DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE.render(
+        user_input=USER_INPUT, rdti_template=STYLE_GUIDE, additional_context=DOCUMENT
+    )
+
+
+def main():
+    if USER_INPUT not in render_with_replace():
+        print("The chained replace pasted the style guide into the user's question")
+    for name, render in [("chained replace", render_with_replace), ("PromptTemplate", render_with_template)]:
+        seconds = timeit.timeit(render, number=200) / 200
+        tracemalloc.start()
+        render()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name}: {seconds * 1e6:.0f} us per render, peak allocation {peak / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
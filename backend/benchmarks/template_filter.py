@@ -0,0 +1,92 @@
+"""
+Benchmark stripping the template boilerplate from a large filled-in RDTI template: the single
+pass over a Counter of template lines (gpt.parsing.filter_template_lines) against the list.remove
+filter it replaced.
+
+    python -m benchmarks.template_filter [filled-in template.docx]
+
+Without an argument a filled-in template is generated with python-docx: every line of the bundled
+blank templates (or, when those are not checked out, of the template guidance in gpt.prompts)
+followed by several paragraphs of answers.
+"""
+
+import random
+import sys
+import timeit
+from collections import Counter
+from io import BytesIO
+from pathlib import Path
+
+import docx
+
+from gpt.parsing import NEW_TEMPLATE_PATH, OLD_TEMPLATE_PATH, docx_to_text, filter_template_lines, load_template_lines
+from gpt.prompts import guidance
+
+ANSWERS_PER_LINE = 40
+
+
+def filter_template_lines_by_removal(text: str, template_lines: list[str]) -> str:
+    """
+    The original filter: quadratic list.remove calls for blank lines and each template line
+    """
+    lines = text.split("\n")
+    while "" in lines:
+        lines.remove("")
+    for line in template_lines:
+        try:
+            lines.remove(line)
+        except ValueError:
+            continue
+    return "\n".join([f"{line}\n" for line in lines])
+
+
+def guidance_lines(value) -> list[str]:
+    if isinstance(value, str):
+        return [line for line in value.split("\n") if line]
+    values = value.values() if isinstance(value, dict) else value
+    return [line for item in values for line in guidance_lines(item)]
+
+
+def blank_template_lines() -> list[str]:
+    if Path(NEW_TEMPLATE_PATH).exists() and Path(OLD_TEMPLATE_PATH).exists():
+        return load_template_lines(NEW_TEMPLATE_PATH) + load_template_lines(OLD_TEMPLATE_PATH)
+    return guidance_lines(guidance)
+
+
+def filled_in_template(template_lines: list[str]) -> BytesIO:
+    random.seed(0)
+    document = docx.Document()
+    for line in template_lines:
+        document.add_paragraph(line)
+        for index in range(ANSWERS_PER_LINE):
+            document.add_paragraph(f"Answer {index}: " + "the experiment tested the hypothesis " * random.randint(1, 10))
+            if index % 4 == 0:
+                document.add_paragraph("")
+    # An answer that quotes a template line, which must be kept
+    document.add_paragraph(template_lines[0])
+    filled = BytesIO()
+    document.save(filled)
+    filled.seek(0)
+    return filled
+
+
+def main():
+    template_lines = blank_template_lines()
+    filled = open(sys.argv[1], "rb") if len(sys.argv) > 1 else filled_in_template(template_lines)
+    with filled:
+        text = docx_to_text(filled)
+    template_line_index = Counter(template_lines)
+
+    assert filter_template_lines(text, template_line_index) == filter_template_lines_by_removal(text, template_lines)
+
+    removal_seconds = timeit.timeit(lambda: filter_template_lines_by_removal(text, template_lines), number=3) / 3
+    index_seconds = timeit.timeit(lambda: filter_template_lines(text, template_line_index), number=3) / 3
+    print(
+        f"{text.count(chr(10)) + 1} lines, {len(template_lines)} template lines: "
+        f"list.remove {removal_seconds * 1000:.1f} ms, counter index {index_seconds * 1000:.1f} ms, "
+        f"speedup {removal_seconds / index_seconds:.0f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
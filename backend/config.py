@@ -67,7 +67,7 @@ def get_secrets(secret_name: str) -> Secrets:
                      secret_name, e.response['Error']['Code'])
         raise e
 
-    logger.info(f"Got secret {secret_name} with value {get_secret_value_response['SecretString']}")
+    logger.info(f"Got secret {secret_name}")
     secret = get_secret_value_response['SecretString']
     json_obj = json.loads(secret)
     # convert keys to uppercase
@@ -93,6 +93,10 @@ def load_environment_variables() -> None:
 
     if "PORTAL_SECRETS" in os.environ:
         secret_name = os.environ.get("PORTAL_SECRETS")
+        if os.environ.get("PORTAL_SECRETS_LOADED") == secret_name:
+            # A child process (e.g. an extraction worker) inherits the secrets its parent loaded
+            logger.info(f"Secrets from {secret_name} already loaded by the parent process")
+            return
         logger.info(f"Loading secrets from {secret_name} in Secrets Manager")
         secrets = get_secrets(secret_name)
         logger.info(f"Loaded secrets from {secret_name} in Secrets Manager")
@@ -112,6 +116,7 @@ def load_environment_variables() -> None:
         os.environ['DESTINATION_EMAIL'] = secrets.DESTINATION_EMAIL
         os.environ['SOURCE_EMAIL'] = secrets.SOURCE_EMAIL
         os.environ['SECRET_KEY'] = secrets.SECRET_KEY
+        os.environ['PORTAL_SECRETS_LOADED'] = secret_name
 
         logger.info("Loaded secrets from AWS Secrets Manager")
     else:
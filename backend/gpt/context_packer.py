@@ -0,0 +1,120 @@
+"""
+Token-budget context packing for LLM prompts.
+
+The model context budget (MODEL_CONTEXT_TOKENS, less the tokens reserved for the response)
+is shared between the fixed prompt, each context section (style guide, template, uploaded
+files) and the chat history. When everything does not fit, each section and the history get
+a share of the remaining budget in proportion to their size, and are trimmed at token
+boundaries rather than dropped outright.
+"""
+
+from typing import NamedTuple
+
+from config import load_environment_variable
+from gpt.tokenizer import count_tokens, decode, encode
+
+MODEL_CONTEXT_TOKENS = int(load_environment_variable("MODEL_CONTEXT_TOKENS", 60000))
+RESPONSE_TOKENS = 4096
+
+
+class PackedSection(NamedTuple):
+    name: str
+    tokens: int
+    kept_tokens: int
+
+
+class PackingReport(NamedTuple):
+    budget: int
+    prompt_tokens: int
+    sections: list[PackedSection]
+
+    @property
+    def used_tokens(self) -> int:
+        return self.prompt_tokens + sum(section.kept_tokens for section in self.sections)
+
+    @property
+    def trimmed(self) -> list[PackedSection]:
+        return [section for section in self.sections if section.kept_tokens < section.tokens]
+
+    def summary(self) -> str:
+        trimmed = ", ".join(
+            f"{section.name} {section.kept_tokens}/{section.tokens}" for section in self.trimmed
+        )
+        return (
+            f"Packed {self.used_tokens} of {self.budget} context tokens "
+            f"({len(self.sections)} sections, prompt {self.prompt_tokens})"
+            + (f", trimmed: {trimmed}" if trimmed else ", nothing trimmed")
+        )
+
+
+def trim_to_tokens(text: str, max_tokens: int, tokens: list[int] = None) -> str:
+    """
+    Cut text down to at most max_tokens tokens, noting how much was cut
+    """
+    tokens = encode(text) if tokens is None else tokens
+    if len(tokens) <= max_tokens:
+        return text
+    note = f"\n\n[... {len(tokens) - max_tokens} tokens trimmed to fit the context budget]"
+    return decode(tokens[: max(0, max_tokens)]) + note
+
+
+def _pack_history(history: list[dict], history_tokens: list[int], budget: int) -> list[dict]:
+    """
+    Keep the newest history messages that fit the budget, trimming the oldest one kept if needed
+    """
+    packed = []
+    remaining = budget
+    for message, tokens in zip(reversed(history), reversed(history_tokens)):
+        if remaining <= 0:
+            break
+        content = message["content"]
+        if tokens > remaining:
+            content = trim_to_tokens(content, remaining)
+        packed.insert(0, {"role": message["role"], "content": content})
+        remaining -= tokens
+    return packed
+
+
+def pack_context(
+    prompt: str,
+    sections: list[tuple[str, str]],
+    history: list[dict] = None,
+    budget: int = MODEL_CONTEXT_TOKENS,
+    response_tokens: int = RESPONSE_TOKENS,
+) -> tuple[list[str], list[dict], PackingReport]:
+    """
+    Fit the named context sections and the chat history into the token budget alongside prompt.
+
+    Returns the packed section texts (in the same order as sections), the packed history
+    and a PackingReport saying what was included and what was cut.
+    """
+    history = history or []
+    prompt_tokens = count_tokens(prompt)
+    available = max(0, budget - response_tokens - prompt_tokens)
+
+    section_tokens = [encode(text) for _, text in sections]
+    history_tokens = [count_tokens(message["content"]) for message in history]
+    sizes = [len(tokens) for tokens in section_tokens] + [sum(history_tokens)]
+    total = sum(sizes)
+
+    if total <= available:
+        shares = sizes
+    else:
+        shares = [available * size // total for size in sizes]
+
+    packed_sections = [
+        trim_to_tokens(text, share, tokens)
+        for (_, text), tokens, share in zip(sections, section_tokens, shares)
+    ]
+    packed_history = _pack_history(history, history_tokens, shares[-1])
+
+    report = PackingReport(
+        budget=budget,
+        prompt_tokens=prompt_tokens,
+        sections=[
+            PackedSection(name, len(tokens), min(len(tokens), share))
+            for (name, _), tokens, share in zip(sections, section_tokens, shares)
+        ]
+        + [PackedSection("chat history", sizes[-1], min(sizes[-1], shares[-1]))],
+    )
+    return packed_sections, packed_history, report
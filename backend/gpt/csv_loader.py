@@ -0,0 +1,159 @@
+"""
+Chunked CSV ingestion with token-aware row sampling.
+
+The CSV is read CSV_CHUNK_ROWS rows at a time, so peak memory stays flat however large the
+file is. If every row fits in the token budget the rows are returned as compact |-delimited
+lines. Otherwise the output is the header, per-column summary statistics and a head, tail and
+evenly spread (position stratified) sample of the rows, filled up to the budget.
+"""
+
+from collections import Counter, deque
+
+import pandas as pd
+
+from config import load_environment_variable
+from gpt.tokenizer import count_tokens, count_tokens_batch
+
+CSV_CHUNK_ROWS = int(load_environment_variable("CSV_CHUNK_ROWS", 10000))
+CSV_TYPE_SAMPLE_ROWS = 1000
+CSV_HEAD_ROWS = 20
+CSV_TAIL_ROWS = 10
+CSV_SAMPLES_PER_CHUNK = 5
+MAX_TRACKED_VALUES = 1000
+
+
+def _is_numeric(values: pd.Series) -> bool:
+    """
+    Infer a numeric column from a sample: every non-empty value parses as a number
+    """
+    non_empty = values[values != ""]
+    return len(non_empty) > 0 and pd.to_numeric(non_empty, errors="coerce").notna().all()
+
+
+class ColumnStats:
+    def __init__(self, name: str, numeric: bool):
+        self.name = name
+        self.numeric = numeric
+        self.count = 0
+        self.empty = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+        self.value_counts = Counter()
+
+    def update(self, values: pd.Series):
+        empty = values == ""
+        self.empty += int(empty.sum())
+        values = values[~empty]
+        if self.numeric:
+            numbers = pd.to_numeric(values, errors="coerce").dropna()
+            self.empty += len(values) - len(numbers)
+            if len(numbers):
+                self.count += len(numbers)
+                self.total += float(numbers.sum())
+                self.minimum = numbers.min() if self.minimum is None else min(self.minimum, numbers.min())
+                self.maximum = numbers.max() if self.maximum is None else max(self.maximum, numbers.max())
+        else:
+            self.count += len(values)
+            for value, count in values.value_counts().items():
+                if value in self.value_counts or len(self.value_counts) < MAX_TRACKED_VALUES:
+                    self.value_counts[value] += count
+
+    def describe(self) -> str:
+        if self.numeric:
+            mean = self.total / self.count if self.count else 0.0
+            return (
+                f"- {self.name} (numeric): {self.count} values, {self.empty} empty, "
+                f"min {self.minimum}, max {self.maximum}, mean {mean:.4g}"
+            )
+        distinct = len(self.value_counts)
+        distinct_text = f"{distinct}+" if distinct >= MAX_TRACKED_VALUES else f"{distinct}"
+        common = ", ".join(f"{value} ({count})" for value, count in self.value_counts.most_common(5))
+        return (
+            f"- {self.name} (text): {self.count} values, {self.empty} empty, "
+            f"{distinct_text} distinct, most common: {common}"
+        )
+
+
+def _fill_budget(rows: list[str], budget: int) -> list[str]:
+    """
+    Pick an evenly spaced subset of rows whose tokens fit within budget
+    """
+    if not rows or budget <= 0:
+        return []
+    row_tokens = count_tokens_batch(rows)
+    if sum(row_tokens) <= budget:
+        return rows
+    average = sum(row_tokens) / len(rows)
+    n_keep = max(0, min(len(rows), int(budget / average)))
+    if n_keep == 0:
+        return []
+    step = len(rows) / n_keep
+    return [rows[int(i * step)] for i in range(n_keep)]
+
+
+def load_csv_streaming(source, token_budget: int = 0) -> str:
+    """
+    Read a .csv file (path or file-like object) in chunks and render it within token_budget (0 for no limit)
+    """
+    reader = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=CSV_CHUNK_ROWS)
+
+    columns = None
+    stats = []
+    head = []
+    tail = deque(maxlen=CSV_TAIL_ROWS)
+    samples = []
+    all_rows = []
+    all_rows_tokens = 0
+    fits_in_budget = True
+    n_rows = 0
+
+    for chunk in reader:
+        if columns is None:
+            columns = [str(column) for column in chunk.columns]
+            type_sample = chunk.head(CSV_TYPE_SAMPLE_ROWS)
+            stats = [ColumnStats(column, _is_numeric(type_sample[column])) for column in chunk.columns]
+        for column_stats, column in zip(stats, chunk.columns):
+            column_stats.update(chunk[column])
+
+        rows = ["|".join(values).rstrip("|") for values in chunk.itertuples(index=False, name=None)]
+
+        if fits_in_budget:
+            all_rows_tokens += sum(count_tokens_batch(rows))
+            if token_budget and all_rows_tokens > token_budget:
+                fits_in_budget = False
+                all_rows = []
+            else:
+                all_rows.extend(rows)
+
+        if len(head) < CSV_HEAD_ROWS:
+            head.extend(rows[: CSV_HEAD_ROWS - len(head)])
+        tail.extend(rows)
+        step = max(1, len(rows) // CSV_SAMPLES_PER_CHUNK)
+        samples.extend(
+            (n_rows + index, rows[index])
+            for index in range(0, len(rows), step)
+            if n_rows + index >= CSV_HEAD_ROWS
+        )
+        n_rows += len(rows)
+
+    if columns is None:
+        return ""
+
+    header = "|".join(columns)
+    if fits_in_budget:
+        return "\n".join([header] + all_rows)
+
+    tail_start = n_rows - len(tail)
+    middle = [row for index, row in samples if index < tail_start]
+    summary = [
+        f"CSV with {n_rows} rows and {len(columns)} columns, summarised to fit a token budget of {token_budget}.",
+        "Columns:",
+        *[column_stats.describe() for column_stats in stats],
+        f"Rows (header, first {len(head)}, a representative sample, last {len(tail)}):",
+        header,
+        *head,
+    ]
+    remaining = token_budget - count_tokens("\n".join(summary + list(tail))) - 20
+    sampled = _fill_budget(middle, remaining)
+    return "\n".join(summary + ["..."] + sampled + ["..."] + list(tail))
@@ -0,0 +1,123 @@
+"""
+Near-duplicate detection across uploaded files, run before prompt assembly.
+
+Users often select several versions of one document (a draft, the final and a PDF export of
+the final). Each file gets a MinHash signature over its word shingles; a file whose estimated
+Jaccard similarity with an earlier file reaches NEAR_DUPLICATE_THRESHOLD is collapsed into the
+longer of the two. Long paragraphs repeated word for word in a later file are dropped as well.
+Signatures are cached per file text, so follow-up requests on the same upload are free.
+"""
+
+import functools
+import re
+import zlib
+
+import numpy as np
+
+from config import load_environment_variable
+from gpt.retrieval import FILE_HEADER
+
+NEAR_DUPLICATE_THRESHOLD = float(load_environment_variable("NEAR_DUPLICATE_THRESHOLD", 0.8))
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 64
+MIN_PARAGRAPH_CHARS = 200
+
+_PRIME = np.uint64((1 << 31) - 1)
+_random = np.random.default_rng(20240601)
+_A = _random.integers(1, (1 << 31) - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _random.integers(0, (1 << 31) - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def _split_header(contents: str) -> tuple[str, str]:
+    header_match = FILE_HEADER.match(contents)
+    header = header_match.group(0) if header_match else ""
+    return header, contents[len(header):]
+
+
+def _file_name(header: str) -> str:
+    return header.strip().removesuffix(" has the following contents:") or "an earlier file"
+
+
+def _normalise(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+@functools.lru_cache(maxsize=128)
+def minhash_signature(text: str) -> np.ndarray | None:
+    """
+    MinHash signature of the word shingles of text, or None if the text is too short to compare
+    """
+    words = text.lower().split()
+    if len(words) < SHINGLE_WORDS:
+        return None
+    shingles = {" ".join(words[i : i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles)
+    )
+    return np.array([((a * hashes + b) % _PRIME).min() for a, b in zip(_A, _B)], dtype=np.uint64)
+
+
+def estimate_similarity(signature: np.ndarray, other_signature: np.ndarray) -> float:
+    """
+    Estimated Jaccard similarity of the shingle sets behind two signatures
+    """
+    return float(np.mean(signature == other_signature))
+
+
+def collapse_near_duplicates(
+    file_contents: list[str], threshold: float = NEAR_DUPLICATE_THRESHOLD
+) -> tuple[list[str], list[str]]:
+    """
+    Collapse near-duplicate files and drop repeated long paragraphs.
+    Returns the contents of each file (in the original order) and a description of what was dropped.
+    """
+    split_files = [_split_header(contents) for contents in file_contents]
+    signatures = [minhash_signature(body) for _, body in split_files]
+    output = list(file_contents)
+    dropped = []
+
+    kept = []
+    for index, signature in enumerate(signatures):
+        if signature is None:
+            continue
+        duplicate_of = next(
+            (kept_index for kept_index in kept if estimate_similarity(signature, signatures[kept_index]) >= threshold),
+            None,
+        )
+        if duplicate_of is None:
+            kept.append(index)
+            continue
+        # Keep the longer version, and point the shorter one at it
+        longer, shorter = (
+            (index, duplicate_of)
+            if len(split_files[index][1]) > len(split_files[duplicate_of][1])
+            else (duplicate_of, index)
+        )
+        similarity = estimate_similarity(signature, signatures[duplicate_of])
+        output[shorter] = split_files[shorter][0] + f"[near-duplicate of {_file_name(split_files[longer][0])}, omitted]"
+        dropped.append(
+            f"{_file_name(split_files[shorter][0])} (~{similarity:.0%} similar to {_file_name(split_files[longer][0])})"
+        )
+        if shorter == duplicate_of:
+            kept[kept.index(duplicate_of)] = index
+
+    seen_paragraphs = set()
+    for index in sorted(kept):
+        header, body = split_files[index]
+        paragraphs = re.split(r"(\n\s*\n)", body)
+        repeated = 0
+        for position in range(0, len(paragraphs), 2):
+            paragraph = paragraphs[position]
+            if len(paragraph) < MIN_PARAGRAPH_CHARS:
+                continue
+            key = hash(_normalise(paragraph))
+            if key in seen_paragraphs:
+                paragraphs[position] = "[repeated paragraph omitted]"
+                repeated += 1
+            else:
+                seen_paragraphs.add(key)
+        if repeated:
+            output[index] = header + "".join(paragraphs)
+            dropped.append(f"{repeated} repeated paragraphs in {_file_name(header)}")
+
+    return output, dropped
@@ -0,0 +1,144 @@
+"""
+Content-addressed cache of extracted document text, so repeat queries on the same
+upload skip the pdf/docx/xlsx extractors entirely.
+
+Entries are keyed by a sha256 of the file bytes, the file extension, the extractor
+version and any extraction options. There is an in-memory LRU tier bounded by the
+total size of the cached text, and an optional on-disk tier (EXTRACTION_CACHE_DIR).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+from config import load_environment_variable, logger
+from service.metrics import metrics
+
+# Bump this whenever an extractor changes its output, so stale entries are never served
+EXTRACTOR_VERSION = "5"
+
+
+class ExtractedFile(NamedTuple):
+    contents: str
+    is_template: bool
+    tokens: int
+    pages_skipped: int = 0
+    # Set when the file could not be extracted; such results are never cached
+    error: str = None
+
+
+class ExtractionCache:
+    def __init__(self, max_bytes: int, cache_dir: str = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(data: bytes, file_name: str, options: str = "") -> str:
+        """
+        Build the cache key for the raw bytes of an uploaded file
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        suffix = Path(file_name).suffix.lower()
+        return hashlib.sha256(
+            f"{EXTRACTOR_VERSION}|{suffix}|{options}|{digest}".encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> ExtractedFile | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.increment("extraction_cache.hits")
+                return entry
+
+        entry = self._read_from_disk(key)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+            metrics.increment("extraction_cache.disk_hits")
+            self._put_in_memory(key, entry)
+            return entry
+
+        with self._lock:
+            self.misses += 1
+        metrics.increment("extraction_cache.misses")
+        return None
+
+    def put(self, key: str, entry: ExtractedFile):
+        self._put_in_memory(key, entry)
+        self._write_to_disk(key, entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "disk_enabled": self.cache_dir is not None,
+            }
+
+    def _put_in_memory(self, key: str, entry: ExtractedFile):
+        size = len(entry.contents.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= len(previous.contents.encode("utf-8"))
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted.contents.encode("utf-8"))
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _read_from_disk(self, key: str) -> ExtractedFile | None:
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return ExtractedFile(**json.load(f))
+        except Exception:
+            logger.warning(f"Discarding unreadable extraction cache entry {path}", exc_info=True)
+            return None
+
+    def _write_to_disk(self, key: str, entry: ExtractedFile):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entry._asdict(), f)
+            os.replace(temp_path, path)
+        except Exception:
+            logger.warning(f"Could not write extraction cache entry {path}", exc_info=True)
+
+
+extraction_cache = ExtractionCache(
+    max_bytes=int(load_environment_variable("EXTRACTION_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    cache_dir=load_environment_variable("EXTRACTION_CACHE_DIR", None),
+)
+metrics.register_collector("extraction_cache", extraction_cache.stats)
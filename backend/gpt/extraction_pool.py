@@ -0,0 +1,206 @@
+"""
+Sandboxed, recyclable worker processes used by DocumentParser to extract uploaded files.
+
+fitz and pandas extraction is CPU bound and holds the GIL, so files are sent to worker
+processes as (name, bytes) and the results are returned in the original order.
+
+A malformed or huge upload must not take the web task down with it, so every job runs with
+a wall-clock timeout (EXTRACTION_TIMEOUT_SECONDS) and every worker with an address-space limit
+(EXTRACTION_MEMORY_LIMIT_MB above its size at start-up). A worker that times out or dies is
+killed and replaced, and that file comes back as a per-file error while the other files still
+return their content. Workers are also restarted after EXTRACTION_MAX_JOBS_PER_WORKER jobs to
+cap memory fragmentation. The number of workers is set with EXTRACTION_POOL_SIZE; each can use
+EXTRACTION_MEMORY_LIMIT_MB on top of the web process's memory, so keep it small on small tasks.
+
+Workers are started by a forkserver rather than forked from the web process, whose other threads
+may hold locks (logging, sqlite, the runpod event loop) that a forked child would inherit locked.
+"""
+
+import multiprocessing
+import os
+import queue
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from config import load_environment_variable, logger
+from gpt.extraction_cache import ExtractedFile
+from gpt.tokenizer import count_tokens
+from service.metrics import metrics
+
+EXTRACTION_POOL_SIZE = int(load_environment_variable("EXTRACTION_POOL_SIZE", 2))
+EXTRACTION_TIMEOUT_SECONDS = float(load_environment_variable("EXTRACTION_TIMEOUT_SECONDS", 60))
+EXTRACTION_MEMORY_LIMIT_MB = int(load_environment_variable("EXTRACTION_MEMORY_LIMIT_MB", 256))
+EXTRACTION_MAX_JOBS_PER_WORKER = int(load_environment_variable("EXTRACTION_MAX_JOBS_PER_WORKER", 50))
+
+
+def _address_space_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _worker_main(connection, memory_limit_bytes: int):
+    """
+    Worker process loop: receive (file_name, data, token_budget) jobs and send back ("ok", ExtractedFile),
+    ("error", reason), or ("fatal", reason) when the worker is exiting and must be replaced
+    """
+    if memory_limit_bytes:
+        limit = _address_space_bytes() + memory_limit_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    from gpt.parsing import DocumentParser
+
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        file_name, data, token_budget = job
+        try:
+            file_object = BytesIO(data)
+            file_object.name = file_name
+            extracted = DocumentParser(token_budget=token_budget, parallel=False).extract_file(file_object)
+            connection.send(("ok", extracted))
+        except MemoryError:
+            connection.send(("fatal", "ran out of memory"))
+            return
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context, memory_limit_bytes: int, worker_main=_worker_main):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=worker_main, args=(child_connection, memory_limit_bytes), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.jobs = 0
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+        self.connection.close()
+
+
+def failed_extraction(file_name: str, reason: str) -> ExtractedFile:
+    contents = f"[{file_name} could not be read: {reason}]"
+    return ExtractedFile(contents, False, count_tokens(contents), 0, reason)
+
+
+class SandboxedExtractionPool:
+    def __init__(
+        self,
+        size: int = EXTRACTION_POOL_SIZE,
+        timeout: float = EXTRACTION_TIMEOUT_SECONDS,
+        memory_limit_bytes: int = EXTRACTION_MEMORY_LIMIT_MB * 1024 * 1024,
+        max_jobs_per_worker: int = EXTRACTION_MAX_JOBS_PER_WORKER,
+        worker_main=_worker_main,
+    ):
+        self.timeout = timeout
+        self.memory_limit_bytes = memory_limit_bytes
+        self.max_jobs_per_worker = max_jobs_per_worker
+        # The worker process loop, a module level function so the forkserver can import it
+        self.worker_main = worker_main
+        self._context = multiprocessing.get_context("forkserver")
+        # Imported once by the forkserver, so each worker starts without importing the extraction libraries again
+        self._context.set_forkserver_preload(["fitz", "docx", "openpyxl", "pandas", "gpt.tokenizer"])
+        self._threads = ThreadPoolExecutor(max_workers=size, thread_name_prefix="extraction")
+        # Worker slots, started lazily; None is an empty slot
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _start_worker(self) -> _Worker:
+        return _Worker(self._context, self.memory_limit_bytes, self.worker_main)
+
+    def _run(self, file_name: str, data: bytes, token_budget: int) -> ExtractedFile:
+        worker = self._idle.get()
+        try:
+            if worker is None or not worker.process.is_alive():
+                worker = self._start_worker()
+            try:
+                worker.connection.send((file_name, data, token_budget))
+            except OSError:
+                # The idle worker died since its last job, so replace it and send again
+                worker.kill()
+                worker = self._start_worker()
+                worker.connection.send((file_name, data, token_budget))
+            worker.jobs += 1
+
+            if not worker.connection.poll(self.timeout):
+                logger.error(f"Extraction of {file_name} timed out after {self.timeout} seconds, killing worker")
+                metrics.increment("extraction_pool.timeouts")
+                worker.kill()
+                worker = None
+                return failed_extraction(file_name, f"timed out after {self.timeout:.0f} seconds")
+
+            try:
+                status, result = worker.connection.recv()
+            except EOFError:
+                logger.error(f"Extraction worker died while reading {file_name}, exit code {worker.process.exitcode}")
+                metrics.increment("extraction_pool.crashes")
+                worker.kill()
+                worker = None
+                return failed_extraction(file_name, "the file is too large or malformed")
+
+            if status != "ok":
+                logger.error(f"Extraction of {file_name} failed: {result}")
+                metrics.increment("extraction_pool.errors")
+                if status == "fatal":
+                    worker.kill()
+                    worker = None
+                return failed_extraction(file_name, result)
+            return result
+        except OSError as e:
+            logger.error(f"Lost the extraction worker while sending {file_name}: {e}")
+            if worker is not None:
+                worker.kill()
+                worker = None
+            return failed_extraction(file_name, "the extraction worker failed")
+        finally:
+            if worker is not None and (worker.jobs >= self.max_jobs_per_worker or not worker.process.is_alive()):
+                metrics.increment("extraction_pool.recycled")
+                worker.stop()
+                worker = None
+            self._idle.put(worker)
+
+    def extract(self, files: list, token_budget: int = None) -> list[ExtractedFile]:
+        futures = [
+            self._threads.submit(self._run, file.name, file.getvalue(), token_budget) for file in files
+        ]
+        return [future.result() for future in futures]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> SandboxedExtractionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            logger.info(f"Starting extraction pool with {EXTRACTION_POOL_SIZE} workers")
+            _pool = SandboxedExtractionPool()
+        return _pool
+
+
+def extract_files_in_parallel(files: list, token_budget: int = None) -> list[ExtractedFile]:
+    """
+    Extract each file in a sandboxed worker process, returning the results in the same order as files
+    """
+    return get_extraction_pool().extract(files, token_budget=token_budget)
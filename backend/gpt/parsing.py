@@ -1,23 +1,31 @@
+import functools
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import zipfile
 import pkg_resources
-import pandas as pd
 from pathlib import Path
 from io import BytesIO, StringIO
-from tempfile import NamedTemporaryFile
+from xml.etree import ElementTree
 # import streamlit as st
 
 import fitz
 import docx
-import docx2txt
-import tiktoken
+import openpyxl
 from striprtf.striprtf import rtf_to_text
 
 from gpt.prompts import (
-    summarization_prompt_rimon_specific,
-    summarization_prompt_rimon_specific_new,
-    summarization_prompt_rimon_specific_json_style,
+    summarization_prompt_rimon_specific_template,
+    summarization_prompt_rimon_specific_json_style_template,
+    summarization_reduce_prompt_json_style_template,
 )
-from service.runpod_utils import runpod_call
-from config import logger
+from gpt.extraction_cache import ExtractedFile, ExtractionCache, extraction_cache
+from gpt.extraction_pool import extract_files_in_parallel
+from gpt.csv_loader import load_csv_streaming
+from gpt.dedup import collapse_near_duplicates
+from gpt.tokenizer import count_tokens, count_tokens_batch, decode, encode
+from config import load_environment_variable, logger
 
 NEW_TEMPLATE_PATH = pkg_resources.resource_filename(
     __name__, "Templates/BLANK - RDTI Initial Information Preparation FY23 - v18.docx"
@@ -31,20 +39,76 @@ TEMPLATE_PATH = pkg_resources.resource_filename(
     __name__, "Templates/rimon_template_v2.docx"
 )
 
+PARALLEL_EXTRACTION = load_environment_variable("PARALLEL_EXTRACTION", "True") == "True"
+# Default cap on the tokens read from any one file, 0 for no limit
+FILE_TOKEN_BUDGET = int(load_environment_variable("FILE_TOKEN_BUDGET", 0))
+XLSX_MAX_ROWS = int(load_environment_variable("XLSX_MAX_ROWS", 5000))
+DEDUPLICATE_FILES = load_environment_variable("DEDUPLICATE_FILES", "True") == "True"
+SUMMARY_CONCURRENCY = int(load_environment_variable("SUMMARY_CONCURRENCY", 4))
+SUMMARY_TARGET_TOKENS = int(load_environment_variable("SUMMARY_TARGET_TOKENS", 6000))
+SUMMARY_WINDOW_TOKENS = 6000
+SUMMARY_WINDOW_OVERLAP = 500
 
-def count_tokens(input_text: str) -> int:
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+WORD_TEXT = f"{WORD_NAMESPACE}t"
+WORD_TAB = f"{WORD_NAMESPACE}tab"
+WORD_BREAKS = {f"{WORD_NAMESPACE}br", f"{WORD_NAMESPACE}cr"}
+WORD_PARAGRAPH = f"{WORD_NAMESPACE}p"
+
+
+def _docx_part_to_text(docx_zip: zipfile.ZipFile, part_name: str) -> list[str]:
     """
-    Count the number of tokens in an input string
+    Stream one xml part of a .docx archive, returning its text pieces in document order
     """
-    encoding_model = tiktoken.get_encoding("cl100k_base")
-    return len(encoding_model.encode(input_text))
+    text_pieces = []
+    with docx_zip.open(part_name) as part:
+        for event, element in ElementTree.iterparse(part, events=("start", "end")):
+            if event == "start":
+                if element.tag == WORD_PARAGRAPH:
+                    text_pieces.append("\n\n")
+            elif element.tag == WORD_TEXT:
+                text_pieces.append(element.text or "")
+            elif element.tag == WORD_TAB:
+                text_pieces.append("\t")
+            elif element.tag in WORD_BREAKS:
+                text_pieces.append("\n")
+            elif element.tag == WORD_PARAGRAPH:
+                element.clear()
+    return text_pieces
+
+
+def docx_to_text(docx_file) -> str:
+    """
+    Extract the text of a .docx file (path or binary file-like object) in a single streaming pass
+    over its headers, body and footers, without writing it to disk. Matches docx2txt.process output.
+    """
+    with zipfile.ZipFile(docx_file) as docx_zip:
+        part_names = docx_zip.namelist()
+        headers = [name for name in part_names if re.match(r"word/header[0-9]*\.xml", name)]
+        footers = [name for name in part_names if re.match(r"word/footer[0-9]*\.xml", name)]
+
+        text_pieces = []
+        for part_name in headers + ["word/document.xml"] + footers:
+            text_pieces.extend(_docx_part_to_text(docx_zip, part_name))
+
+    return "".join(text_pieces).strip()
 
 
 class DocumentParser:
-    def __init__(self, files: list = None, encoding_model: str = "cl100k_base"):
+    def __init__(
+        self,
+        files: list = None,
+        encoding_model: str = "cl100k_base",
+        parallel: bool = None,
+        token_budget: int = None,
+    ):
         self.type = None
         self.files = files
-        self.encoding_model = tiktoken.get_encoding(encoding_model)
+        self.parallel = PARALLEL_EXTRACTION if parallel is None else parallel
+        # Stop reading a file once this many tokens have been extracted from it (0 for no limit)
+        self.token_budget = FILE_TOKEN_BUDGET if token_budget is None else token_budget
+        self.encoding_name = encoding_model
 
     def load_from_file_path(self, file_path) -> str:
 
@@ -72,45 +136,97 @@ class DocumentParser:
         """
         Count the number of tokens in an input string
         """
-        return len(self.encoding_model.encode(input_text))
+        return count_tokens(input_text, self.encoding_name)
+
+    def extract_file(self, file) -> ExtractedFile:
+        """
+        Extract the contents of one uploaded file, flagging whether it was an rimon template
+        """
+        contents, is_template, pages_skipped = self.extract_contents(file)
+        return ExtractedFile(contents, is_template, self.count_tokens(contents), pages_skipped)
+
+    def extract_contents(self, file) -> tuple[str, bool, int]:
+        """
+        Extract the text of one uploaded file, returning (contents, is_template, pages_skipped)
+        """
+        file_extension = Path(file.name).suffix
+        is_template = False
+        pages_skipped = 0
+
+        match file_extension:
+            case ".pdf":
+                contents, pages_skipped = self.stream_pdf(file, token_budget=self.token_budget)
+            case ".txt":
+                contents = self.load_txt(file)
+            case ".docx":
+                contents, is_template = self.load_docx_advanced(file)
+            case ".rtf":
+                contents = self.load_rtf(file)
+            case ".csv":
+                contents = self.load_csv(file)
+            case ".xlsx":
+                contents = self.load_xlsx(file)
+            case _:
+                contents = "Unknown file type"
+
+        return contents, is_template, pages_skipped
+
+    def extract_files(self, files: list) -> list[ExtractedFile]:
+        """
+        Extract each of the files, serving exact byte matches from the extraction cache.
+        Cache misses are extracted in sandboxed worker processes when parallel extraction is enabled,
+        where a file that times out or crashes its worker comes back as a per-file error.
+        """
+        cache_keys = [
+            ExtractionCache.make_key(file.getvalue(), file.name, options=f"token_budget={self.token_budget}")
+            for file in files
+        ]
+        extracted_files = [extraction_cache.get(cache_key) for cache_key in cache_keys]
+        missing = [index for index, extracted in enumerate(extracted_files) if extracted is None]
+        logger.info(f"Extraction cache served {len(files) - len(missing)} of {len(files)} files")
+
+        if self.parallel and missing:
+            results = extract_files_in_parallel([files[index] for index in missing], token_budget=self.token_budget)
+        else:
+            extracted_contents = [self.extract_contents(files[index]) for index in missing]
+            token_counts = count_tokens_batch([contents for contents, _, _ in extracted_contents], self.encoding_name)
+            results = [
+                ExtractedFile(contents, is_template, tokens, pages_skipped)
+                for (contents, is_template, pages_skipped), tokens in zip(extracted_contents, token_counts)
+            ]
+
+        for index, extracted in zip(missing, results):
+            if extracted.error is None:
+                extraction_cache.put(cache_keys[index], extracted)
+            extracted_files[index] = extracted
+
+        return extracted_files
 
     def load_file_contents(self) -> str:
         """
-        Takes the files passed to the document parser, and returns a string with all of their contents.
+        Takes the files passed to the document parser, and returns a list with the contents of each file.
         """
-        TEMPLATE_FLAG = False
         rimon_template_contents = "No rimon Template Given by User."
+        rimon_tokens = self.count_tokens(rimon_template_contents)
+        additional_contents_tokens = 0
+        pages_skipped = 0
         output_contents = []
-        for file in self.files:
-            file_extension = Path(file.name).suffix
-
-            output_contents.append(f"\n\n{file.name} has the following contents:\n\n")
-
-            match file_extension:
-                case ".pdf":
-                    contents = self.load_pdf(file)
-                case ".txt":
-                    contents = self.load_txt(file)
-                case ".docx":
-                    contents, TEMPLATE_FLAG = self.load_docx_advanced(file)
-                case ".rtf":
-                    contents = self.load_rtf(file)
-                case ".csv":
-                    contents = self.load_csv(file)
-                case ".xlsx":
-                    contents = self.load_xlsx(file)
-                case _:
-                    contents = "Unknown file type"
-
-            if TEMPLATE_FLAG:
-                rimon_template_contents = contents
-                TEMPLATE_FLAG = False
+        headers = [f"\n\n{file.name} has the following contents:\n\n" for file in self.files]
+        additional_contents_tokens += sum(count_tokens_batch(headers, self.encoding_name))
+        for file, header, extracted in zip(self.files, headers, self.extract_files(self.files)):
+
+            if extracted.is_template:
+                rimon_template_contents = extracted.contents
+                rimon_tokens = extracted.tokens
+                output_contents.append(header)
             else:
-                output_contents.append(contents)
-            logger.info(f"Loaded {file.name} with file contents: {contents[:200]}")
+                output_contents.append(header + extracted.contents)
+                additional_contents_tokens += extracted.tokens
+            pages_skipped += extracted.pages_skipped
+            logger.info(f"Loaded {file.name} with file contents: {extracted.contents[:200]}")
 
-        rimon_tokens = self.count_tokens(rimon_template_contents)
-        additional_contents_tokens = self.count_tokens("".join(output_contents))
+        if pages_skipped:
+            logger.warning(f"Skipped {pages_skipped} pages across {len(self.files)} files after reaching the token budget")
 
         return (
             output_contents,
@@ -118,27 +234,51 @@ class DocumentParser:
             rimon_tokens + additional_contents_tokens,
         )
 
-    # TODO: To set up with pdf2text, I think we need to make a tempfile from the bytes object then read in that file
-    def load_pdf(self, file_object=None, file_path=None) -> str:
+    def iter_pdf_pages(self, file_object=None, file_path=None):
         """
-        Load a .pdf file, and return the contents as a string
+        Yield (page_number, n_pages, page_text) for each page of a .pdf file, one page at a time
         """
         if file_path:
             pdf_document = fitz.open(file_path, filetype="pdf")
-            filename = file_path
         else:
             pdf_document = fitz.open(stream=file_object.getvalue(), filetype="pdf")
-            filename = file_object.name
-
-        n_pages = len(pdf_document)
 
-        text_chunks = [
-            f"{pdf_document.load_page(page_number).get_text()}"
-            for page_number in range(n_pages)
-        ]
+        with pdf_document:
+            n_pages = len(pdf_document)
+            for page_number in range(n_pages):
+                yield page_number, n_pages, pdf_document.load_page(page_number).get_text()
 
-        output_text = "".join(text_chunks)
+    def stream_pdf(self, file_object=None, file_path=None, token_budget: int = None) -> tuple[str, int]:
+        """
+        Read a .pdf file page by page, counting tokens as it goes, and stop once token_budget is reached.
+        Returns the text read and the number of pages skipped.
+        """
+        filename = file_path or file_object.name
+        text_chunks = []
+        tokens = 0
+        pages_skipped = 0
 
+        pages = self.iter_pdf_pages(file_object=file_object, file_path=file_path)
+        try:
+            for page_number, n_pages, page_text in pages:
+                if token_budget and tokens >= token_budget:
+                    pages_skipped = n_pages - page_number
+                    logger.warning(f"Token budget of {token_budget} reached in {filename}, skipped {pages_skipped} of {n_pages} pages")
+                    text_chunks.append(f"\n\n[{pages_skipped} of {n_pages} pages not read: token budget of {token_budget} reached]")
+                    break
+                text_chunks.append(page_text)
+                if token_budget:
+                    tokens += self.count_tokens(page_text)
+        finally:
+            pages.close()
+
+        return "".join(text_chunks), pages_skipped
+
+    def load_pdf(self, file_object=None, file_path=None, token_budget: int = None) -> str:
+        """
+        Load a .pdf file, and return the contents as a string
+        """
+        output_text, _ = self.stream_pdf(file_object=file_object, file_path=file_path, token_budget=token_budget)
         return output_text
 
     # def load_pdf_advanced(self, file_object) -> str:
@@ -201,52 +341,71 @@ class DocumentParser:
 
     def load_docx_advanced(self, file_object=None, file_path=None) -> str:
         """
-        Load a .docx file, and return the contents as a string
+        Load a .docx file, and return the contents as a string.
+        Uploaded files are read straight from memory, and rimon templates are detected from the same pass.
         """
 
         if file_path:
-            output_text = docx2txt.process(file_path)
+            with open(file_path, "rb") as docx_file:
+                output_text = docx_to_text(docx_file)
             return output_text
         else:
             TEMPLATE_FLAG = False
-            with NamedTemporaryFile(suffix=".docx", delete=True) as temp_docx_file:
-                temp_docx_file.write(BytesIO(file_object.getvalue()).read())
-                doc_text = docx2txt.process(temp_docx_file.name)
-
-                # Now, we need to check the doc_text to see if it was actually an rimon template!
-                # If it was, we will instead call
-                if (
-                    "Please fill out the following table:" in doc_text
-                    or "What was your goal or problem being solved in this Activity?"
-                    in doc_text
-                ):
-                    doc_text = parse_rimon_template(file_object)
-                    TEMPLATE_FLAG = True
+            file_object.seek(0)
+            doc_text = docx_to_text(file_object)
+
+            # Now, we need to check the doc_text to see if it was actually an rimon template!
+            # If it was, we strip the template boilerplate from the text we already have
+            if (
+                "Please fill out the following table:" in doc_text
+                or "What was your goal or problem being solved in this Activity?"
+                in doc_text
+            ):
+                doc_text = parse_rimon_template(doc_text)
+                TEMPLATE_FLAG = True
 
             return doc_text, TEMPLATE_FLAG
 
     def load_xlsx(self, file_object=None, file_path=None) -> str:
         """
-        Load a .xlsx file, and return the contents as a string
+        Load a .xlsx file, and return the contents as a string.
+        Rows are streamed from the workbook in read-only mode and rendered as compact |-delimited lines,
+        stopping at XLSX_MAX_ROWS rows or the token budget.
         """
         if file_path:
-            xlsx_file = pd.ExcelFile(file_path)
+            workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
             filename = file_path
         else:
-            xlsx_file = pd.ExcelFile(StringIO(file_object.getvalue().decode("latin-1")))
+            file_object.seek(0)
+            workbook = openpyxl.load_workbook(file_object, read_only=True, data_only=True)
             filename = file_object.name
 
-        xlsx_file_sheets = {
-            sheet_name: xlsx_file.parse(sheet_name)
-            for sheet_name in xlsx_file.sheet_names
-        }
-
         output_contents = []
-        for xlsx_sheet_name, xlsx_sheet_contents in xlsx_file_sheets.items():
-            output_contents.append(
-                f"\n\nThe Sheet: {xlsx_sheet_name} has the following contents:\n"
-            )
-            output_contents.append(xlsx_sheet_contents.to_string(index=False))
+        n_rows = 0
+        tokens = 0
+        try:
+            for sheet_index, sheet in enumerate(workbook.worksheets):
+                output_contents.append(
+                    f"\n\nThe Sheet: {sheet.title} has the following contents:\n"
+                )
+                for row in sheet.iter_rows(values_only=True):
+                    line = "|".join("" if cell is None else str(cell) for cell in row).rstrip("|")
+                    if not line:
+                        continue
+                    tokens += self.count_tokens(line)
+                    if n_rows >= XLSX_MAX_ROWS or (self.token_budget and tokens > self.token_budget):
+                        sheets_skipped = len(workbook.worksheets) - sheet_index - 1
+                        note = (
+                            f"\n[Truncated after {n_rows} rows: row cap of {XLSX_MAX_ROWS} or token budget of {self.token_budget} reached"
+                            + (f", {sheets_skipped} more sheets not read]" if sheets_skipped else "]")
+                        )
+                        logger.warning(f"Truncated {filename} in sheet {sheet.title}: {note.strip()}")
+                        output_contents.append(note)
+                        return "".join(output_contents)
+                    output_contents.append(f"{line}\n")
+                    n_rows += 1
+        finally:
+            workbook.close()
 
         output_text = "".join(output_contents)
 
@@ -254,97 +413,99 @@ class DocumentParser:
 
     def load_csv(self, file_object=None, file_path=None) -> str:
         """
-        Load a .csv file, and return the contents as a string
+        Load a .csv file in chunks, and return the contents (or a summary within the token budget) as a string
         """
         if file_path:
-            data = pd.read_csv(file_path)
+            output_text = load_csv_streaming(file_path, self.token_budget)
             filename = file_path
         else:
-            data = pd.read_csv(StringIO(file_object.getvalue().decode("utf-8")))
+            file_object.seek(0)
+            output_text = load_csv_streaming(file_object, self.token_budget)
             filename = file_object.name
 
-        output_text = data.to_string(index=False)
         return output_text
 
 
-def parse_rimon_template(
-    INPUT_DOCX, TEMPLATE_PATH=NEW_TEMPLATE_PATH, OLD_TEMPLATE_PATH=OLD_TEMPLATE_PATH
-) -> str:
-    LINES_TO_KEEP = {
-        "Company name",
-        "Company postcode",
-        "Project name",
-        "Project start date",
-        "Estimated end date",
-        "1b) Project Objectives:",
-        "1c) Project Activities:",
-        "Step 2 – Core Activities",
-        "Step 3 - Supporting Activities",
-    }
-
-    # This section can all probably be cached, so it doesn't need computed each time?
-    template = docx2txt.process(TEMPLATE_PATH)
-
-    template_lines = template.split("\n")
+# Section titles from the templates that stay in the output to indicate section beginnings
+LINES_TO_KEEP = {
+    "Company name",
+    "Company postcode",
+    "Project name",
+    "Project start date",
+    "Estimated end date",
+    "1b) Project Objectives:",
+    "1c) Project Activities:",
+    "Step 2 – Core Activities",
+    "Step 3 - Supporting Activities",
+}
 
-    while "" in template_lines:
-        template_lines.remove("")
 
-    template_lines.pop(1)
+def load_template_lines(template_path) -> list[str]:
+    """
+    Load the boilerplate lines of a blank template, i.e. the lines to strip from a filled-in copy
+    """
+    with open(template_path, "rb") as template_file:
+        template_text = docx_to_text(template_file)
+    template_lines = [line for line in template_text.split("\n") if line]
+    template_lines.pop(1)  # line with financial year
+    return [line for line in template_lines if line not in LINES_TO_KEEP]
 
-    for l in LINES_TO_KEEP:
-        try:
-            template_lines.remove(
-                l
-            )  # keep section titles to indicate section begginings
-        except:
-            continue
 
-    template2 = docx2txt.process(OLD_TEMPLATE_PATH)
+@functools.lru_cache(maxsize=None)
+def get_template_line_index(template_path=NEW_TEMPLATE_PATH, old_template_path=OLD_TEMPLATE_PATH) -> Counter:
+    """
+    How many times each template boilerplate line appears across both RDTI templates, built once on first use
+    """
+    return Counter(load_template_lines(template_path) + load_template_lines(old_template_path))
 
-    template_lines2 = template2.split("\n")
-    while "" in template_lines2:
-        template_lines2.remove("")
 
-    template_lines2.pop(1)  # line with financial year
-    for l in LINES_TO_KEEP:
-        try:
-            template_lines2.remove(
-                l
-            )  # keep section titles to indicate section begginings
-        except:
+def filter_template_lines(text: str, template_line_index: Counter) -> str:
+    """
+    Drop blank lines and template boilerplate lines from the text in one linear pass. Each template
+    line removes one copy of itself, the first, so an answer that repeats a template line is kept.
+    """
+    remaining = template_line_index.copy()
+    lines = []
+    for line in text.split("\n"):
+        if not line:
             continue
-
-    template_lines = template_lines + template_lines2
-
-    with NamedTemporaryFile(suffix=".docx", delete=True) as temp_docx_file:
-        temp_docx_file.write(BytesIO(INPUT_DOCX.getvalue()).read())
-        text = docx2txt.process(temp_docx_file.name)
-
-    lines = text.split("\n")
-    while "" in lines:
-        lines.remove("")
-
-    # Remove unnecessary text
-    for line in template_lines:
-        try:
-            lines.remove(line)
-        except:
+        if remaining[line]:
+            remaining[line] -= 1
             continue
+        lines.append(f"{line}\n")
+    return "\n".join(lines)
 
-    lines = [f"{line}\n" for line in lines]
 
-    return "\n".join(lines)
+def parse_rimon_template(
+    doc_text: str, TEMPLATE_PATH=NEW_TEMPLATE_PATH, OLD_TEMPLATE_PATH=OLD_TEMPLATE_PATH
+) -> str:
+    """
+    Strip the template boilerplate from the already extracted text of a filled-in rimon template
+    """
+    template_line_index = get_template_line_index(TEMPLATE_PATH, OLD_TEMPLATE_PATH)
+    return filter_template_lines(doc_text, template_line_index)
 
 
-def process_files(files, summarize: bool = False, **runpod_credentials):
+def process_files(files, summarize: bool = False, token_budget: int = None, as_list: bool = False, **runpod_credentials):
     """
     Takes streamlit files, and loads the document parser and simply extracts out the file contents.
+    token_budget caps the tokens read from any one file, defaulting to FILE_TOKEN_BUDGET (0 for no limit).
+    as_list returns the contents of each file separately, so prompts can be packed per file.
     """
 
-    parser = DocumentParser(files)
+    parser = DocumentParser(files, token_budget=token_budget)
     file_contents, rimon_summary, total_tokens = parser.load_file_contents()
 
+    if DEDUPLICATE_FILES and len(file_contents) > 1:
+        deduplicated_contents, dropped = collapse_near_duplicates(file_contents)
+        if dropped:
+            changed = [index for index, contents in enumerate(file_contents) if contents is not deduplicated_contents[index]]
+            total_tokens -= sum(count_tokens_batch([file_contents[index] for index in changed])) - sum(
+                count_tokens_batch([deduplicated_contents[index] for index in changed])
+            )
+            logger.info(f"Dropped near-duplicate content: {'; '.join(dropped)}. Total tokens now {total_tokens}")
+            file_contents = deduplicated_contents
+
     # Now, call summarization to summarize the file contents ...
     if summarize:
         file_contents_summarized = summarize_list_of_text(
@@ -358,35 +519,96 @@ def process_files(files, summarize: bool = False, **runpod_credentials):
     else:
 
         return (
-            "".join(file_contents),
+            file_contents if as_list else "".join(file_contents),
             rimon_summary,
             total_tokens,
         )
 
 
-def summarize_list_of_text(input_text_chunks: list[str], **runpod_credentials) -> str:
+def runpod_call(prompt: str, **runpod_credentials) -> str:
     """
-    Take a list of strings, and summarize them into one string
+    service.runpod_utils.runpod_call, imported on first use so that the extraction workers, which
+    import this module, don't load the LLM clients and caches
     """
-    encoding = tiktoken.get_encoding("cl100k_base")
-    output = []
+    from service.runpod_utils import runpod_call
 
-    for index, input_text_chunk in enumerate(input_text_chunks):
-        # Firstly, let's only pass in up to 4k tokens at a time. We will use a 500 token overlap
-        input_text_chunk_tokens = encoding.encode(input_text_chunk)
+    return runpod_call(prompt, **runpod_credentials)
 
-        input_text_chunk_sub_chunks = [
-            encoding.decode(input_text_chunk_tokens[i : i + 6000])
-            for i in range(0, len(input_text_chunk_tokens), 5500)
-        ]
 
-        for sub_index, sub_chunk in enumerate(input_text_chunk_sub_chunks):
-            input_prompt = summarization_prompt_rimon_specific_json_style.replace(
-                "<text-to-compress>", sub_chunk
-            )
-            summary_output = runpod_call(input_prompt, **runpod_credentials)
+def _summarize_window(text_window: str, **runpod_credentials) -> str:
+    input_prompt = summarization_prompt_rimon_specific_json_style_template.render(
+        text_to_compress=text_window
+    )
+    return runpod_call(input_prompt, **runpod_credentials)
+
+
+def _merge_summaries(summaries: list[str], **runpod_credentials) -> str:
+    input_prompt = summarization_reduce_prompt_json_style_template.render(
+        summaries_to_merge="\n\n".join(summaries)
+    )
+    return runpod_call(input_prompt, **runpod_credentials)
+
+
+def _batch_summaries(summaries: list[str], summary_tokens: list[int], window_tokens: int) -> list[list[str]]:
+    """
+    Group consecutive summaries into batches of at most window_tokens tokens (and at least one summary)
+    """
+    batches = [[]]
+    batch_tokens = 0
+    for summary, tokens in zip(summaries, summary_tokens):
+        if batches[-1] and batch_tokens + tokens > window_tokens:
+            batches.append([])
+            batch_tokens = 0
+        batches[-1].append(summary)
+        batch_tokens += tokens
+    return batches
+
+
+def summarize_list_of_text(
+    input_text_chunks: list[str],
+    max_concurrency: int = None,
+    target_tokens: int = None,
+    **runpod_credentials,
+) -> str:
+    """
+    Take a list of strings, and summarize them into one string.
+
+    Map: each file is split into SUMMARY_WINDOW_TOKENS windows (with a 500 token overlap) which are
+    summarised concurrently, at most max_concurrency calls at a time.
+    Reduce: consecutive summaries are merged in window-sized batches, again concurrently, level by
+    level until the combined summary fits in target_tokens. Wall-clock time scales with the depth
+    of the tree rather than the number of windows.
+    """
+    max_concurrency = max_concurrency or SUMMARY_CONCURRENCY
+    target_tokens = target_tokens or SUMMARY_TARGET_TOKENS
+    step = SUMMARY_WINDOW_TOKENS - SUMMARY_WINDOW_OVERLAP
+
+    text_windows = []
+    for input_text_chunk in input_text_chunks:
+        input_text_chunk_tokens = encode(input_text_chunk)
+        text_windows.extend(
+            decode(input_text_chunk_tokens[i : i + SUMMARY_WINDOW_TOKENS])
+            for i in range(0, len(input_text_chunk_tokens), step)
+        )
 
-            output.append(summary_output)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        start = datetime.now()
+        output = list(executor.map(lambda text_window: _summarize_window(text_window, **runpod_credentials), text_windows))
+        logger.info(f"Summarised {len(text_windows)} windows in {datetime.now() - start}")
+
+        level = 0
+        while len(output) > 1:
+            summary_tokens = count_tokens_batch(output)
+            if sum(summary_tokens) <= target_tokens:
+                break
+            batches = _batch_summaries(output, summary_tokens, SUMMARY_WINDOW_TOKENS)
+            if len(batches) == len(output):
+                logger.warning("Summaries are too large to merge any further, stopping the reduce stage")
+                break
+            level += 1
+            start = datetime.now()
+            output = list(executor.map(lambda batch: _merge_summaries(batch, **runpod_credentials), batches))
+            logger.info(f"Reduce level {level}: merged into {len(output)} summaries in {datetime.now() - start}")
 
     return "\n\n".join(output)
 
@@ -395,8 +617,8 @@ def summarize_text(input_text: str, **runpod_credentials):
     """
     Summarize one text segment
     """
-    input_prompt = summarization_prompt_rimon_specific.replace(
-        "<text-to-compress>", input_text
+    input_prompt = summarization_prompt_rimon_specific_template.render(
+        text_to_compress=input_text
     )
 
     return runpod_call(input_prompt, **runpod_credentials)
@@ -1,5 +1,34 @@
+import re
 from unidecode import unidecode
 
+PLACEHOLDER = re.compile(r"<([a-z][a-z-]*)>")
+
+
+class PromptTemplate:
+    """
+    A prompt compiled once into literal segments and <placeholder> names, rendered with a single join.
+
+    Values are inserted verbatim and never searched again, so placeholder-like text inside
+    user content is left alone. Placeholders without a value (e.g. <citation-needed>) are kept as is.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        parts = PLACEHOLDER.split(template)
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+
+    def render(self, **values) -> str:
+        """
+        Fill placeholders from keyword arguments, with dashes as underscores (<user-input> is user_input)
+        """
+        pieces = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = values.get(name.replace("-", "_"))
+            pieces.append(f"<{name}>" if value is None else value)
+            pieces.append(literal)
+        return "".join(pieces)
+
 guidance = {
     "Objectives": '[STYLE: FUTURE TENSE, FORMAL THIRD PERSON] Brief intro about the project and or business <mandatory phrase> The overall objective of this project is to...<fill in> <copy/paste> Expenditure claimed in this R&D application is limited only to specific eligible experimental activities and any non-R&D activities have been excluded. <copy/paste, if only 1 core activity> Eligible research and development activities in the financial year 2022-23 focused on experimentation to test the hypothesis that...<paste from technical hypothesis statement (from the "What was the hypothesis?" section below)>.',
     "Supporting_activities": [
@@ -372,3 +401,40 @@ We need to preserve as many details as possible to write the final report, while
 <text-to-compress>
 
 The compressed and filtered text, which could now be used as a summary of the input file for the purposes of writing the R&D tax report is is:"""
+
+
+summarization_reduce_prompt_json_style = """
+You will be given several summaries, each extracted from one part of the documents uploaded by an individual at a company who is looking to understand if their project is eligble for R&D tax credits.
+Each summary is a dictionary of quotes relevant to writing an R&D tax credit report.
+
+Your task is to merge them into ONE dictionary with the same keys. Combine the quotes for each key, remove quotes that are repeated, and keep the quotes word for word.
+
+{
+    "dates": [{"date":, "dateInfo":}],
+    "projectInfo":,
+    "companyInfo":,
+    "projectObjectives":,
+    "hypothesis":,
+    "problems":,
+    "opportunities":,
+    "experiments":,
+    "activities:",
+    "researchInfo":,
+    "how_get_new_knowledge":,
+    "experiments_evaluation": ,
+    "observations_of_experiments":
+}
+
+DO NOT include a KEY if none of the summaries have a quote for it.
+
+<summaries-to-merge>
+
+The merged summary is:"""
+
+
+DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE = PromptTemplate(DOC_AUDIT_PROMPT_WITH_FILES)
+CHAT_PROMPT_WITH_FILES_TEMPLATE = PromptTemplate(CHAT_PROMPT_WITH_FILES)
+CHAT_PROMPT_WITHOUT_TEMPLATE = PromptTemplate(CHAT_PROMPT_WITHOUT)
+summarization_prompt_rimon_specific_template = PromptTemplate(summarization_prompt_rimon_specific)
+summarization_prompt_rimon_specific_json_style_template = PromptTemplate(summarization_prompt_rimon_specific_json_style)
+summarization_reduce_prompt_json_style_template = PromptTemplate(summarization_reduce_prompt_json_style)
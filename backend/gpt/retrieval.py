@@ -0,0 +1,180 @@
+"""
+Lexical (BM25) retrieval over passage-sized chunks of extracted document text.
+
+Each file is split into passages of about RETRIEVAL_PASSAGE_TOKENS tokens, and the passage
+term counts are cached per file text, so follow-up questions about the same upload only pay
+for scoring. For a question, only the top scoring passages that fit the token budget are kept,
+in document order, so the prompt carries the relevant paragraphs rather than whole files.
+"""
+
+import functools
+import math
+import re
+from collections import Counter
+from typing import NamedTuple
+
+from config import load_environment_variable
+from gpt.tokenizer import count_tokens, count_tokens_batch, decode, encode
+
+RETRIEVAL_PASSAGE_TOKENS = int(load_environment_variable("RETRIEVAL_PASSAGE_TOKENS", 200))
+RETRIEVAL_TOKEN_BUDGET = int(load_environment_variable("RETRIEVAL_TOKEN_BUDGET", 12000))
+RETRIEVAL_TOP_K = int(load_environment_variable("RETRIEVAL_TOP_K", 60))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+FILE_HEADER = re.compile(r"^\s*.+? has the following contents:\n\n")
+WORD = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has have in is it its of on or that the this to was were "
+    "what when where which who why will with you your i me my we our do does did can could should would "
+    "how please about".split()
+)
+
+
+def tokenize_terms(text: str) -> list[str]:
+    return [term for term in WORD.findall(text.lower()) if term not in STOP_WORDS]
+
+
+class Passage(NamedTuple):
+    text: str
+    tokens: int
+    terms: Counter
+
+
+def split_passages(text: str, passage_tokens: int = RETRIEVAL_PASSAGE_TOKENS) -> list[str]:
+    """
+    Split text on blank lines into paragraphs, merging small paragraphs and splitting large ones
+    so each passage is about passage_tokens tokens
+    """
+    paragraphs = [paragraph for paragraph in re.split(r"\n\s*\n", text) if paragraph.strip()]
+    paragraph_tokens = count_tokens_batch(paragraphs)
+
+    passages = []
+    current = []
+    current_tokens = 0
+    for paragraph, tokens in zip(paragraphs, paragraph_tokens):
+        if tokens > passage_tokens:
+            if current:
+                passages.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            paragraph_token_ids = encode(paragraph)
+            passages.extend(
+                decode(paragraph_token_ids[i : i + passage_tokens])
+                for i in range(0, len(paragraph_token_ids), passage_tokens)
+            )
+            continue
+        if current and current_tokens + tokens > passage_tokens:
+            passages.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        passages.append("\n\n".join(current))
+    return passages
+
+
+@functools.lru_cache(maxsize=64)
+def index_file(text: str) -> tuple[str, tuple[Passage, ...]]:
+    """
+    Split one file's contents into its header and indexed passages, cached per file text
+    """
+    header_match = FILE_HEADER.match(text)
+    header = header_match.group(0) if header_match else ""
+    passages = split_passages(text[len(header):])
+    passage_tokens = count_tokens_batch(passages)
+    return header, tuple(
+        Passage(passage, tokens, Counter(tokenize_terms(passage)))
+        for passage, tokens in zip(passages, passage_tokens)
+    )
+
+
+class BM25Index:
+    def __init__(self, passages: list[Passage]):
+        self.passages = passages
+        self.average_length = (
+            sum(sum(passage.terms.values()) for passage in passages) / len(passages) if passages else 0
+        )
+        document_frequency = Counter()
+        for passage in passages:
+            document_frequency.update(passage.terms.keys())
+        n = len(passages)
+        self.idf = {
+            term: math.log(1 + (n - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def score(self, query_terms: list[str], passage: Passage) -> float:
+        length = sum(passage.terms.values())
+        score = 0.0
+        for term in query_terms:
+            frequency = passage.terms.get(term, 0)
+            if not frequency:
+                continue
+            normaliser = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.average_length or 1))
+            score += self.idf[term] * frequency * (BM25_K1 + 1) / (frequency + normaliser)
+        return score
+
+    def search(self, query: str, k: int) -> list[tuple[float, int]]:
+        """
+        Return (score, passage index) for the top k passages with a positive score
+        """
+        query_terms = tokenize_terms(query)
+        scored = [(self.score(query_terms, passage), index) for index, passage in enumerate(self.passages)]
+        scored = [(score, index) for score, index in scored if score > 0]
+        scored.sort(reverse=True)
+        return scored[:k]
+
+
+def select_relevant_passages(
+    query: str,
+    file_contents: list[str],
+    token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+    top_k: int = RETRIEVAL_TOP_K,
+) -> tuple[list[str], str]:
+    """
+    Keep only the passages of each file most relevant to query, within token_budget.
+    Returns the reduced contents of each file (in the original order) and a one line report.
+    """
+    indexed_files = [index_file(contents) for contents in file_contents]
+    passages = [passage for _, file_passages in indexed_files for passage in file_passages]
+
+    index = BM25Index(passages)
+    selected = set()
+    used_tokens = sum(count_tokens(header) for header, _ in indexed_files)
+    for _, passage_index in index.search(query, top_k):
+        tokens = passages[passage_index].tokens
+        if used_tokens + tokens > token_budget:
+            continue
+        selected.add(passage_index)
+        used_tokens += tokens
+
+    if not selected:
+        # Nothing matched the question, so fall back to the start of each document
+        for passage_index, passage in enumerate(passages):
+            if used_tokens + passage.tokens > token_budget:
+                break
+            selected.add(passage_index)
+            used_tokens += passage.tokens
+
+    reduced_contents = []
+    offset = 0
+    for header, file_passages in indexed_files:
+        kept = [
+            passage.text
+            for index, passage in enumerate(file_passages, start=offset)
+            if index in selected
+        ]
+        if kept:
+            reduced_contents.append(header + "\n\n[...]\n\n".join(kept))
+        elif file_passages:
+            reduced_contents.append(header + "[no passages relevant to the question]")
+        else:
+            reduced_contents.append(header)
+        offset += len(file_passages)
+
+    report = (
+        f"Retrieved {len(selected)} of {len(passages)} passages ({used_tokens} tokens, "
+        f"budget {token_budget}) across {len(file_contents)} files"
+    )
+    return reduced_contents, report
@@ -0,0 +1,49 @@
+"""
+Process-wide tokenizer service.
+
+tiktoken encoders are built once per encoding name and shared by every caller
+(budget checks, chunking and logging), and many texts can be counted in one batch
+across TOKENIZER_THREADS threads.
+"""
+
+import functools
+
+import tiktoken
+
+from config import load_environment_variable
+
+DEFAULT_ENCODING = "cl100k_base"
+TOKENIZER_THREADS = int(load_environment_variable("TOKENIZER_THREADS", 4))
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
+def encode(input_text: str, encoding_name: str = DEFAULT_ENCODING) -> list[int]:
+    """
+    Encode text to tokens, treating special token text in user documents as ordinary text
+    """
+    return get_encoding(encoding_name).encode_ordinary(input_text)
+
+
+def decode(tokens: list[int], encoding_name: str = DEFAULT_ENCODING) -> str:
+    return get_encoding(encoding_name).decode(tokens)
+
+
+def count_tokens(input_text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """
+    Count the number of tokens in an input string
+    """
+    return len(encode(input_text, encoding_name))
+
+
+def count_tokens_batch(input_texts: list[str], encoding_name: str = DEFAULT_ENCODING) -> list[int]:
+    """
+    Count the tokens of each input string, encoding them in parallel threads
+    """
+    if len(input_texts) < 2:
+        return [count_tokens(input_text, encoding_name) for input_text in input_texts]
+    encoded = get_encoding(encoding_name).encode_ordinary_batch(input_texts, num_threads=TOKENIZER_THREADS)
+    return [len(tokens) for tokens in encoded]
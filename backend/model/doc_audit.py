@@ -9,6 +9,12 @@ class DocAuditRequest(BaseModel):
     style_guide_file_names: str = ''
     template_name: str = ''
     ai_provider: str = ''
+    # Review all sections at once; responses are tagged with their section and arrive as they finish,
+    # or in section order when ordered is set
+    concurrent: bool = False
+    ordered: bool = False
+    # Skip the LLM response cache and always generate fresh reviews
+    bypass_cache: bool = False
 
     class Config:
         json_schema_extra = {
@@ -18,7 +24,9 @@ class DocAuditRequest(BaseModel):
                 "file_name": "file1.txt", 
                 "style_guide_file_names": "section1.txt,section2.txt",
                 "template_name": "doc_audit",
-                "ai_provider": "scoti"
+                "ai_provider": "scoti",
+                "concurrent": False,
+                "ordered": False
             }
         }
 
@@ -26,6 +34,14 @@ class DocAuditResponse(BaseModel):
     received: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     status: str = ''
     ai_response: str = ''
+    # Set on section responses of a concurrent audit; section_index starts at 1
+    section_index: int = 0
+    section_name: str = ''
+    section_count: int = 0
+    # The response came from the LLM response cache
+    cached: bool = False
+    # The background job running the audit, see /api/jobs
+    job_id: str = ''
 
     class Config:
         json_schema_extra = {
@@ -34,6 +50,14 @@ class DocAuditResponse(BaseModel):
                 "status": "200", 
                 "ai_response": "47 is the meaning of life"
             },
+            "concurrent_section_example": {
+                "received": "2022-01-01T00:00:00",
+                "status": "200", 
+                "ai_response": "47 is the meaning of life",
+                "section_index": 3,
+                "section_name": "referencing-and-attribution_1",
+                "section_count": 14
+            },
             "failure_example": {
                 "received": "2022-01-01T00:00:00",
                 "status": "500", 
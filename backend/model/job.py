@@ -0,0 +1,67 @@
+from typing import Any
+from pydantic import BaseModel
+
+class JobRequest(BaseModel):
+    # "audit" (payload is a DocAuditRequest) or "summarise" (payload is a SummariseRequest)
+    kind: str = ''
+    payload: dict = {}
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "kind": "audit",
+                "payload": {
+                    "userid": "292e5448-b001-70cb-1582-4599f2239de5",
+                    "file_name": "file1.txt",
+                    "style_guide_file_names": "section1.txt,section2.txt",
+                    "template_name": "doc_audit",
+                    "ai_provider": "scoti",
+                    "concurrent": True
+                }
+            }
+        }
+
+class SummariseRequest(BaseModel):
+    userid: str = ''
+    file_names: str = ''
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "userid": "292e5448-b001-70cb-1582-4599f2239de5",
+                "file_names": "file1.txt,file2.txt"
+            }
+        }
+
+class JobResponse(BaseModel):
+    job_id: str = ''
+    kind: str = ''
+    # queued, running, completed or failed
+    status: str = ''
+    attempts: int = 0
+    created: float = 0
+    started: float | None = None
+    finished: float | None = None
+    # Set once the job has completed
+    result: Any = None
+    error: str | None = None
+
+    class Config:
+        json_schema_extra = {
+            "queued_example": {
+                "job_id": "0b5e3a4c-3f0e-4d4c-9d52-1d8f0c1b2a11",
+                "kind": "audit",
+                "status": "queued",
+                "created": 1704067200.0
+            },
+            "completed_example": {
+                "job_id": "0b5e3a4c-3f0e-4d4c-9d52-1d8f0c1b2a11",
+                "kind": "summarise",
+                "status": "completed",
+                "attempts": 1,
+                "created": 1704067200.0,
+                "started": 1704067201.0,
+                "finished": 1704067260.0,
+                "result": {"summary": "47 is the meaning of life", "total_tokens": 1200}
+            }
+        }
@@ -9,6 +9,8 @@ class QueryRequest(BaseModel):
     user_input: str = ''
     template_name: str = ''
     ai_provider: str = ''
+    # Skip the LLM response cache and always generate a fresh answer
+    bypass_cache: bool = False
 
     class Config:
         json_schema_extra = {
@@ -26,6 +28,8 @@ class QueryResponse(BaseModel):
     received: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     status: str = ''
     ai_response: str = ''
+    # The answer came from the LLM response cache
+    cached: bool = False
 
     class Config:
         json_schema_extra = {
@@ -0,0 +1,180 @@
+"""
+Circuit breakers and adaptive timeouts for the LLM backends.
+
+A breaker opens after BREAKER_FAILURE_THRESHOLD consecutive timeouts or errors. While it is open,
+calls to that backend are rejected at once with CircuitOpenError (the router sends them to the
+other backend instead) rather than each one waiting out a full timeout. After
+BREAKER_RECOVERY_SECONDS one trial call is let through: success closes the breaker again, failure
+keeps it open for another period.
+
+Timeouts follow the observed latencies: ADAPTIVE_TIMEOUT_MULTIPLIER times the p99 of recent
+successful calls, kept between ADAPTIVE_TIMEOUT_MIN_SECONDS and the caller's own timeout. A caller
+expecting a slow call, such as a runpod cold start, can raise the minimum for that call.
+
+Streamed responses go through the same breakers with guard_stream.
+"""
+
+import threading
+import time
+from typing import Iterable, Iterator
+
+from config import load_environment_variable, logger
+from service.metrics import metrics, percentile
+
+BREAKER_FAILURE_THRESHOLD = int(load_environment_variable("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RECOVERY_SECONDS = float(load_environment_variable("BREAKER_RECOVERY_SECONDS", 30))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(load_environment_variable("ADAPTIVE_TIMEOUT_MULTIPLIER", 2))
+ADAPTIVE_TIMEOUT_MIN_SECONDS = float(load_environment_variable("ADAPTIVE_TIMEOUT_MIN_SECONDS", 30))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(load_environment_variable("ADAPTIVE_TIMEOUT_MIN_SAMPLES", 20))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        recovery_seconds: float = BREAKER_RECOVERY_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go ahead now; when the breaker is half open only one trial call is allowed
+        """
+        with self._lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.recovery_seconds:
+                self.state = HALF_OPEN
+                logger.info(f"Circuit breaker {self.name} is half open, letting a trial call through")
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+        metrics.increment(f"circuit_breaker.{self.name}.rejected")
+        return False
+
+    def is_open(self) -> bool:
+        """
+        Whether calls are currently being rejected, without using up a half open trial call
+        """
+        with self._lock:
+            return self.state == OPEN and self.clock() - self.opened_at < self.recovery_seconds
+
+    def check(self):
+        """
+        Raise CircuitOpenError unless a call may go ahead now
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable after repeated failures, try again shortly")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"Circuit breaker {self.name} closed")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = self.clock()
+                self.times_opened += 1
+                opened = True
+            else:
+                opened = False
+        if opened:
+            logger.error(f"Circuit breaker {self.name} opened after {self.consecutive_failures} consecutive failures")
+            metrics.increment(f"circuit_breaker.{self.name}.opened")
+
+    def record_cancelled(self):
+        """
+        The call was abandoned (e.g. it lost a hedge), which says nothing about the backend's health
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "seconds_open": round(self.clock() - self.opened_at, 1) if self.state != CLOSED else 0,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def guard_stream(name: str, chunks: Iterable) -> Iterator:
+    """
+    Yield the chunks of a streamed response through the named backend's breaker: CircuitOpenError
+    while it is open, a failure if the stream raises, a success once it completes. A stream the
+    caller closes early is recorded as cancelled.
+    """
+    breaker = get_breaker(name)
+    breaker.check()
+    try:
+        yield from chunks
+    except GeneratorExit:
+        breaker.record_cancelled()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+
+metrics.register_collector("circuit_breakers", breaker_states)
+
+
+def adaptive_timeout(latencies, ceiling: float, floor: float = 0.0) -> float:
+    """
+    Timeout for the next call given recent successful latencies, never above ceiling. floor raises
+    the minimum for this call, e.g. to allow for a cold start the latencies don't reflect.
+    """
+    if len(latencies) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+        return ceiling
+    timeout = ADAPTIVE_TIMEOUT_MULTIPLIER * percentile(latencies, 0.99)
+    return min(ceiling, max(ADAPTIVE_TIMEOUT_MIN_SECONDS, floor, timeout))
@@ -1,33 +1,70 @@
+import time
 from datetime import datetime
+from gpt.context_packer import pack_context
 from gpt.parsing import process_files
-from gpt.prompts import CHAT_PROMPT_WITH_FILES, CHAT_PROMPT_WITHOUT
-from service.runpod_utils import runpod_call
-from service.openai_client import invoke_openai_directly_with_messages
+from gpt.prompts import CHAT_PROMPT_WITH_FILES_TEMPLATE, CHAT_PROMPT_WITHOUT_TEMPLATE
+from service.circuit_breaker import CircuitOpenError, get_breaker
+from service.llm_router import OPENAI, SCOTI, resolve_ai_provider
+from service.metrics import metrics
+from service.runpod_utils import runpod_call, runpod_stream
+from service.runpod_warmer import RunpodBusyError, describe_wait
+from service.openai_client import stream_with_messages
 from config import runpod_credentials_chat, logger
 
-def send_chat_message(messages, rdti_template, additional_context):
+BUSY_MESSAGE = "SCOTi is very busy right now, please try again in a minute"
+
+
+def starting_up_message(expected_wait):
+    return f"SCOTi is starting up and needs {describe_wait(expected_wait)} before it can answer, please try again shortly"
+
+
+def build_chat_messages(messages, rdti_template, additional_context):
+    """
+    additional_context is either the joined file contents or a list with the contents of each file
+    """
+    include_files = bool(additional_context)
+    if include_files:
+        files = [additional_context] if isinstance(additional_context, str) else additional_context
+        history = [{"role": msg["role"], "content": msg["content"]} for msg in messages[:-1]]
+        user_input = messages[-1]["content"]
+        prompt = CHAT_PROMPT_WITH_FILES_TEMPLATE.render(
+            user_input=user_input, rdti_template="", additional_context="")
+        (packed_template, *packed_files), history, report = pack_context(
+            prompt,
+            [("rdti template", rdti_template)]
+            + [(f"file {index}", file) for index, file in enumerate(files, start=1)],
+            history,
+        )
+        logger.info(report.summary())
+        return history + [{
+            "role": "user",
+            "content": CHAT_PROMPT_WITH_FILES_TEMPLATE.render(
+                user_input=user_input,
+                rdti_template=packed_template,
+                additional_context="".join(packed_files))
+            }]
+    messages = [{"role": msg["role"],
+                "content": CHAT_PROMPT_WITHOUT_TEMPLATE.render(user_input=msg["content"])} if msg["role"] == "user" else {"role": msg["role"], "content": msg["content"]} for msg in messages]
+    _, messages, report = pack_context("", [], messages)
+    logger.info(report.summary())
+    return messages
+
+
+def send_chat_message(messages, rdti_template, additional_context, use_cache=True):
+    """
+    additional_context is either the joined file contents or a list with the contents of each file
+    """
     if messages:
-        include_files = bool(additional_context)
-        if include_files:
-            messages = [{
-                "role": msg["role"],
-                "content": CHAT_PROMPT_WITH_FILES.replace("<user-input>", msg["content"])
-                } if msg["role"] == "user" 
-                else {
-                    "role": msg["role"], 
-                    "content": msg["content"]
-                } for msg in messages]
-            messages[-1]["content"] = messages[-1]["content"].replace(
-                "<rdti-template>", rdti_template).replace("<additional-context>", additional_context)
-        else:
-            messages = [{"role": msg["role"],
-                        "content": CHAT_PROMPT_WITHOUT.replace("<user-input>", msg["content"])} if msg["role"] == "user" else {"role": msg["role"], "content": msg["content"]} for msg in messages]
-        # messages.pop(0)
-        while len(str(messages)) > 240000:
-            messages.pop(0)
+        messages = build_chat_messages(messages, rdti_template, additional_context)
         start = datetime.now()
         try:
-            runpod_response = runpod_call(messages=messages, **runpod_credentials_chat)
+            runpod_response = runpod_call(messages=messages, use_cache=use_cache, **runpod_credentials_chat)
+        except CircuitOpenError as e:
+            logger.error(f"Not calling the model: {e}")
+            runpod_response = BUSY_MESSAGE
+        except RunpodBusyError as e:
+            logger.error(f"Not calling the model: {e}")
+            runpod_response = starting_up_message(e.expected_wait)
         except TimeoutError:
             logger.error("Timeout error calling runpod")
             runpod_response = "Argh!!! I took too long to respond. please try again"
@@ -36,4 +73,51 @@ def send_chat_message(messages, rdti_template, additional_context):
             runpod_response = "#@!# oops, something went wrong, please try again"
         end = datetime.now()
         logger.info(f"Got a {len(runpod_response)} character response. Call took {end-start}")
-        return runpod_response
\ No newline at end of file
+        return runpod_response
+
+
+def stream_chat_message(messages, rdti_template, additional_context, ai_provider='scoti', use_cache=True):
+    """
+    Same as send_chat_message, but returns (iterator over the response text as the model generates it,
+    whether the response came from the response cache).
+    Time to first token of uncached responses is recorded in metrics as <ai_provider>.ttft_seconds.
+    """
+    messages = build_chat_messages(messages, rdti_template, additional_context)
+    provider = resolve_ai_provider(ai_provider)
+    start = time.monotonic()
+    if provider == SCOTI and get_breaker("runpod").is_open():
+        logger.warning("The runpod circuit breaker is open, streaming from OpenAI instead")
+        metrics.increment("router.failovers")
+        provider = OPENAI
+    if provider == SCOTI:
+        tokens, cached = runpod_stream(messages=messages, use_cache=use_cache, **runpod_credentials_chat)
+    else:
+        tokens, cached = stream_with_messages(messages, use_cache=use_cache)
+
+    def generate():
+        length = 0
+        try:
+            for token in tokens:
+                if not token:
+                    continue
+                if not length and not cached:
+                    metrics.observe(f"{provider}.ttft_seconds", time.monotonic() - start)
+                length += len(token)
+                yield token
+        except CircuitOpenError as e:
+            logger.error(f"Not calling the model: {e}")
+            yield BUSY_MESSAGE
+        except RunpodBusyError as e:
+            logger.error(f"Not calling the model: {e}")
+            yield starting_up_message(e.expected_wait)
+        except TimeoutError:
+            logger.error(f"Timeout error streaming from {provider}")
+            yield "Argh!!! I took too long to respond. please try again"
+        except Exception as e:
+            logger.error("Houston, we have a %s major problem", exc_info=True)
+            yield "#@!# oops, something went wrong, please try again"
+        finally:
+            tokens.close()
+        logger.info(f"Streamed a {length} character response{' from the cache' if cached else ''}. Call took {time.monotonic() - start:.2f}s")
+
+    return generate(), cached
@@ -1,10 +1,31 @@
+import asyncio
 import os
+import functools
+from collections import Counter
 from datetime import datetime
+from typing import NamedTuple
+from gpt.context_packer import pack_context
+from gpt.retrieval import BM25Index, Passage, tokenize_terms
 from gpt.parsing import DocumentParser, process_files
-from gpt.prompts import CHAT_PROMPT_WITH_FILES, CHAT_PROMPT_WITHOUT, DOC_AUDIT_PROMPT_WITH_FILES
-from service.runpod_utils import runpod_call
-from service.openai_client import invoke_openai_directly_with_messages
-from config import runpod_credentials_chat, logger
+from gpt.prompts import DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE
+from service.circuit_breaker import CircuitOpenError
+from service.doc_analyst import BUSY_MESSAGE, starting_up_message
+from service.llm_router import SCOTI, resolve_ai_provider
+from service.runpod_async import iterate_in_loop, run_in_loop
+from service.runpod_utils import arunpod_complete
+from service.runpod_warmer import RunpodBusyError
+from service.openai_client import acomplete_with_messages_cached
+from config import load_environment_variable, runpod_credentials_chat, logger
+
+# Sections scoring below this fraction of the best section's score are low relevance
+STYLE_GUIDE_MIN_SCORE = float(load_environment_variable("STYLE_GUIDE_MIN_SCORE", 0.2))
+# Always review at least this many of the most relevant sections
+STYLE_GUIDE_MIN_SECTIONS = int(load_environment_variable("STYLE_GUIDE_MIN_SECTIONS", 3))
+# "skip" drops low relevance sections, "batch" reviews them together in one final call
+STYLE_GUIDE_LOW_RELEVANCE = load_environment_variable("STYLE_GUIDE_LOW_RELEVANCE", "skip")
+STYLE_GUIDE_QUERY_TERMS = 200
+# Maximum number of sections reviewed at the same time by send_audit_message_concurrently
+AUDIT_CONCURRENCY = int(load_environment_variable("AUDIT_CONCURRENCY", 14))
 
 all_style_guides = """
 accessible-and-inclusive-content_1, 
@@ -25,22 +46,85 @@ grammar-punctuation-and-conventions_5
 
 
 
-def get_style_guides(style_guides_filter):
+def get_style_guide_names(style_guides_filter):
     if style_guides_filter is None or len(style_guides_filter) == 0:
         style_guides_filter = all_style_guides
-    style_guide_names = [
-        "data/input/" + style_guide + ".pdf"
-        for style_guide in style_guides_filter.split(", ")
-    ]
+    return [style_guide.strip() for style_guide in style_guides_filter.split(", ")]
+
+
+@functools.lru_cache(maxsize=None)
+def load_style_guide(style_guide_name):
+    """
+    Load the text of one bundled style guide section, once per process
+    """
+    file_path = "data/input/" + style_guide_name + ".pdf"
+    logger.info("Loading style guide %s from %s", file_path, os.getcwd())
+    return DocumentParser().load_pdf(file_path=file_path)
+
+
+def get_style_guides(style_guides_filter):
+    """
+    Load the style guide text for each name in the filter.
+    A name of the form "a+b+c" is a batch of sections reviewed together in one call.
+    """
+    style_guide_names = get_style_guide_names(style_guides_filter)
     logger.info("style guides: %s", style_guide_names)
-    parser = DocumentParser()
-    # log current working directory
-    cwd = os.getcwd()
-    logger.info("Current working directory: %s", cwd)
-    style_guides = [parser.load_pdf(file_path=file_path) for file_path in style_guide_names]
+    style_guides = [
+        "\n\n".join(load_style_guide(part) for part in style_guide_name.split("+"))
+        for style_guide_name in style_guide_names
+    ]
     return style_guides
 
 
+@functools.lru_cache(maxsize=8)
+def get_style_guide_index(style_guide_names):
+    """
+    BM25 index over the given style guide sections, one passage per section
+    """
+    return BM25Index([
+        Passage(style_guide, 0, Counter(tokenize_terms(style_guide)))
+        for style_guide in (load_style_guide(name) for name in style_guide_names)
+    ])
+
+
+def select_style_guides(style_guides_filter, additional_context):
+    """
+    Score each style guide section against the user document and split them into the sections
+    worth a review call and the low relevance ones. Depending on STYLE_GUIDE_LOW_RELEVANCE, the
+    low relevance sections are either skipped, or batched into a single extra review call.
+    Sections the user chose are all reviewed; selection only applies when they chose none, and
+    keeps every section when none of them scores at all.
+
+    Returns (filter of the sections to review, names of the sections skipped or batched)
+    """
+    if style_guides_filter:
+        return style_guides_filter, []
+    style_guide_names = get_style_guide_names(style_guides_filter)
+    document = additional_context if isinstance(additional_context, str) else "".join(additional_context)
+    document_terms = [term for term, _ in Counter(tokenize_terms(document)).most_common(STYLE_GUIDE_QUERY_TERMS)]
+
+    index = get_style_guide_index(tuple(style_guide_names))
+    scores = [index.score(document_terms, passage) for passage in index.passages]
+    if not any(scores):
+        logger.info("No style guide section matches the document, reviewing them all")
+        return ", ".join(style_guide_names), []
+    best_score = max(scores)
+    ranked = sorted(range(len(style_guide_names)), key=lambda i: scores[i], reverse=True)
+    keep = set(ranked[:STYLE_GUIDE_MIN_SECTIONS]) | {
+        i for i, score in enumerate(scores) if score / best_score >= STYLE_GUIDE_MIN_SCORE
+    }
+
+    selected = [name for i, name in enumerate(style_guide_names) if i in keep]
+    low_relevance = [name for i, name in enumerate(style_guide_names) if i not in keep]
+    logger.info(
+        "Style guide relevance: %s",
+        ", ".join(f"{name} {score / best_score:.2f}" for name, score in zip(style_guide_names, scores)),
+    )
+    if low_relevance and STYLE_GUIDE_LOW_RELEVANCE == "batch":
+        selected.append("+".join(low_relevance))
+    return ", ".join(selected), low_relevance
+
+
 # def send_chat_message(messages,previous_recommendations,additional_context,message_history,**runpod_credentials):
 #     st.session_state.session_history += "\n\nUser : " + messages[-1]["content"] + "\n\n"
 #     if "cancel" in st.session_state:
@@ -127,75 +211,134 @@ def get_style_guides(style_guides_filter):
 #         return runpod_response
 
 
-def send_audit_message(style_guides_filter, additional_context, ai_provider='scoti'):
+def build_audit_messages(index, style_guide_names, style_guide, file_sections, history):
+    """
+    Messages asking for a review of the files against style guide section index (1-based)
+    """
+    ask_for_review = f"Please review my doc against style guide section [{index} of {len(style_guide_names)}] {style_guide_names[index-1]}"
+    logger.info(f"Sending message to SCOTi with style guide {index} {style_guide_names[index-1]}")
+    prompt = DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE.render(
+        user_input=ask_for_review, rdti_template="", additional_context=""
+    )
+    (packed_style_guide, *packed_files), packed_history, report = pack_context(
+        prompt, [(f"style guide {index}", style_guide)] + file_sections, history
+    )
+    logger.info(report.summary())
+    return packed_history + [
+        {
+            "role": "user",
+            "content": DOC_AUDIT_PROMPT_WITH_FILES_TEMPLATE.render(
+                user_input=ask_for_review,
+                rdti_template=packed_style_guide,
+                additional_context="".join(packed_files),
+            ),
+        }
+    ]
+
+
+class AuditResult(NamedTuple):
+    section_index: int
+    section_name: str
+    response: str
+    cached: bool
+
+
+async def acall_audit_model(messages, ai_provider='scoti', use_cache=True):
+    """
+    Returns (response, whether it came from the response cache)
+    """
+    start = datetime.now()
+    cached = False
+    try:
+        if resolve_ai_provider(ai_provider) == SCOTI:
+            ai_response, cached = await arunpod_complete(messages=messages, use_cache=use_cache, **runpod_credentials_chat)
+        else:
+            ai_response, cached = await acomplete_with_messages_cached(messages, use_cache=use_cache)
+    except CircuitOpenError as e:
+        logger.error(f"Not calling the model: {e}")
+        ai_response = BUSY_MESSAGE
+    except RunpodBusyError as e:
+        logger.error(f"Not calling the model: {e}")
+        ai_response = starting_up_message(e.expected_wait)
+    except TimeoutError as e:
+        logger.error("Timeout error calling runpod")
+        ai_response = "Argh!!! I took too long to respond. please try again"
+    except Exception as e:
+        logger.error("Houston, we have a %s", "major problem", exc_info=True)
+        ai_response = "#@!# oops, something went wrong, please try again"
+    end = datetime.now()
+    logger.info(f"Got a {len(ai_response)} character response{' from the cache' if cached else ''}. Call took {end-start}")
+    return ai_response, cached
+
+
+def call_audit_model(messages, ai_provider='scoti', use_cache=True):
+    """
+    Returns (response, whether it came from the response cache)
+    """
+    return run_in_loop(acall_audit_model(messages, ai_provider, use_cache))
+
+
+def _audit_files(additional_context):
+    files = [additional_context] if isinstance(additional_context, str) else additional_context
+    return [(f"file {index}", file) for index, file in enumerate(files, start=1)]
+
+
+def send_audit_message(style_guides_filter, additional_context, ai_provider='scoti', use_cache=True):
+    """
+    Review the document against each style guide section in turn, yielding an AuditResult per section.
+    additional_context is either the joined file contents or a list with the contents of each file.
+    """
+    style_guide_names = get_style_guide_names(style_guides_filter)
     style_guides = get_style_guides(style_guides_filter)
-    messages = []
+    file_sections = _audit_files(additional_context)
+    history = []
     for i, style_guide in enumerate(style_guides, start=1):
-        ask_for_review = f"Please review my doc against style guide section [{i} of {len(style_guides)}] {style_guides_filter[i-1]}"
-        messages.append({"role": "user","content": ask_for_review,})
-        logger.info(f"Sending message to SCOTi with style guide {i} {style_guide.split(maxsplit=1)[0]}")
-        messages = [
-            (
-                {
-                    "role": msg["role"],
-                    "user-input": msg["content"],
-                    "content": DOC_AUDIT_PROMPT_WITH_FILES.replace(
-                        "<user-input>", msg["content"]
-                    ),
-                } if msg["role"] == "user"
-                else {
-                    "role": msg["role"],
-                    "content": msg["content"],
-                }
-            )
-            for msg in messages
+        messages = build_audit_messages(i, style_guide_names, style_guide, file_sections, history)
+        ai_response, cached = call_audit_model(messages, ai_provider, use_cache)
+        # Only the previous section's review is carried forward as history
+        history = [
+            {
+                "role": "assistant",
+                "content": ai_response,
+            }
         ]
-        messages[-1]["content"] = (
-            messages[-1]["content"]
-            .replace("<rdti-template>", style_guide)
-            .replace("<additional-context>", additional_context)
-        )
-
-        while len(messages) > 2:
-            messages.pop(0)
-        logger.info("Message length: %s", len(str(messages)))
-        while len(str(messages)) > 240000:
-            logger.info("oops - that message is too big, dropping the message: %s",len(str(messages)),)
-            messages.pop(0)
-        start = datetime.now()
+        yield AuditResult(i, style_guide_names[i-1], ai_response, cached)
+
+
+def send_audit_message_concurrently(
+    style_guides_filter, additional_context, ai_provider='scoti', ordered=False, max_concurrency=None, use_cache=True
+):
+    """
+    Review the document against all style guide sections at once, at most max_concurrency
+    (AUDIT_CONCURRENCY) calls at a time, yielding an AuditResult as each section finishes, or in
+    section order if ordered is set. Sections are reviewed independently, without the previous
+    section's review as history. The calls all run on the runpod event loop, so no thread waits on them.
+    """
+    style_guide_names = get_style_guide_names(style_guides_filter)
+    style_guides = get_style_guides(style_guides_filter)
+    file_sections = _audit_files(additional_context)
+    section_messages = [
+        build_audit_messages(index, style_guide_names, style_guide, file_sections, [])
+        for index, style_guide in enumerate(style_guides, start=1)
+    ]
+
+    async def review_sections():
+        semaphore = asyncio.Semaphore(max_concurrency or AUDIT_CONCURRENCY)
+
+        async def review(index, messages):
+            async with semaphore:
+                return AuditResult(index, style_guide_names[index - 1], *await acall_audit_model(messages, ai_provider, use_cache))
+
+        reviews = [asyncio.ensure_future(review(index, messages)) for index, messages in enumerate(section_messages, start=1)]
+        sections = asyncio.gather(*reviews)
         try:
-            if ai_provider == 'scoti':
-                ai_response = runpod_call(messages=messages, **runpod_credentials_chat)
-            else:
-                ai_response = invoke_openai_directly_with_messages(messages)
-        except TimeoutError as e:
-            logger.error("Timeout error calling runpod")
-            ai_response = "Argh!!! I took too long to respond. please try again"
-        except Exception as e:
-            logger.error("Houston, we have a %s", "major problem", exc_info=True)
-            ai_response = "#@!# oops, something went wrong, please try again"
-        end = datetime.now()
-        logger.info(f"Got a {len(ai_response)} character response. Call took {end-start}")
-        if i < len(style_guides):
-            logger.info("after interim AI call")
-            logger.info("AI response added to state")
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": ai_response,
-                }
-            )
-            yield ai_response
-            logger.info(f"index is {i} style_guides length is {len(style_guides)}")
-            logger.info(f"style guide {i} is {style_guides[i][:100]}")
-        else:
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": ai_response,
-                }
-            )
-            yield ai_response
+            for review in reviews if ordered else asyncio.as_completed(reviews):
+                yield await review
+        finally:
+            # The client went away, so stop the sections still running or waiting for a slot
+            sections.cancel()
+
+    yield from iterate_in_loop(review_sections())
 
 
 # def get_updated_document():
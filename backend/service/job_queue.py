@@ -0,0 +1,377 @@
+"""
+A durable queue of background jobs, such as audits and summarisation, kept in SQLite.
+
+A job is submitted with a kind and a JSON payload. It is then run by a JobWorkerPool in a separate
+worker process (python -m service.jobs, the portal-jobs container in template.yml), so web
+requests no longer wait on the GPU. JOB_WORKERS_IN_PROCESS=True runs the workers in the web
+process instead, e.g. for local development. The handler registered for the job's kind reports
+progress through emit(). Its events are stored with the job, so the user who submitted it can
+poll, stream or fetch the result by job id, and can reconnect at any time.
+
+Jobs live in JOB_QUEUE_PATH and survive restarts; in template.yml that is an EFS volume, so they
+also outlive the ECS task. A worker holds a lease on each running job and renews it every few
+seconds. If the worker dies, the lease expires after JOB_LEASE_SECONDS and the job is run again,
+at most JOB_MAX_ATTEMPTS times; the events of the abandoned attempt are deleted then, so followers
+see each section once. Event ids keep increasing across attempts. Finished jobs are deleted after
+JOB_RETENTION_SECONDS.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple, Optional
+
+from config import load_environment_variable, logger
+from service.metrics import metrics
+
+JOB_QUEUE_PATH = load_environment_variable("JOB_QUEUE_PATH", "data/jobs/jobs.sqlite3")
+# WAL, or DELETE when JOB_QUEUE_PATH is on a network file system (the EFS volume in template.yml)
+JOB_QUEUE_JOURNAL_MODE = load_environment_variable("JOB_QUEUE_JOURNAL_MODE", "WAL")
+JOB_WORKERS = int(load_environment_variable("JOB_WORKERS", 4))
+JOB_WORKERS_IN_PROCESS = load_environment_variable("JOB_WORKERS_IN_PROCESS", "False") == "True"
+JOB_POLL_SECONDS = float(load_environment_variable("JOB_POLL_SECONDS", 1))
+JOB_LEASE_SECONDS = float(load_environment_variable("JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(load_environment_variable("JOB_MAX_ATTEMPTS", 3))
+JOB_RETENTION_SECONDS = float(load_environment_variable("JOB_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATES = {COMPLETED, FAILED}
+
+
+class Job(NamedTuple):
+    id: str
+    kind: str
+    payload: dict
+    status: str
+    attempts: int
+    created: float
+    started: Optional[float]
+    finished: Optional[float]
+    result: object
+    error: Optional[str]
+    # The userid that submitted the job; only they can see it
+    owner: str
+
+    @classmethod
+    def from_row(cls, row) -> "Job":
+        id, kind, payload, status, attempts, created, started, finished, result, error, owner = row
+        return cls(
+            id, kind, json.loads(payload), status, attempts, created, started, finished,
+            json.loads(result) if result is not None else None, error, owner,
+        )
+
+
+class JobEvent(NamedTuple):
+    job_id: str
+    sequence: int
+    event: dict
+
+
+_JOB_COLUMNS = "id, kind, payload, status, attempts, created, started, finished, result, error, owner"
+
+_handlers = {}
+
+
+def register_handler(kind: str, handler: Callable[[dict, Callable[[dict], None]], object]):
+    """
+    Run jobs of this kind with handler(payload, emit), whose return value (JSON serialisable) is
+    the job's result. emit(event) records a progress event for the job's subscribers.
+    """
+    _handlers[kind] = handler
+
+
+def job_kinds() -> list[str]:
+    return sorted(_handlers)
+
+
+class JobQueue:
+    def __init__(self, path: str = JOB_QUEUE_PATH, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._connection:
+            if path != ":memory:":
+                self._connection.execute(f"PRAGMA journal_mode={JOB_QUEUE_JOURNAL_MODE}")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, started REAL, finished REAL, "
+                "result TEXT, error TEXT, lease_id TEXT, lease_until REAL, event_sequence INTEGER NOT NULL DEFAULT 0, "
+                "dedupe_key TEXT, owner TEXT NOT NULL DEFAULT '')"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe_key ON jobs (dedupe_key)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                "job_id TEXT NOT NULL, sequence INTEGER NOT NULL, event TEXT NOT NULL, PRIMARY KEY (job_id, sequence))"
+            )
+
+    def submit(self, kind: str, payload: dict, owner: str = "", dedupe_key: str = None) -> str:
+        """
+        Queue a job for the userid owner and return its id. dedupe_key identifies identical jobs for find_active.
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {', '.join(job_kinds())}")
+        with self._lock, self._connection:
+            job_id = self._insert(kind, payload, owner, dedupe_key)
+        self._submitted(kind, job_id)
+        return job_id
+
+    def submit_unless_active(self, kind: str, payload: dict, owner: str, dedupe_key: str) -> tuple[str, bool]:
+        """
+        Returns (id of the queued or running job with this dedupe_key, False) if there is one, otherwise
+        (id of a newly queued job, True). The check and the insert are one transaction, which other
+        processes using the queue wait for, so identical requests arriving together start one job.
+        """
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {', '.join(job_kinds())}")
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            job_id = self._find_active(dedupe_key)
+            if job_id:
+                return job_id, False
+            job_id = self._insert(kind, payload, owner, dedupe_key)
+        self._submitted(kind, job_id)
+        return job_id, True
+
+    def _insert(self, kind: str, payload: dict, owner: str, dedupe_key: Optional[str]) -> str:
+        """
+        Insert a queued job and delete expired ones, inside the caller's transaction
+        """
+        job_id = str(uuid.uuid4())
+        now = self.clock()
+        self._connection.execute(
+            "INSERT INTO jobs (id, kind, payload, status, created, dedupe_key, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), QUEUED, now, dedupe_key, owner),
+        )
+        expired = [row[0] for row in self._connection.execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND finished < ?",
+            (COMPLETED, FAILED, now - JOB_RETENTION_SECONDS),
+        )]
+        self._connection.executemany("DELETE FROM job_events WHERE job_id = ?", [(id,) for id in expired])
+        self._connection.executemany("DELETE FROM jobs WHERE id = ?", [(id,) for id in expired])
+        return job_id
+
+    @staticmethod
+    def _submitted(kind: str, job_id: str):
+        metrics.increment(f"jobs.{kind}.submitted")
+        logger.info(f"Queued {kind} job {job_id}")
+
+    def find_active(self, dedupe_key: str) -> Optional[str]:
+        """
+        The id of a queued or running job submitted with this dedupe_key, if there is one
+        """
+        with self._lock:
+            return self._find_active(dedupe_key)
+
+    def _find_active(self, dedupe_key: str) -> Optional[str]:
+        row = self._connection.execute(
+            "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN (?, ?) ORDER BY created DESC LIMIT 1",
+            (dedupe_key, QUEUED, RUNNING),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get(self, job_id: str, owner: str = None) -> Optional[Job]:
+        """
+        The job, or None if there is none with this id or, when owner is given, it belongs to someone else
+        """
+        with self._lock:
+            row = self._connection.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        job = Job.from_row(row) if row else None
+        if job is None or (owner is not None and job.owner != owner):
+            return None
+        return job
+
+    def events(self, job_id: str, after: int = 0) -> list[JobEvent]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT sequence, event FROM job_events WHERE job_id = ? AND sequence > ? ORDER BY sequence",
+                (job_id, after),
+            ).fetchall()
+        return [JobEvent(job_id, sequence, json.loads(event)) for sequence, event in rows]
+
+    def follow(self, job_id: str, after: int = 0) -> Iterator[JobEvent]:
+        """
+        Yield the job's events after sequence number after, waiting for new ones until it finishes
+        """
+        while True:
+            job = self.get(job_id)
+            for event in self.events(job_id, after):
+                after = event.sequence
+                yield event
+            if job is None or job.status in FINISHED_STATES:
+                # Events emitted between reading the job and its events were yielded above
+                return
+            time.sleep(JOB_POLL_SECONDS)
+
+    def claim(self, lease_id: str) -> Optional[Job]:
+        """
+        Lease the oldest queued job, or a running one whose worker has stopped renewing its lease
+        """
+        now = self.clock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, started = ?, lease_id = ?, lease_until = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+                "ORDER BY created LIMIT 1)",
+                (RUNNING, now, lease_id, now + JOB_LEASE_SECONDS, QUEUED, RUNNING, now),
+            )
+            row = self._connection.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE lease_id = ? AND status = ?", (lease_id, RUNNING)
+            ).fetchone()
+            if row:
+                # Drop what an abandoned earlier attempt emitted, the new attempt emits it all again
+                self._connection.execute("DELETE FROM job_events WHERE job_id = ?", (row[0],))
+        return Job.from_row(row) if row else None
+
+    def renew(self, lease_ids: list[str]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE lease_id = ? AND status = ?",
+                [(self.clock() + JOB_LEASE_SECONDS, lease_id, RUNNING) for lease_id in lease_ids],
+            )
+
+    def emit(self, job_id: str, lease_id: str, event: dict) -> bool:
+        """
+        Record an event of a leased job; False, and nothing is recorded, if the lease was lost to another worker
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET event_sequence = event_sequence + 1 WHERE id = ? AND lease_id = ?", (job_id, lease_id)
+            )
+            if cursor.rowcount != 1:
+                return False
+            self._connection.execute(
+                "INSERT INTO job_events (job_id, sequence, event) SELECT id, event_sequence, ? FROM jobs WHERE id = ?",
+                (json.dumps(event), job_id),
+            )
+        return True
+
+    def finish(self, job_id: str, lease_id: str, result: object = None, error: str = None) -> bool:
+        """
+        Record the outcome of a leased job; False if the lease was lost to another worker
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, result = ?, error = ?, lease_id = NULL, lease_until = NULL "
+                "WHERE id = ? AND lease_id = ?",
+                (FAILED if error else COMPLETED, self.clock(), json.dumps(result), error, job_id, lease_id),
+            )
+        return cursor.rowcount == 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._connection.execute(
+                "SELECT MIN(created) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+        return {
+            **{status: counts.get(status, 0) for status in (QUEUED, RUNNING, COMPLETED, FAILED)},
+            "oldest_queued_seconds": round(self.clock() - oldest, 1) if oldest else 0,
+        }
+
+
+class JobWorkerPool:
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS):
+        self.queue = queue
+        self.workers = workers
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Start the worker threads and the lease renewing thread, once
+        """
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [
+                threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+                for index in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._renew_leases, name="job-lease-renewer", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Started {self.workers} job workers on {self.queue.path}")
+
+    def stop(self):
+        self._stopping.set()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            lease_id = str(uuid.uuid4())
+            try:
+                job = self.queue.claim(lease_id)
+            except sqlite3.Error:
+                logger.error("Could not claim a job", exc_info=True)
+                job = None
+            if job is None:
+                self._stopping.wait(JOB_POLL_SECONDS)
+                continue
+            with self._lock:
+                self._leases[lease_id] = job.id
+            try:
+                self._run(job, lease_id)
+            finally:
+                with self._lock:
+                    del self._leases[lease_id]
+
+    def _run(self, job: Job, lease_id: str):
+        metrics.observe("jobs.queue_seconds", job.started - job.created)
+        if job.attempts > JOB_MAX_ATTEMPTS:
+            logger.error(f"Giving up on {job.kind} job {job.id} after {JOB_MAX_ATTEMPTS} attempts")
+            self.queue.finish(job.id, lease_id, error=f"Gave up after {JOB_MAX_ATTEMPTS} attempts")
+            metrics.increment(f"jobs.{job.kind}.failed")
+            return
+        if job.attempts > 1:
+            logger.warning(f"Running {job.kind} job {job.id} again (attempt {job.attempts}), its worker stopped")
+            metrics.increment(f"jobs.{job.kind}.retried")
+            self.queue.emit(job.id, lease_id, {
+                "status": "100",
+                "ai_response": "Starting again after the server running this was restarted, earlier results are replaced"
+            })
+
+        logger.info(f"Running {job.kind} job {job.id}")
+        start = time.monotonic()
+        try:
+            result = _handlers[job.kind](job.payload, lambda event: self.queue.emit(job.id, lease_id, event))
+        except Exception as e:
+            logger.error(f"{job.kind} job {job.id} failed", exc_info=True)
+            self.queue.finish(job.id, lease_id, error=f"{type(e).__name__}: {e}")
+            metrics.increment(f"jobs.{job.kind}.failed")
+            return
+        if self.queue.finish(job.id, lease_id, result=result):
+            metrics.increment(f"jobs.{job.kind}.completed")
+        else:
+            logger.warning(f"Lost the lease on {job.kind} job {job.id}, another worker has taken it over")
+        metrics.observe(f"jobs.{job.kind}.run_seconds", time.monotonic() - start)
+
+    def _renew_leases(self):
+        while not self._stopping.wait(JOB_LEASE_SECONDS / 4):
+            with self._lock:
+                lease_ids = list(self._leases)
+            if lease_ids:
+                try:
+                    self.queue.renew(lease_ids)
+                except sqlite3.Error:
+                    logger.error("Could not renew job leases", exc_info=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "busy": len(self._leases)}
+
+
+job_queue = JobQueue()
+job_workers = JobWorkerPool(job_queue)
+metrics.register_collector("job_queue", lambda: {**job_queue.stats(), **job_workers.stats()})
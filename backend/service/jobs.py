@@ -0,0 +1,124 @@
+"""
+The audit and summarisation pipelines, and the job queue handlers that run them in the background.
+
+`python -m service.jobs` runs the job workers (the portal-jobs container); set JOB_WORKERS_IN_PROCESS
+to True to run them in the web process instead.
+"""
+
+import threading
+from typing import Iterator
+
+from config import logger, runpod_credentials_chat
+from gpt.parsing import process_files
+from model.doc_audit import DocAuditRequest, DocAuditResponse
+from model.job import SummariseRequest
+from service.doc_audit import (
+    STYLE_GUIDE_LOW_RELEVANCE,
+    get_style_guide_names,
+    select_style_guides,
+    send_audit_message,
+    send_audit_message_concurrently,
+)
+from service.job_queue import job_queue, job_workers, register_handler
+from service.runpod_warmer import runpod_wait_message
+from service.s3_client import fetch_uploaded_files
+
+
+def audit_responses(doc_audit_request: DocAuditRequest) -> Iterator[DocAuditResponse]:
+    """
+    Run an audit, yielding status 100 progress responses and a status 200 response per section
+    """
+    logger.info(f"AI Doc Audit: userid: {doc_audit_request.userid}, file_name: {doc_audit_request.file_name}, template_name: {doc_audit_request.template_name}, style_guide_file_names: {doc_audit_request.style_guide_file_names}")
+    uploaded_files = fetch_uploaded_files(doc_audit_request.userid, doc_audit_request.file_name)
+
+    logger.debug(f"First 50 chars of first 5 file contents: {[f.read(50) for f in uploaded_files[:5]]}")
+    file_contents, rimon_template_contents, total_tokens = process_files(uploaded_files, as_list=True)
+    logger.info(f"Total tokens: {total_tokens}")
+
+    if total_tokens > 60000:
+        logger.warning(f"Total tokens exceed 60000, likely failure ahead. Total tokens: {total_tokens}")
+
+    yield DocAuditResponse(
+        status='100',
+        ai_response=f"{doc_audit_request.ai_provider} starting"
+    )
+
+    wait_message = runpod_wait_message(doc_audit_request.ai_provider)
+    if wait_message:
+        yield DocAuditResponse(status='100', ai_response=wait_message)
+
+    style_guides_filter, low_relevance_style_guides = select_style_guides(
+        doc_audit_request.style_guide_file_names, file_contents)
+    if low_relevance_style_guides:
+        action = "Reviewing together" if STYLE_GUIDE_LOW_RELEVANCE == "batch" else "Skipping"
+        yield DocAuditResponse(
+            status='100',
+            ai_response=f"{action} style guide sections with little relevance to this document: {', '.join(low_relevance_style_guides)}"
+        )
+
+    use_cache = not doc_audit_request.bypass_cache
+    if doc_audit_request.concurrent:
+        response = send_audit_message_concurrently(
+            style_guides_filter=style_guides_filter,
+            additional_context=file_contents,
+            ai_provider=doc_audit_request.ai_provider,
+            ordered=doc_audit_request.ordered,
+            use_cache=use_cache)
+    else:
+        response = send_audit_message(
+            style_guides_filter=style_guides_filter,
+            additional_context=file_contents,
+            ai_provider=doc_audit_request.ai_provider,
+            use_cache=use_cache)
+    section_count = len(get_style_guide_names(style_guides_filter))
+    cached_sections = 0
+    for result in response:
+        cached_sections += result.cached
+        yield DocAuditResponse(
+            status='200',
+            ai_response=result.response,
+            section_index=result.section_index,
+            section_name=result.section_name,
+            section_count=section_count,
+            cached=result.cached
+        )
+
+    if cached_sections:
+        yield DocAuditResponse(
+            status='100',
+            ai_response=f"{cached_sections} of {section_count} sections were answered from the cache of identical earlier audits",
+            cached=True
+        )
+
+
+def run_audit_job(payload: dict, emit) -> dict:
+    """
+    Every response is emitted as it is produced; the result has the section responses in section order
+    """
+    sections = []
+    for doc_audit_response in audit_responses(DocAuditRequest(**payload)):
+        emit(doc_audit_response.model_dump())
+        if doc_audit_response.status == '200':
+            sections.append(doc_audit_response.model_dump())
+    return {"sections": sorted(sections, key=lambda section: section["section_index"])}
+
+
+def run_summarise_job(payload: dict, emit) -> dict:
+    summarise_request = SummariseRequest(**payload)
+    logger.info(f"Summarise: userid: {summarise_request.userid}, file_names: {summarise_request.file_names}")
+    uploaded_files = fetch_uploaded_files(summarise_request.userid, summarise_request.file_names)
+    emit(DocAuditResponse(status='100', ai_response=f"Summarising {len(uploaded_files)} files").model_dump())
+    # Whole files, however long: the summary is built from windows over all of the text
+    summary, rimon_template_contents, total_tokens = process_files(
+        uploaded_files, summarize=True, token_budget=0, **runpod_credentials_chat)
+    return {"summary": summary, "total_tokens": total_tokens}
+
+
+register_handler("audit", run_audit_job)
+register_handler("summarise", run_summarise_job)
+
+
+if __name__ == '__main__':
+    job_workers.start()
+    logger.info(f"Job worker process running, queue at {job_queue.path}")
+    threading.Event().wait()
@@ -0,0 +1,233 @@
+"""
+Latency-aware routing between a primary and a secondary LLM backend (runpod and OpenAI).
+
+Each backend's latency is tracked over the last ROUTER_LATENCY_WINDOW successful calls. When the
+primary has not answered by its own p95 latency, a hedged request is sent to the secondary, the
+first usable answer wins and the other request is cancelled. If the primary fails outright, or
+its circuit breaker is open, the request fails over to the secondary. Each call's timeout adapts
+to its backend's recent latencies (see service.circuit_breaker).
+
+Hedges are paid for out of a budget so the cost stays bounded: every primary request earns
+HEDGE_BUDGET_RATIO of a hedge (saved up to HEDGE_BUDGET_BURST), each hedge spends one, and at most
+HEDGE_MAX_IN_FLIGHT hedges run at once. Until a backend has ROUTER_MIN_SAMPLES latencies, the
+hedge delay is HEDGE_DEFAULT_DELAY_SECONDS.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from config import load_environment_variable, logger
+from service.circuit_breaker import adaptive_timeout, get_breaker
+from service.metrics import metrics, percentile
+
+HEDGE_ENABLED = load_environment_variable("HEDGE_ENABLED", "True") == "True"
+FAILOVER_ENABLED = load_environment_variable("FAILOVER_ENABLED", "True") == "True"
+HEDGE_PERCENTILE = float(load_environment_variable("HEDGE_PERCENTILE", 0.95))
+HEDGE_BUDGET_RATIO = float(load_environment_variable("HEDGE_BUDGET_RATIO", 0.1))
+HEDGE_BUDGET_BURST = float(load_environment_variable("HEDGE_BUDGET_BURST", 5))
+HEDGE_MAX_IN_FLIGHT = int(load_environment_variable("HEDGE_MAX_IN_FLIGHT", 4))
+HEDGE_MIN_DELAY_SECONDS = float(load_environment_variable("HEDGE_MIN_DELAY_SECONDS", 5))
+HEDGE_DEFAULT_DELAY_SECONDS = float(load_environment_variable("HEDGE_DEFAULT_DELAY_SECONDS", 60))
+ROUTER_LATENCY_WINDOW = int(load_environment_variable("ROUTER_LATENCY_WINDOW", 200))
+ROUTER_MIN_SAMPLES = int(load_environment_variable("ROUTER_MIN_SAMPLES", 20))
+# Longest any backend call may take, before adaptive timeouts bring it down
+ROUTER_TIMEOUT_SECONDS = float(load_environment_variable("ROUTER_TIMEOUT_SECONDS", 180))
+# OpenAI model used for hedged and failed-over runpod requests
+ROUTER_SECONDARY_MODEL = load_environment_variable("ROUTER_SECONDARY_MODEL", "gpt-4o")
+
+SCOTI = "scoti"
+OPENAI = "openai"
+
+
+def resolve_ai_provider(ai_provider: str) -> str:
+    """
+    The provider a request's ai_provider asks for: SCOTI (runpod) for "scoti" or when it is not
+    set, OPENAI for anything else
+    """
+    return SCOTI if ai_provider in (SCOTI, '', None) else OPENAI
+
+
+class BackendStats:
+    def __init__(self, window: int = ROUTER_LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+
+    def summary(self, ceiling: float) -> dict:
+        latencies = list(self.latencies)
+        return {
+            "timeout_seconds": adaptive_timeout(latencies, ceiling),
+            "requests": self.requests,
+            "errors": self.errors,
+            "wins": self.wins,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "samples": len(latencies),
+        }
+
+
+class LatencyRouter:
+    def __init__(self, primary: str, secondary: str):
+        self.primary = primary
+        self.secondary = secondary
+        self.backends = {primary: BackendStats(), secondary: BackendStats()}
+        self.hedge_budget = HEDGE_BUDGET_BURST
+        self.hedges_in_flight = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self) -> float:
+        """
+        How long to wait for the primary before hedging: its rolling p95 latency
+        """
+        with self._lock:
+            latencies = list(self.backends[self.primary].latencies)
+        if len(latencies) < ROUTER_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        return max(HEDGE_MIN_DELAY_SECONDS, percentile(latencies, HEDGE_PERCENTILE))
+
+    def _earn_hedge_budget(self):
+        with self._lock:
+            self.hedge_budget = min(HEDGE_BUDGET_BURST, self.hedge_budget + HEDGE_BUDGET_RATIO)
+
+    def _take_hedge_budget(self) -> bool:
+        with self._lock:
+            if self.hedge_budget < 1 or self.hedges_in_flight >= HEDGE_MAX_IN_FLIGHT:
+                return False
+            self.hedge_budget -= 1
+            self.hedges_in_flight += 1
+            return True
+
+    def _release_hedge(self):
+        with self._lock:
+            self.hedges_in_flight -= 1
+
+    def timeout_for(self, name: str, ceiling: float, floor: float = 0.0) -> float:
+        with self._lock:
+            latencies = list(self.backends[name].latencies)
+        return adaptive_timeout(latencies, ceiling, floor)
+
+    async def _timed(
+        self, name: str, call: Callable[[], Awaitable[str]], timeout: float, min_timeout: float = 0.0
+    ) -> str:
+        """
+        Call one backend through its circuit breaker, with a timeout adapted to its recent latencies
+        but at least min_timeout (within timeout)
+        """
+        stats = self.backends[name]
+        breaker = get_breaker(name)
+        breaker.check()
+        timeout = self.timeout_for(name, timeout, min_timeout)
+        start = time.monotonic()
+        with self._lock:
+            stats.requests += 1
+        try:
+            response = await asyncio.wait_for(call(), timeout)
+            if not response:
+                raise ValueError(f"{name} returned an empty response")
+        except asyncio.CancelledError:
+            breaker.record_cancelled()
+            raise
+        except asyncio.TimeoutError as e:
+            breaker.record_failure()
+            with self._lock:
+                stats.errors += 1
+            raise TimeoutError(f"{name} did not answer within {timeout:.0f} seconds") from e
+        except Exception:
+            breaker.record_failure()
+            with self._lock:
+                stats.errors += 1
+            raise
+        breaker.record_success()
+        elapsed = time.monotonic() - start
+        with self._lock:
+            stats.latencies.append(elapsed)
+        metrics.observe(f"router.{name}.latency_seconds", elapsed)
+        return response
+
+    def _won(self, name: str, response: str) -> tuple[str, str]:
+        with self._lock:
+            self.backends[name].wins += 1
+        return response, name
+
+    async def complete(
+        self,
+        primary: Callable[[], Awaitable[str]],
+        secondary: Callable[[], Awaitable[str]],
+        timeout: float,
+        primary_min_timeout: float = 0.0,
+    ) -> tuple[str, str]:
+        """
+        Run primary(), hedging or failing over to secondary() as described above. A backend whose
+        circuit breaker is open is skipped, and neither call runs longer than timeout seconds.
+        primary_min_timeout keeps the primary's adaptive timeout from cutting off a call known to be
+        slow, e.g. a runpod cold start.
+        Returns (response, name of the backend that answered). If both fail, the primary's error is raised.
+        """
+        self._earn_hedge_budget()
+        primary_task = asyncio.ensure_future(self._timed(self.primary, primary, timeout, primary_min_timeout))
+        secondary_task = None
+        hedged = False
+        try:
+            if HEDGE_ENABLED:
+                done, _ = await asyncio.wait({primary_task}, timeout=self.hedge_delay())
+                if not done:
+                    hedged = self._take_hedge_budget()
+                    metrics.increment("router.hedges" if hedged else "router.hedges_denied")
+
+            if not hedged:
+                try:
+                    return self._won(self.primary, await primary_task)
+                except Exception as e:
+                    if not FAILOVER_ENABLED:
+                        raise
+                    logger.warning(f"{self.primary} failed ({type(e).__name__}: {e}), failing over to {self.secondary}")
+                    metrics.increment("router.failovers")
+                    try:
+                        return self._won(self.secondary, await self._timed(self.secondary, secondary, timeout))
+                    except Exception:
+                        logger.error(f"{self.secondary} failed as well", exc_info=True)
+                        raise e
+
+            logger.info(f"{self.primary} is slower than its p{HEDGE_PERCENTILE * 100:.0f}, hedging with {self.secondary}")
+            secondary_task = asyncio.ensure_future(self._timed(self.secondary, secondary, timeout))
+            names = {primary_task: self.primary, secondary_task: self.secondary}
+            pending = set(names)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        metrics.increment(f"router.hedge_won.{names[task]}")
+                        return self._won(names[task], task.result())
+            raise primary_task.exception()
+        finally:
+            # Cancel whichever request lost, or everything if our caller gave up
+            primary_task.cancel()
+            if secondary_task is not None:
+                secondary_task.cancel()
+            if hedged:
+                self._release_hedge()
+
+    async def complete_secondary(self, secondary: Callable[[], Awaitable[str]], timeout: float) -> tuple[str, str]:
+        """
+        Run secondary() alone, for requests the primary is known to be unable to serve in time
+        """
+        metrics.increment("router.rerouted")
+        return self._won(self.secondary, await self._timed(self.secondary, secondary, timeout))
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                "hedge_delay_seconds": delay,
+                "hedge_budget": round(self.hedge_budget, 2),
+                "hedges_in_flight": self.hedges_in_flight,
+                **{name: stats.summary(ROUTER_TIMEOUT_SECONDS) for name, stats in self.backends.items()},
+            }
+
+
+llm_router = LatencyRouter("runpod", "openai")
+metrics.register_collector("llm_router", llm_router.stats)
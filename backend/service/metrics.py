@@ -0,0 +1,83 @@
+"""
+Process-wide counters, gauges and latency observations, served by /api/metrics
+"""
+
+import threading
+from collections import defaultdict, deque
+from typing import Callable
+
+
+def percentile(values, fraction: float) -> float:
+    """
+    Nearest-rank percentile of a list of numbers, 0.0 for an empty list
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Metrics:
+    def __init__(self, window: int = 500):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._observations = defaultdict(lambda: deque(maxlen=window))
+        self._collectors = {}
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """
+        Record one observation (typically a latency in seconds) in a rolling window
+        """
+        with self._lock:
+            self._observations[name].append(value)
+
+    def values(self, name: str) -> list:
+        """
+        The observations currently in the rolling window for name
+        """
+        with self._lock:
+            return list(self._observations.get(name, ()))
+
+    def register_collector(self, name: str, collector: Callable[[], dict]):
+        """
+        Register a callable whose dict result is included in every snapshot under name
+        """
+        with self._lock:
+            self._collectors[name] = collector
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            observations = {name: list(values) for name, values in self._observations.items()}
+            collectors = dict(self._collectors)
+
+        summary = {
+            name: {
+                "count": len(values),
+                "avg": sum(values) / len(values) if values else 0.0,
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "max": max(values) if values else 0.0,
+            }
+            for name, values in observations.items()
+        }
+        return {
+            "counters": counters,
+            "gauges": gauges,
+            "observations": summary,
+            **{name: collector() for name, collector in collectors.items()},
+        }
+
+
+metrics = Metrics()
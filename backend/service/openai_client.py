@@ -1,37 +1,230 @@
-from openai import OpenAI
-from config import load_environment_variable
+"""
+Process-wide, pooled OpenAI clients.
 
+Every call used to build a new OpenAI client, so each audit section paid for a new connection
+and TLS handshake. Clients are now created once per model and shared between threads, on top of
+a single keep-alive connection pool (OPENAI_POOL_SIZE connections, idle ones kept for
+OPENAI_KEEPALIVE_SECONDS). Timeouts and retries can be set per model with
+OPENAI_<MODEL>_TIMEOUT_SECONDS and OPENAI_<MODEL>_MAX_RETRIES, e.g. OPENAI_GPT_4O_MINI_TIMEOUT_SECONDS.
+New and reused connections are counted in metrics.
+"""
 
-def invoke_openai_directly(query):
+import re
+import threading
+from typing import NamedTuple
 
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=load_environment_variable("OPENAI_API_KEY"),
-    )
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from config import load_environment_variable, logger
+from service.circuit_breaker import get_breaker, guard_stream
+from service.metrics import metrics
+from service.response_cache import acached_call, cached_call, cached_stream
+
+OPENAI_POOL_SIZE = int(load_environment_variable("OPENAI_POOL_SIZE", 20))
+OPENAI_KEEPALIVE_SECONDS = float(load_environment_variable("OPENAI_KEEPALIVE_SECONDS", 60))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(load_environment_variable("OPENAI_CONNECT_TIMEOUT_SECONDS", 10))
+OPENAI_TIMEOUT_SECONDS = float(load_environment_variable("OPENAI_TIMEOUT_SECONDS", 180))
+OPENAI_MAX_RETRIES = int(load_environment_variable("OPENAI_MAX_RETRIES", 2))
+
+CHAT_MODEL = "gpt-4o"
+AUDIT_MODEL = "gpt-4o-mini"
+
+
+class ModelSettings(NamedTuple):
+    timeout: float
+    max_retries: int
 
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": query,
-            }
-        ],
-        model="gpt-4o",
+
+def get_model_settings(model: str) -> ModelSettings:
+    prefix = "OPENAI_" + re.sub(r"[^A-Z0-9]+", "_", model.upper())
+    return ModelSettings(
+        timeout=float(load_environment_variable(f"{prefix}_TIMEOUT_SECONDS", OPENAI_TIMEOUT_SECONDS)),
+        max_retries=int(load_environment_variable(f"{prefix}_MAX_RETRIES", OPENAI_MAX_RETRIES)),
     )
 
-    return chat_completion.choices[0].message.content
 
+class _ConnectionTracer:
+    """
+    httpcore trace callback that records whether a request had to open a new connection
+    """
+
+    def __init__(self):
+        self.connected = False
+
+    def __call__(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connected = True
+
+
+def _trace_request(request):
+    request.extensions["trace"] = _ConnectionTracer()
+
+
+class _AsyncConnectionTracer(_ConnectionTracer):
+    async def __call__(self, event_name: str, info: dict):
+        super().__call__(event_name, info)
+
+
+async def _trace_async_request(request):
+    request.extensions["trace"] = _AsyncConnectionTracer()
+
+
+async def _count_async_connection(response):
+    _count_connection(response)
+
+
+def _count_connection(response):
+    tracer = response.request.extensions.get("trace")
+    metrics.increment("openai.requests")
+    if isinstance(tracer, _ConnectionTracer):
+        metrics.increment("openai.connections_opened" if tracer.connected else "openai.connections_reused")
+
+
+_http_client = None
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
 
-def invoke_openai_directly_with_messages(messages):
 
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=load_environment_variable("OPENAI_API_KEY"),
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_POOL_SIZE,
+        max_keepalive_connections=OPENAI_POOL_SIZE,
+        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
     )
 
-    chat_completion = client.chat.completions.create(
+
+def _get_http_client() -> DefaultHttpxClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = DefaultHttpxClient(
+            limits=_pool_limits(),
+            event_hooks={"request": [_trace_request], "response": [_count_connection]},
+        )
+        metrics.set_gauge("openai.pool_size", OPENAI_POOL_SIZE)
+    return _http_client
+
+
+def get_openai_client(model: str) -> OpenAI:
+    """
+    Shared OpenAI client for model, created on first use
+    """
+    with _clients_lock:
+        client = _clients.get(model)
+        if client is None:
+            settings = get_model_settings(model)
+            logger.info(f"Creating pooled OpenAI client for {model} ({settings})")
+            client = OpenAI(
+                api_key=load_environment_variable("OPENAI_API_KEY"),
+                http_client=_get_http_client(),
+                timeout=httpx.Timeout(settings.timeout, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+                max_retries=settings.max_retries,
+            )
+            _clients[model] = client
+        return client
+
+
+def get_async_openai_client(model: str) -> AsyncOpenAI:
+    """
+    Shared AsyncOpenAI client for model, for use on the runpod event loop (see service.runpod_async)
+    """
+    with _clients_lock:
+        client = _async_clients.get(model)
+        if client is None:
+            settings = get_model_settings(model)
+            logger.info(f"Creating pooled async OpenAI client for {model} ({settings})")
+            client = AsyncOpenAI(
+                api_key=load_environment_variable("OPENAI_API_KEY"),
+                http_client=DefaultAsyncHttpxClient(
+                    limits=_pool_limits(),
+                    event_hooks={"request": [_trace_async_request], "response": [_count_async_connection]},
+                ),
+                timeout=httpx.Timeout(settings.timeout, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+                max_retries=settings.max_retries,
+            )
+            _async_clients[model] = client
+        return client
+
+
+async def acomplete_with_messages(messages, model=CHAT_MODEL) -> str:
+    """
+    Uncached async completion, cancelling the task aborts the HTTP request
+    """
+    chat_completion = await get_async_openai_client(model).chat.completions.create(
         messages=messages,
-        model="gpt-4o-mini",
+        model=model,
     )
+    return chat_completion.choices[0].message.content
+
+
+def complete_with_messages(messages, model=AUDIT_MODEL, use_cache=True) -> tuple[str, bool]:
+    """
+    Returns (response, whether it came from the response cache)
+    """
+    def call():
+        breaker = get_breaker("openai")
+        breaker.check()
+        try:
+            chat_completion = get_openai_client(model).chat.completions.create(
+                messages=messages,
+                model=model,
+            )
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return chat_completion.choices[0].message.content
+
+    return cached_call("openai", model, {}, messages, call, use_cache)
+
+
+async def acomplete_with_messages_cached(messages, model=AUDIT_MODEL, use_cache=True) -> tuple[str, bool]:
+    """
+    Async complete_with_messages, for use on the runpod event loop
+    """
+    async def call():
+        breaker = get_breaker("openai")
+        breaker.check()
+        try:
+            response = await acomplete_with_messages(messages, model)
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response
+
+    return await acached_call("openai", model, {}, messages, call, use_cache)
+
+
+def invoke_openai_directly(query, use_cache=True):
+    return invoke_openai_directly_with_messages([{"role": "user", "content": query}], model=CHAT_MODEL, use_cache=use_cache)
+
+
+def invoke_openai_directly_with_messages(messages, model=AUDIT_MODEL, use_cache=True):
+    return complete_with_messages(messages, model, use_cache)[0]
+
+
+def stream_openai_with_messages(messages, model=CHAT_MODEL):
+    """
+    Yield the response text as it is generated, through the openai circuit breaker
+    """
+    def chunks():
+        stream = get_openai_client(model).chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=True,
+        )
+        with stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    yield from guard_stream("openai", chunks())
+
 
-    return chat_completion.choices[0].message.content
\ No newline at end of file
+def stream_with_messages(messages, model=CHAT_MODEL, use_cache=True):
+    """
+    Returns (iterator over the response text, whether it came from the response cache)
+    """
+    return cached_stream("openai", model, {}, messages, lambda: stream_openai_with_messages(messages, model), use_cache)
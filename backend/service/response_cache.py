@@ -0,0 +1,224 @@
+"""
+Cache of LLM responses, so an identical audit or question is answered without a new generation.
+
+Sampling is effectively deterministic (runpod_call pins temperature at 0.001), so a response is
+reused when the provider, model, sampling parameters and normalised messages all match. Entries
+live in SQLite, in RESPONSE_CACHE_PATH when it is set (shared by all workers and kept across
+restarts) or in memory otherwise. Entries expire after RESPONSE_CACHE_TTL_SECONDS, and the least
+recently used ones are evicted once the cached text exceeds RESPONSE_CACHE_MAX_BYTES.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, NamedTuple
+
+from config import load_environment_variable, logger
+from service.metrics import metrics
+
+RESPONSE_CACHE_ENABLED = load_environment_variable("RESPONSE_CACHE_ENABLED", "True") == "True"
+RESPONSE_CACHE_PATH = load_environment_variable("RESPONSE_CACHE_PATH", None)
+RESPONSE_CACHE_TTL_SECONDS = float(load_environment_variable("RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+RESPONSE_CACHE_MAX_BYTES = int(load_environment_variable("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+class Source(NamedTuple):
+    """
+    The backend that actually produced a response, when it is not the one that was asked
+    (e.g. a runpod request answered by OpenAI after hedging or failover)
+    """
+    provider: str
+    model: str
+    params: dict
+
+
+def normalise_messages(messages: list) -> list:
+    """
+    Role and content of each message with runs of whitespace collapsed, ignoring any other keys
+    """
+    return [{"role": message["role"], "content": " ".join(str(message["content"]).split())} for message in messages]
+
+
+class ResponseCache:
+    def __init__(self, path: str = None, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path or ":memory:", timeout=10, check_same_thread=False)
+        with self._lock, self._connection:
+            if path:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    @staticmethod
+    def make_key(provider: str, model: str, params: dict, messages: list) -> str:
+        payload = json.dumps(
+            {"provider": provider, "model": model, "params": params, "messages": normalise_messages(messages)},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND created > ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is not None:
+                self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.increment("response_cache.hits" if row is not None else "response_cache.misses")
+        return row[0] if row is not None else None
+
+    def put(self, key: str, response: str):
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, size, now, now),
+                )
+                self._connection.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl_seconds,))
+                # Evict the least recently used entries beyond max_bytes
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                    "SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running FROM responses"
+                    ") WHERE running > ?)",
+                    (self.max_bytes,),
+                )
+        except sqlite3.Error:
+            logger.warning("Could not write LLM response cache entry", exc_info=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                "enabled": RESPONSE_CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "persistent": self.path is not None,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH)
+metrics.register_collector("response_cache", response_cache.stats)
+
+
+def _lookup(provider: str, model: str, params: dict, messages: list, use_cache: bool) -> tuple[str, str | None]:
+    """
+    The cache key, and the cached response or None
+    """
+    key = response_cache.make_key(provider, model, params, messages)
+    if use_cache:
+        return key, response_cache.get(key)
+    metrics.increment("response_cache.bypassed")
+    return key, None
+
+
+def _without_source(response):
+    """
+    The response or stream iterator of call() or stream(), without its Source if it has one
+    """
+    return response[0] if isinstance(response, tuple) else response
+
+
+def _store(key: str, messages: list, response) -> str:
+    """
+    Cache a fresh response, given as a string or as (response, Source), and return its text
+    """
+    if isinstance(response, tuple):
+        response, source = response
+        key = response_cache.make_key(*source, messages)
+    if response:
+        response_cache.put(key, response)
+    return response
+
+
+def cached_call(
+    provider: str, model: str, params: dict, messages: list, call: Callable[[], str], use_cache: bool = True
+) -> tuple[str, bool]:
+    """
+    Return (response, True) from the cache, or (call(), False) after caching a non-empty result.
+    use_cache=False bypasses the lookup but still stores the fresh response.
+    call() may return (response, Source) instead, and the response is then cached under the key of
+    the backend that produced it rather than the one asked.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return _without_source(call()), False
+    key, cached = _lookup(provider, model, params, messages, use_cache)
+    if cached is not None:
+        return cached, True
+    return _store(key, messages, call()), False
+
+
+async def acached_call(
+    provider: str, model: str, params: dict, messages: list, call: Callable[[], Awaitable], use_cache: bool = True
+) -> tuple[str, bool]:
+    """
+    cached_call for a coroutine function call
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return _without_source(await call()), False
+    key, cached = _lookup(provider, model, params, messages, use_cache)
+    if cached is not None:
+        return cached, True
+    return _store(key, messages, await call()), False
+
+
+def _replay(response: str) -> Iterator[str]:
+    yield response
+
+
+def cached_stream(
+    provider: str,
+    model: str,
+    params: dict,
+    messages: list,
+    stream: Callable[[], Iterator[str]],
+    use_cache: bool = True,
+) -> tuple[Iterator[str], bool]:
+    """
+    Streaming version of cached_call: returns (the cached response as a single chunk, True), or
+    (the chunks of stream(), False), caching the joined response once the stream completes.
+    Like call() in cached_call, stream() may return (iterator, Source).
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return _without_source(stream()), False
+    key, cached = _lookup(provider, model, params, messages, use_cache)
+    if cached is not None:
+        return _replay(cached), True
+
+    def record():
+        chunks = []
+        iterator = stream()
+        source = None
+        if isinstance(iterator, tuple):
+            iterator, source = iterator
+        for chunk in iterator:
+            chunks.append(chunk)
+            yield chunk
+        response = "".join(chunks)
+        _store(key, messages, (response, source) if source else response)
+
+    return record(), False
@@ -0,0 +1,212 @@
+"""
+Asyncio client for the runpod serverless API.
+
+Every job used to hold a Flask worker thread in run_request.output() for up to three minutes.
+Jobs are now submitted and polled from one event loop, running in a background thread, over a
+single shared aiohttp session, so one worker can have many jobs in flight. Polling backs off
+from RUNPOD_POLL_MIN_SECONDS to RUNPOD_POLL_MAX_SECONDS. Synchronous code reaches the client
+through run_in_loop and iterate_in_loop, which is what the functions in runpod_utils wrap.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from typing import AsyncIterator, Iterator
+
+import aiohttp
+import runpod
+
+from config import load_environment_variable, logger
+from service.metrics import metrics
+
+RUNPOD_POOL_SIZE = int(load_environment_variable("RUNPOD_POOL_SIZE", 20))
+RUNPOD_POLL_MIN_SECONDS = float(load_environment_variable("RUNPOD_POLL_MIN_SECONDS", 0.25))
+RUNPOD_POLL_MAX_SECONDS = float(load_environment_variable("RUNPOD_POLL_MAX_SECONDS", 2))
+RUNPOD_REQUEST_TIMEOUT_SECONDS = float(load_environment_variable("RUNPOD_REQUEST_TIMEOUT_SECONDS", 30))
+
+COMPLETED_STATES = {"COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT"}
+
+
+class RunpodJobError(Exception):
+    pass
+
+
+class AsyncRunpodClient:
+    def __init__(self, pool_size: int = RUNPOD_POOL_SIZE):
+        self.pool_size = pool_size
+        self._session = None
+        # Strong references to fire-and-forget cancellations, so they are not garbage collected
+        self._background = set()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily, so it is bound to the loop it is used from
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=RUNPOD_REQUEST_TIMEOUT_SECONDS),
+            )
+        return self._session
+
+    async def _request(self, method: str, pod_id: str, path: str, token: str, payload: dict = None) -> dict:
+        url = f"{runpod.endpoint_url_base}/{pod_id}/{path}"
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        async with self._get_session().request(method, url, headers=headers, json=payload) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def submit(self, pod_id: str, token: str, job_input: dict) -> str:
+        """
+        Queue a job on the endpoint and return its id
+        """
+        job = await self._request("POST", pod_id, "run", token, {"input": job_input})
+        metrics.increment("runpod.jobs_submitted")
+        return job["id"]
+
+    async def status(self, pod_id: str, token: str, job_id: str) -> dict:
+        return await self._request("GET", pod_id, f"status/{job_id}", token)
+
+    async def cancel(self, pod_id: str, token: str, job_id: str) -> dict:
+        metrics.increment("runpod.jobs_cancelled")
+        return await self._request("POST", pod_id, f"cancel/{job_id}", token)
+
+    async def health(self, pod_id: str, token: str) -> dict:
+        return await self._request("GET", pod_id, "health", token)
+
+    async def _cancel_quietly(self, pod_id: str, token: str, job_id: str):
+        try:
+            await self.cancel(pod_id, token, job_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning(f"Could not cancel runpod job {job_id}", exc_info=True)
+
+    def _cancel_in_background(self, pod_id: str, token: str, job_id: str):
+        """
+        Cancel the job without waiting, e.g. from a task that is itself being cancelled
+        """
+        task = asyncio.get_running_loop().create_task(self._cancel_quietly(pod_id, token, job_id))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def wait(self, pod_id: str, token: str, job_id: str, timeout: float) -> dict:
+        """
+        Poll the job until it finishes and return its final status.
+        Raises TimeoutError, after cancelling the job, if it is still running after timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        interval = RUNPOD_POLL_MIN_SECONDS
+        while True:
+            job = await self.status(pod_id, token, job_id)
+            if job["status"] in COMPLETED_STATES:
+                if "delayTime" in job:
+                    metrics.observe("runpod.queue_seconds", job["delayTime"] / 1000)
+                if "executionTime" in job:
+                    metrics.observe("runpod.execution_seconds", job["executionTime"] / 1000)
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                await self._cancel_quietly(pod_id, token, job_id)
+                raise TimeoutError(f"Runpod job {job_id} did not finish in {timeout} seconds")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, RUNPOD_POLL_MAX_SECONDS)
+
+    async def run(self, pod_id: str, token: str, job_input: dict, timeout: float):
+        """
+        Submit a job, wait for it and return its output
+        """
+        start = time.monotonic()
+        job_id = await self.submit(pod_id, token, job_input)
+        try:
+            job = await self.wait(pod_id, token, job_id, timeout)
+        except asyncio.CancelledError:
+            # The caller no longer wants the result (e.g. a hedged request won), so free the GPU
+            self._cancel_in_background(pod_id, token, job_id)
+            raise
+        metrics.observe("runpod.latency_seconds", time.monotonic() - start)
+        if job["status"] != "COMPLETED":
+            metrics.increment("runpod.jobs_failed")
+            raise RunpodJobError(f"Runpod job {job_id} finished with status {job['status']}: {job.get('error')}")
+        return job.get("output")
+
+    async def stream(self, pod_id: str, token: str, job_input: dict, timeout: float = None) -> AsyncIterator:
+        """
+        Submit a job and yield its output chunks as the worker produces them.
+        Raises TimeoutError, after cancelling the job, if it is still running after timeout seconds.
+        The job is also cancelled if the iteration is cancelled or closed before the job finishes.
+        """
+        job_id = await self.submit(pod_id, token, job_input)
+        deadline = time.monotonic() + timeout if timeout else None
+        interval = RUNPOD_POLL_MIN_SECONDS
+        finished = False
+        try:
+            while True:
+                if deadline and time.monotonic() > deadline:
+                    finished = True
+                    await self._cancel_quietly(pod_id, token, job_id)
+                    raise TimeoutError(f"Runpod job {job_id} did not finish in {timeout} seconds")
+                partial = await self._request("GET", pod_id, f"stream/{job_id}", token)
+                chunks = partial.get("stream", [])
+                finished = partial["status"] in COMPLETED_STATES
+                for chunk in chunks:
+                    yield chunk["output"]
+                if finished and not chunks:
+                    if partial["status"] != "COMPLETED":
+                        raise RunpodJobError(f"Runpod job {job_id} finished with status {partial['status']}")
+                    return
+                interval = RUNPOD_POLL_MIN_SECONDS if chunks else min(interval * 2, RUNPOD_POLL_MAX_SECONDS)
+                await asyncio.sleep(interval)
+        finally:
+            if not finished:
+                # Cancelled, closed by the caller (e.g. the client disconnected) or failed, so free the GPU
+                self._cancel_in_background(pod_id, token, job_id)
+
+
+runpod_client = AsyncRunpodClient()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop shared by all runpod jobs, running in a daemon thread
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="runpod-client", daemon=True).start()
+        return _loop
+
+
+def run_in_loop(coroutine, timeout: float = None):
+    """
+    Run a coroutine on the shared event loop and block the calling thread until its result is ready
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result(timeout)
+
+
+def iterate_in_loop(async_iterator: AsyncIterator) -> Iterator:
+    """
+    Iterate an async iterator on the shared event loop from synchronous code
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop polling if the caller stops iterating early, e.g. the client disconnected
+        future.cancel()
@@ -2,110 +2,202 @@
 Functions for making runpod calls, and getting the GPT response 
 """
 
-import runpod
+from typing import Iterator
+
 from config import load_environment_variable, logger
-from service.openai_client import invoke_openai_directly
+from service.circuit_breaker import guard_stream
+from service.llm_router import ROUTER_SECONDARY_MODEL, llm_router
+from service.metrics import metrics
+from service.openai_client import acomplete_with_messages, invoke_openai_directly, stream_openai_with_messages
+from service.response_cache import Source, acached_call, cached_stream
+from service.runpod_async import RunpodJobError, iterate_in_loop, run_in_loop, runpod_client
+from service.runpod_warmer import REJECT, REROUTE, RunpodBusyError, cold_start_timeout, describe_wait, warm_keeper
 
-def runpod_sync_call(name, query):
-    runpod.api_key = load_environment_variable("runpod_bearer_token")
 
-    endpoint = runpod.Endpoint(load_environment_variable("runpod_pod_id"))
+def build_chat_input(prompt: str = "", messages: list = None) -> dict:
+    if not messages:
+        messages = [
+                {"role": "user", "content": prompt},
+            ]
+    return {
+        "messages": messages,
+        "max_tokens": 4096,
+        "temperature": 0.001,
+        "repetition_penalty": 1.00,
+        "add_bos_token": False,
+        "use_lora": False,
+        # "prompt": prompt,
+    }
+
 
+def runpod_sync_call(name, query):
     try:
-        run_request = endpoint.run_sync(
-            {
-                "input": {
-                    "name": name,
-                    "query": query
-                }
-            },
-            timeout=60,  # Timeout in seconds.
+        return run_in_loop(
+            runpod_client.run(
+                load_environment_variable("runpod_pod_id"),
+                load_environment_variable("runpod_bearer_token"),
+                {"name": name, "query": query},
+                timeout=60,  # Timeout in seconds.
+            )
         )
-
-        return(run_request)
     except TimeoutError:
         logger.error("Runpod request timed out.")
     except Exception as e:
         logger.error("Houston, we have a %s", "major problem", exc_info=True)
     return invoke_openai_directly(query)
 
-def runpod_call(prompt: str = "", messages: list = [], timeout: int = 180, **runpod_credentials):
+
+async def runpod_call_routed(
+    prompt: str = "", messages: list = None, timeout: int = 180, **runpod_credentials
+) -> tuple[str, str]:
+    """
+    A runpod call through the latency router: hedged with, or failing over to, OpenAI
+    (ROUTER_SECONDARY_MODEL) when runpod is slow or down, and sent straight to OpenAI when the
+    runpod queue is too long (see service.runpod_warmer).
+    Returns (response, name of the backend that answered).
+    Raises RunpodBusyError when runpod's wait is too long and OpenAI is unavailable.
+    """
+    runpod_pod_id = runpod_credentials.get("runpod_pod_id")
+    runpod_bearer_token = runpod_credentials.get("runpod_bearer_token")
+    job_input = build_chat_input(prompt, messages)
+
+    async def call_runpod():
+        runpod_response = await runpod_client.run(runpod_pod_id, runpod_bearer_token, job_input, timeout=timeout)
+        return ''.join(runpod_response or [])
+
+    async def call_openai():
+        return await acomplete_with_messages(job_input["messages"], model=ROUTER_SECONDARY_MODEL)
+
+    admission = await warm_keeper.admit(runpod_pod_id, runpod_bearer_token, timeout)
+    if admission.decision == REJECT:
+        raise RunpodBusyError(admission.expected_wait)
+    try:
+        if admission.decision == REROUTE:
+            logger.info(f"Runpod would take {describe_wait(admission.expected_wait)} to start, asking {llm_router.secondary}")
+            runpod_response, backend = await llm_router.complete_secondary(call_openai, timeout)
+        else:
+            runpod_response, backend = await llm_router.complete(
+                call_runpod, call_openai, timeout, primary_min_timeout=cold_start_timeout(admission.health))
+    except (RunpodJobError, ValueError) as e:
+        logger.error(f"Houston, we have a major problem: {e}")
+        return "", llm_router.primary
+    logger.info(f"Response from {backend}")
+    return runpod_response, backend
+
+
+# Cache key of answers served by the router's secondary backend, the same as complete_with_messages uses
+SECONDARY_SOURCE = Source("openai", ROUTER_SECONDARY_MODEL, {})
+
+
+def _cache_params(job_input: dict) -> dict:
+    return {key: value for key, value in job_input.items() if key != "messages"}
+
+
+async def arunpod_complete(
+    prompt: str = "", messages: list = None, timeout: int = 180, use_cache: bool = True, **runpod_credentials
+) -> tuple[str, bool]:
+    """
+    Returns (response, whether it came from the response cache).
+    Answers from OpenAI (hedged or failed over) are cached as OpenAI's, not the runpod model's.
+    """
+    job_input = build_chat_input(prompt, messages)
+
+    async def call():
+        response, backend = await runpod_call_routed(prompt, messages, timeout, **runpod_credentials)
+        return (response, SECONDARY_SOURCE) if backend == llm_router.secondary else response
+
+    return await acached_call(
+        "runpod",
+        runpod_credentials.get("runpod_pod_id"),
+        _cache_params(job_input),
+        job_input["messages"],
+        call,
+        use_cache,
+    )
+
+
+def runpod_complete(
+    prompt: str = "", messages: list = None, timeout: int = 180, use_cache: bool = True, **runpod_credentials
+) -> tuple[str, bool]:
+    """
+    Same as runpod_call, but returns (response, whether it came from the response cache)
+    """
+    return run_in_loop(arunpod_complete(prompt, messages, timeout, use_cache, **runpod_credentials))
+
+
+def runpod_call(prompt: str = "", messages: list = None, timeout: int = 180, use_cache: bool = True, **runpod_credentials):
     """
     Takes your input prompt, and gets output from the designated model
 
     Inputs:
         prompt (str): input message for GPT
+        use_cache (bool): False to skip the response cache lookup
         runpod_pod_id (str): pod id of the runpod pod you want to make a request to.
         runpod_bearer_token (str): your runpod bearer token
     """
-    runpod_bearer_token = runpod_credentials.get("runpod_bearer_token")
-    runpod_pod_id = runpod_credentials.get("runpod_pod_id")
-
-    runpod.api_key = runpod_bearer_token
-    endpoint = runpod.Endpoint(runpod_pod_id)
-    if not messages:
-        messages = [
-                {"role": "user", "content": prompt},
-            ]
-    data = {
-        "input": {
-            "messages": messages,
-            "max_tokens": 4096,
-            "temperature": 0.001,
-            "repetition_penalty": 1.00,
-            "add_bos_token": False,
-            "use_lora": False,
-            # "prompt": prompt,
-        }
-    }
-    # logger.info(f"calling runpod endpoint with data: {data}")
-    run_request = endpoint.run(data)
-    runpod_response = run_request.output(timeout=timeout)
-    try:
-        # logger.info(f"runpod request output: {runpod_response}")
-        return ''.join(runpod_response)
-    except Exception as e:
-        logger.error("Houston, we have a %s", "major problem handling runpod output", exc_info=True)
-        return ""
+    return runpod_complete(prompt, messages, timeout, use_cache, **runpod_credentials)[0]
 
 
-def runpod_call_stream(prompt: str, **runpod_credentials):
+def runpod_stream(
+    prompt: str = "", messages: list = None, timeout: int = 180, use_cache: bool = True, **runpod_credentials
+) -> tuple[Iterator[str], bool]:
     """
-    Takes your input prompt, and gets output from the designated model
+    Same as runpod_call_stream, but returns (iterator over the output, whether it came from the response cache).
+    Shares cache entries with runpod_complete.
+    """
+    job_input = build_chat_input(prompt, messages)
+    return cached_stream(
+        "runpod",
+        runpod_credentials.get("runpod_pod_id_stream") or runpod_credentials.get("runpod_pod_id"),
+        _cache_params(job_input),
+        job_input["messages"],
+        lambda: _admitted_stream(prompt, messages, timeout, **runpod_credentials),
+        use_cache,
+    )
+
+
+def _admitted_stream(prompt: str = "", messages: list = None, timeout: int = 180, **runpod_credentials):
+    """
+    runpod_call_stream, or (OpenAI's stream, its cache Source) when the runpod queue is too long
+    (see service.runpod_warmer). Raises RunpodBusyError when neither can answer in time.
+    """
+    admission = run_in_loop(warm_keeper.admit(
+        runpod_credentials.get("runpod_pod_id_stream") or runpod_credentials.get("runpod_pod_id"),
+        runpod_credentials.get("runpod_bearer_token"),
+        timeout,
+    ))
+    if admission.decision == REJECT:
+        raise RunpodBusyError(admission.expected_wait)
+    if admission.decision == REROUTE:
+        logger.info(f"Runpod would take {describe_wait(admission.expected_wait)} to start, streaming from OpenAI")
+        metrics.increment("router.rerouted")
+        messages = build_chat_input(prompt, messages)["messages"]
+        return stream_openai_with_messages(messages, model=ROUTER_SECONDARY_MODEL), SECONDARY_SOURCE
+    return runpod_call_stream(prompt, messages, timeout, **runpod_credentials)
+
+
+def runpod_call_stream(prompt: str = "", messages: list = None, timeout: int = 180, **runpod_credentials):
+    """
+    Takes your input prompt or messages, and yields the output of the designated model as it is generated
 
     Inputs:
         prompt (str): input message for GPT
 
         runpod_credentials: like
         {
-            runpod_pod_id_stream (str): pod id of the runpod pod you want to make a stream request to.
+            runpod_pod_id (str): pod id of the runpod pod you want to make a request to.
+            runpod_pod_id_stream (str): optional, pod id to use for stream requests instead.
             runpod_bearer_token (str): your runpod bearer token
         }
 
     """
+    runpod_pod_id = runpod_credentials.get("runpod_pod_id_stream") or runpod_credentials.get("runpod_pod_id")
     runpod_bearer_token = runpod_credentials.get("runpod_bearer_token")
-    runpod_pod_id = runpod_credentials.get("runpod_pod_id_stream")
-
-    runpod.api_key = runpod_bearer_token
-    endpoint = runpod.Endpoint(runpod_pod_id)
-    endpoint.purge_queue()
-
-    data = {
-        "input": {
-            "messages": [
-                {"role": "user", "content": prompt},
-            ],
-            "max_tokens": 4096,
-            "temperature": 0.001,
-            "repetition_penalty": 1.00,
-            "add_bos_token": False,
-            "use_lora": False,
-            # "prompt": prompt,
-        }
-    }
+    job_input = build_chat_input(prompt, messages)
 
-    run_request = endpoint.run(data)
-    for chars in run_request.stream():
+    for chars in guard_stream("runpod", iterate_in_loop(
+        runpod_client.stream(runpod_pod_id, runpod_bearer_token, job_input, timeout=timeout)
+    )):
         yield chars
 
 
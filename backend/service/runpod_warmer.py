@@ -0,0 +1,288 @@
+"""
+Keeps the serverless runpod endpoint warm, and decides how requests are admitted to it.
+
+After an idle period the endpoint has no workers, and the first request waits for a cold start
+(minutes). A background warm-keeper checks the endpoint's health every RUNPOD_WARM_INTERVAL_SECONDS
+and, when no real jobs are running, sends a one token warm-up job so a worker stays up. It only
+does this on RUNPOD_WARM_DAYS during RUNPOD_WARM_HOURS (in RUNPOD_WARM_TIMEZONE), so nights and
+weekends cost nothing. The interval should be shorter than the endpoint's idle timeout.
+
+Before a request is sent to runpod, its queue wait is estimated from the endpoint's queue depth,
+warm workers and recent execution times. Requests expected to wait less than
+RUNPOD_ADMIT_MAX_WAIT_SECONDS are queued on runpod; longer waits are routed to OpenAI when it is
+available, else queued if the wait fits in the request's timeout, else rejected with
+RunpodBusyError, which tells the client how long the wait would be.
+"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+from zoneinfo import ZoneInfo
+
+from config import load_environment_variable, logger, runpod_credentials_chat
+from service.circuit_breaker import get_breaker
+from service.llm_router import FAILOVER_ENABLED, SCOTI, resolve_ai_provider
+from service.metrics import metrics, percentile
+from service.runpod_async import run_in_loop, runpod_client
+
+RUNPOD_WARM_ENABLED = load_environment_variable("RUNPOD_WARM_ENABLED", "True") == "True"
+RUNPOD_WARM_INTERVAL_SECONDS = float(load_environment_variable("RUNPOD_WARM_INTERVAL_SECONDS", 240))
+RUNPOD_WARM_TIMEZONE = load_environment_variable("RUNPOD_WARM_TIMEZONE", "Australia/Sydney")
+# Days of the week (0 is Monday, both ends included) and hours (end excluded) to keep the endpoint warm
+RUNPOD_WARM_DAYS = load_environment_variable("RUNPOD_WARM_DAYS", "0-4")
+RUNPOD_WARM_HOURS = load_environment_variable("RUNPOD_WARM_HOURS", "8-18")
+RUNPOD_WARM_TIMEOUT_SECONDS = float(load_environment_variable("RUNPOD_WARM_TIMEOUT_SECONDS", 300))
+RUNPOD_HEALTH_MAX_AGE_SECONDS = float(load_environment_variable("RUNPOD_HEALTH_MAX_AGE_SECONDS", 15))
+RUNPOD_HEALTH_TIMEOUT_SECONDS = float(load_environment_variable("RUNPOD_HEALTH_TIMEOUT_SECONDS", 5))
+# Assumed until cold starts and jobs have been observed
+RUNPOD_COLD_START_SECONDS = float(load_environment_variable("RUNPOD_COLD_START_SECONDS", 120))
+RUNPOD_EXECUTION_SECONDS = float(load_environment_variable("RUNPOD_EXECUTION_SECONDS", 30))
+RUNPOD_ADMIT_MAX_WAIT_SECONDS = float(load_environment_variable("RUNPOD_ADMIT_MAX_WAIT_SECONDS", 20))
+
+QUEUE = "queue"
+REROUTE = "reroute"
+REJECT = "reject"
+
+WARM_UP_INPUT = {
+    "messages": [{"role": "user", "content": "Hi"}],
+    "max_tokens": 1,
+    "temperature": 0.001,
+    "add_bos_token": False,
+    "use_lora": False,
+}
+
+
+class RunpodBusyError(Exception):
+    def __init__(self, expected_wait: float):
+        super().__init__(f"runpod is expected to take {expected_wait:.0f} seconds to start this request")
+        self.expected_wait = expected_wait
+
+
+def describe_wait(seconds: float) -> str:
+    if seconds < 90:
+        return f"about {max(1, round(seconds))} seconds"
+    return f"about {round(seconds / 60)} minutes"
+
+
+class EndpointHealth(NamedTuple):
+    in_queue: int
+    in_progress: int
+    idle_workers: int
+    running_workers: int
+    initializing_workers: int
+    fetched_at: float
+
+    @classmethod
+    def from_response(cls, response: dict) -> "EndpointHealth":
+        jobs = response.get("jobs", {})
+        workers = response.get("workers", {})
+        return cls(
+            in_queue=jobs.get("inQueue", 0),
+            in_progress=jobs.get("inProgress", 0),
+            idle_workers=workers.get("idle", 0),
+            running_workers=workers.get("running", 0),
+            initializing_workers=workers.get("initializing", 0),
+            fetched_at=time.monotonic(),
+        )
+
+    @property
+    def warm_workers(self) -> int:
+        return self.idle_workers + self.running_workers
+
+
+class Admission(NamedTuple):
+    decision: str
+    expected_wait: float
+    health: Optional[EndpointHealth]
+
+
+def expected_wait(health: EndpointHealth) -> float:
+    """
+    Estimated seconds a new request would wait before a runpod worker starts on it
+    """
+    execution = percentile(metrics.values("runpod.execution_seconds"), 0.5) or RUNPOD_EXECUTION_SECONDS
+    if not health.warm_workers:
+        cold_start = percentile(metrics.values("runpod.cold_start_seconds"), 0.5) or RUNPOD_COLD_START_SECONDS
+        return cold_start + health.in_queue * execution
+    ahead = health.in_queue - health.idle_workers
+    if ahead < 0:
+        return 0.0
+    return (ahead + 1) * execution / health.warm_workers
+
+
+def cold_start_timeout(health: Optional[EndpointHealth]) -> float:
+    """
+    The least time to allow a runpod call while the endpoint has no warm workers, so timeouts
+    learnt from warm calls don't abort the cold start; 0.0 when workers are warm or health is unknown
+    """
+    if health is None or health.warm_workers:
+        return 0.0
+    execution = percentile(metrics.values("runpod.execution_seconds"), 0.5) or RUNPOD_EXECUTION_SECONDS
+    return expected_wait(health) + execution
+
+
+def _parse_range(text: str) -> tuple[int, int]:
+    start, _, end = text.partition("-")
+    return int(start), int(end or start)
+
+
+class WarmKeeper:
+    def __init__(self, credentials: dict):
+        self.credentials = credentials
+        self.warm_ups = 0
+        self.last_warm_up = None
+        self._health = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def in_schedule(self, now: datetime = None) -> bool:
+        now = now or datetime.now(ZoneInfo(RUNPOD_WARM_TIMEZONE))
+        first_day, last_day = _parse_range(RUNPOD_WARM_DAYS)
+        start_hour, end_hour = _parse_range(RUNPOD_WARM_HOURS)
+        return first_day <= now.weekday() <= last_day and start_hour <= now.hour < end_hour
+
+    async def fetch_health(self, pod_id: str, token: str) -> EndpointHealth:
+        response = await asyncio.wait_for(runpod_client.health(pod_id, token), RUNPOD_HEALTH_TIMEOUT_SECONDS)
+        health = EndpointHealth.from_response(response)
+        with self._lock:
+            self._health[pod_id] = health
+        metrics.set_gauge("runpod.in_queue", health.in_queue)
+        metrics.set_gauge("runpod.warm_workers", health.warm_workers)
+        return health
+
+    async def health(self, pod_id: str, token: str) -> Optional[EndpointHealth]:
+        """
+        The endpoint's recent health, fetched again when older than RUNPOD_HEALTH_MAX_AGE_SECONDS.
+        None if runpod could not be asked.
+        """
+        with self._lock:
+            health = self._health.get(pod_id)
+        if health and time.monotonic() - health.fetched_at < RUNPOD_HEALTH_MAX_AGE_SECONDS:
+            return health
+        try:
+            return await self.fetch_health(pod_id, token)
+        except Exception as e:
+            logger.warning(f"Could not get the runpod endpoint health: {type(e).__name__}: {e}")
+            return None
+
+    def expected_wait_for(self, pod_id: str, token: str) -> float:
+        """
+        Estimated runpod queue wait in seconds, for synchronous callers; 0.0 if it is unknown
+        """
+        health = run_in_loop(self.health(pod_id, token))
+        return expected_wait(health) if health else 0.0
+
+    async def admit(self, pod_id: str, token: str, timeout: float) -> Admission:
+        """
+        Decide whether a request should be queued on runpod, rerouted to OpenAI or rejected
+        """
+        health = await self.health(pod_id, token)
+        wait = expected_wait(health) if health else 0.0
+        if wait <= RUNPOD_ADMIT_MAX_WAIT_SECONDS:
+            decision = QUEUE
+        elif FAILOVER_ENABLED and not get_breaker("openai").is_open():
+            decision = REROUTE
+            if not health.warm_workers and not health.in_queue:
+                # Nothing is queued that would start a worker, so warm one for the requests that follow
+                self.wake()
+        elif wait < timeout:
+            decision = QUEUE
+        else:
+            decision = REJECT
+        if decision != QUEUE or wait:
+            logger.info(f"Runpod admission: {decision}, expected wait {wait:.0f}s ({health})")
+        metrics.increment(f"runpod.admission.{decision}")
+        return Admission(decision, wait, health)
+
+    async def warm_up(self, pod_id: str, token: str):
+        """
+        Send a warm-up job unless real jobs are already keeping a worker busy
+        """
+        health = await self.fetch_health(pod_id, token)
+        if health.in_queue or health.in_progress:
+            return
+        start = time.monotonic()
+        await runpod_client.run(pod_id, token, WARM_UP_INPUT, RUNPOD_WARM_TIMEOUT_SECONDS)
+        elapsed = time.monotonic() - start
+        if not health.warm_workers:
+            logger.info(f"Runpod cold start took {elapsed:.1f}s")
+            metrics.observe("runpod.cold_start_seconds", elapsed)
+        metrics.increment("runpod.warm_ups")
+        with self._lock:
+            self.warm_ups += 1
+            self.last_warm_up = time.monotonic()
+
+    def tick(self):
+        woken = self._wake.is_set()
+        self._wake.clear()
+        pod_id = self.credentials.get("runpod_pod_id")
+        try:
+            # Inside the try, so a bad RUNPOD_WARM_* setting is logged instead of ending the thread
+            if not pod_id or not (woken or self.in_schedule()):
+                return
+            run_in_loop(self.warm_up(pod_id, self.credentials.get("runpod_bearer_token")))
+        except Exception as e:
+            logger.warning(f"Runpod warm-up failed: {type(e).__name__}: {e}")
+            metrics.increment("runpod.warm_up_failures")
+
+    def _run(self):
+        while True:
+            self.tick()
+            self._wake.wait(RUNPOD_WARM_INTERVAL_SECONDS)
+
+    def start(self):
+        """
+        Start the warm-keeper thread, once, if RUNPOD_WARM_ENABLED
+        """
+        with self._lock:
+            if not RUNPOD_WARM_ENABLED or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="runpod-warm-keeper", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """
+        Send a warm-up job now, even outside the schedule
+        """
+        self._wake.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            health = list(self._health.values())
+            return {
+                "enabled": RUNPOD_WARM_ENABLED,
+                "in_schedule": self.in_schedule(),
+                "warm_ups": self.warm_ups,
+                "seconds_since_warm_up": round(time.monotonic() - self.last_warm_up) if self.last_warm_up else None,
+                "endpoints": [
+                    {
+                        "in_queue": endpoint.in_queue,
+                        "in_progress": endpoint.in_progress,
+                        "warm_workers": endpoint.warm_workers,
+                        "initializing_workers": endpoint.initializing_workers,
+                        "expected_wait_seconds": round(expected_wait(endpoint), 1),
+                        "age_seconds": round(time.monotonic() - endpoint.fetched_at, 1),
+                    }
+                    for endpoint in health
+                ],
+            }
+
+
+warm_keeper = WarmKeeper(runpod_credentials_chat)
+metrics.register_collector("runpod_warm_keeper", warm_keeper.stats)
+
+
+def runpod_wait_message(ai_provider: str) -> Optional[str]:
+    """
+    A progress message warning of a long runpod queue or cold start, or None
+    """
+    if resolve_ai_provider(ai_provider) != SCOTI:
+        return None
+    wait = warm_keeper.expected_wait_for(
+        runpod_credentials_chat.get("runpod_pod_id"), runpod_credentials_chat.get("runpod_bearer_token"))
+    if wait <= RUNPOD_ADMIT_MAX_WAIT_SECONDS:
+        return None
+    return f"SCOTi is warming up, the first answer may take {describe_wait(wait)}"
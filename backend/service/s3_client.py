@@ -2,7 +2,7 @@ import uuid
 import boto3
 import requests
 from io import BytesIO
-from config import Config
+from config import Config, logger
 
 s3_client = boto3.client('s3', region_name=Config.AWS_REGION)
 
@@ -103,6 +103,24 @@ def get_file_like_object_from_s3(download_url):
 
     return file_like_object
 
+
+def fetch_uploaded_files(userid, filenames):
+    """
+    Download a user's uploaded files as named file-like objects, skipping any that fail
+    """
+    download_urls, file_keys = get_download_urls(userid, filenames)
+    uploaded_files = []
+    for download_url, file_key in zip(download_urls, file_keys):
+        try:
+            logger.info(f"Fetching from URL: {download_url}")
+            file_like_object = get_file_like_object_from_s3(download_url)
+            file_like_object.name = file_key
+            uploaded_files.append(file_like_object)
+        except Exception as e:
+            logger.error(f"Failed to fetch or process the file at {download_url}: {str(e)}")
+            continue
+    return uploaded_files
+
 if __name__ == "__main__":
     print(f"fileuploadbucket = {Config.FILE_UPLOAD_BUCKET}")
 
@@ -0,0 +1,162 @@
+"""
+Single-flight coalescing of identical requests that are running at the same time.
+
+A double click, or an EventSource reconnecting to /api/ai-doc-audit, used to start the whole
+pipeline again (S3 fetch, parsing and one LLM call per section) next to the original run. The
+first request for a key now starts the work in a background thread, and every identical request
+that arrives while it is running attaches to it. Events are numbered from 1, and a subscriber
+receives every event after the number it asks for (0 for all of them, or the Last-Event-ID of a
+reconnecting EventSource), so all of them see the same stream, and only one set of LLM jobs runs.
+
+The work carries on for SINGLE_FLIGHT_ORPHAN_SECONDS after its last subscriber disconnects, so a
+client that reconnects picks it up again. It is stopped at its next event after that. A client
+resuming after work that has already finished gets FlightFinishedError rather than new work, whose
+events would repeat numbers it has already seen.
+"""
+
+import threading
+import time
+from typing import Callable, Hashable, Iterable, Iterator, Optional
+
+from config import load_environment_variable, logger
+from service.metrics import metrics
+
+SINGLE_FLIGHT_ORPHAN_SECONDS = float(load_environment_variable("SINGLE_FLIGHT_ORPHAN_SECONDS", 30))
+
+
+class FlightFinishedError(Exception):
+    """
+    A subscriber asked to resume work that is no longer running, so the events it missed are gone
+    """
+
+
+class _Flight:
+    def __init__(self, orphan_seconds: float = SINGLE_FLIGHT_ORPHAN_SECONDS):
+        self.events = []
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.subscribers = 0
+        self.orphan_seconds = orphan_seconds
+        # When the last subscriber left, None while there are subscribers
+        self.orphaned_since: Optional[float] = None
+        self.condition = threading.Condition()
+
+    def publish(self, producer: Callable[[], Iterable]):
+        events = None
+        try:
+            events = iter(producer())
+            for event in events:
+                with self.condition:
+                    self.events.append(event)
+                    self.condition.notify_all()
+                    self.stopped = (
+                        self.orphaned_since is not None
+                        and time.monotonic() - self.orphaned_since >= self.orphan_seconds
+                    )
+                if self.stopped:
+                    logger.info(f"Stopping single-flight work, it has had no subscribers for {self.orphan_seconds:.0f}s")
+                    break
+        except Exception as e:
+            logger.error("Single-flight work failed", exc_info=True)
+            self.error = e
+        finally:
+            if hasattr(events, "close"):
+                events.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def join(self) -> bool:
+        """
+        Add a subscriber; False if the work has finished or been stopped, so new work is needed
+        """
+        with self.condition:
+            if self.done or self.stopped:
+                return False
+            self.subscribers += 1
+            self.orphaned_since = None
+            return True
+
+    def subscribe(self, after: int = 0) -> Iterator[tuple[int, object]]:
+        """
+        Yield (number, event) for the events numbered above after, waiting for each one
+        """
+        position = after
+        try:
+            while True:
+                with self.condition:
+                    while position >= len(self.events) and not self.done:
+                        self.condition.wait()
+                    events = self.events[position:]
+                    done = self.done
+                for event in events:
+                    position += 1
+                    yield position, event
+                if done and position >= len(self.events):
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                if not self.subscribers:
+                    self.orphaned_since = time.monotonic()
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        metrics.register_collector(f"single_flight.{name}", self.stats)
+
+    def stream(self, key: Hashable, producer: Callable[[], Iterable], after: int = 0) -> Iterator[tuple[int, object]]:
+        """
+        Iterate (number, event) for the events of the running work for key, starting producer()
+        in a background thread if there is none. Late subscribers get the events numbered above
+        after. Raises FlightFinishedError when after is set but the work is no longer running.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            started = flight is None or not flight.join()
+            if started:
+                if after:
+                    metrics.increment(f"single_flight.{self.name}.finished_before_resume")
+                    raise FlightFinishedError(f"The {self.name} for {key} is no longer running, cannot resume after event {after}")
+                flight = _Flight()
+                flight.join()
+                self._flights[key] = flight
+
+        if started:
+            metrics.increment(f"single_flight.{self.name}.started")
+            threading.Thread(
+                target=self._run, args=(key, flight, producer), name=f"single-flight-{self.name}", daemon=True
+            ).start()
+        else:
+            logger.info(f"Attaching to the {self.name} already running for {key}")
+            metrics.increment(f"single_flight.{self.name}.joined")
+        return flight.subscribe(after)
+
+    def call(self, key: Hashable, function: Callable[[], object]):
+        """
+        Return function(), sharing a single call between identical concurrent callers
+        """
+        results = list(self.stream(key, lambda: [function()]))
+        return results[-1][1]
+
+    def _run(self, key: Hashable, flight: _Flight, producer: Callable[[], Iterable]):
+        try:
+            flight.publish(producer)
+        finally:
+            with self._lock:
+                # Later identical requests start new work; the response cache makes that cheap
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "subscribers": sum(flight.subscribers for flight in self._flights.values()),
+            }
@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# Keep the module level job queue out of the working directory
+os.environ.setdefault("JOB_QUEUE_PATH", ":memory:")
+
+# The backend modules import each other as top-level packages (config, service, gpt)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
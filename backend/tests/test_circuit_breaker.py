@@ -0,0 +1,133 @@
+import pytest
+
+from service.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    adaptive_timeout,
+    guard_stream,
+    get_breaker,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("test", failure_threshold=3, recovery_seconds=30, clock=clock)
+
+
+def fail(breaker, times):
+    for _ in range(times):
+        breaker.check()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(breaker):
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+    fail(breaker, 1)
+    assert breaker.state == OPEN
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.rejected == 1
+
+
+def test_success_resets_the_failure_count(breaker):
+    fail(breaker, 2)
+    breaker.record_success()
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_one_trial_call_through(breaker, clock):
+    fail(breaker, 3)
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_trial_success_closes(breaker, clock):
+    fail(breaker, 3)
+    clock.advance(30)
+    breaker.check()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_trial_failure_opens_for_another_period(breaker, clock):
+    fail(breaker, 3)
+    clock.advance(30)
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+
+
+def test_cancelled_trial_lets_another_trial_through(breaker, clock):
+    fail(breaker, 3)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record_cancelled()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_guard_stream_records_the_outcome():
+    def broken():
+        yield "partial"
+        raise RuntimeError("stream dropped")
+
+    breaker = get_breaker("test-guard-stream")
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(RuntimeError):
+            list(guard_stream("test-guard-stream", broken()))
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        list(guard_stream("test-guard-stream", iter(["never sent"])))
+
+
+def test_guard_stream_closed_early_is_neither_success_nor_failure():
+    breaker = get_breaker("test-guard-stream-closed")
+    breaker.record_failure()
+    stream = guard_stream("test-guard-stream-closed", iter(["a", "b"]))
+    next(stream)
+    stream.close()
+    assert breaker.consecutive_failures == 1
+    assert list(guard_stream("test-guard-stream-closed", iter(["a", "b"]))) == ["a", "b"]
+    assert breaker.consecutive_failures == 0
+
+
+def test_adaptive_timeout():
+    assert adaptive_timeout([1.0] * 5, 180) == 180
+    assert adaptive_timeout([1.0] * 30, 180) == 30
+    assert adaptive_timeout([50.0] * 30, 180) == 100
+    assert adaptive_timeout([100.0] * 30, 180) == 180
+    assert adaptive_timeout([1.0] * 30, 180, floor=150) == 150
+    assert adaptive_timeout([1.0] * 30, 180, floor=500) == 180
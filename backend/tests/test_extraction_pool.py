@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+from io import BytesIO
+
+import pytest
+
+import gpt.tokenizer
+from gpt.extraction_cache import ExtractedFile
+from gpt.extraction_pool import SandboxedExtractionPool, _worker_main
+
+MB = 1024 * 1024
+
+
+class FakeEncoding:
+    """
+    Whitespace tokenizer, so the tests don't download tiktoken's encodings
+    """
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts, num_threads=1):
+        return [self.encode_ordinary(text) for text in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+def use_fake_tokenizer():
+    gpt.tokenizer.get_encoding = lambda encoding_name=gpt.tokenizer.DEFAULT_ENCODING: FakeEncoding()
+
+
+def sandboxed_worker_main(connection, memory_limit_bytes):
+    """
+    The real worker loop, except that a file named crash.txt kills the worker, slow.txt hangs it and
+    modules.txt is answered with the names of the worker's loaded service modules
+    """
+    use_fake_tokenizer()
+    receive = connection.recv
+
+    def recv():
+        job = receive()
+        if job is not None and job[0] == "modules.txt":
+            modules = " ".join(sorted(name for name in sys.modules if name.startswith("service.")))
+            connection.send(("ok", ExtractedFile(modules, False, 0)))
+            job = receive()
+        if job is not None and job[0] == "crash.txt":
+            os._exit(1)
+        if job is not None and job[0] == "slow.txt":
+            time.sleep(60)
+        return job
+
+    connection.recv = recv
+    _worker_main(connection, memory_limit_bytes)
+
+
+@pytest.fixture(autouse=True)
+def fake_tokenizer(monkeypatch):
+    monkeypatch.setattr(gpt.tokenizer, "get_encoding", lambda encoding_name=None: FakeEncoding())
+
+
+@pytest.fixture
+def pool():
+    return SandboxedExtractionPool(size=1, timeout=10, memory_limit_bytes=64 * MB, worker_main=sandboxed_worker_main)
+
+
+def text_file(name, text):
+    file = BytesIO(text.encode())
+    file.name = name
+    return file
+
+
+def assert_recovered(pool):
+    [extracted] = pool.extract([text_file("after.txt", "the pool still works")])
+    assert extracted.error is None
+    assert "the pool still works" in extracted.contents
+
+
+def test_files_are_extracted_in_order(pool):
+    files = [text_file(f"file{index}.txt", f"contents of file {index}") for index in range(3)]
+    extracted = pool.extract(files)
+    assert [f"contents of file {index}" in file.contents for index, file in enumerate(extracted)] == [True] * 3
+
+
+def test_crashed_worker_returns_an_error_and_is_replaced(pool):
+    extracted = pool.extract([text_file("crash.txt", "boom"), text_file("fine.txt", "still read")])
+    assert extracted[0].error == "the file is too large or malformed"
+    assert "crash.txt could not be read" in extracted[0].contents
+    assert "still read" in extracted[1].contents
+    assert_recovered(pool)
+
+
+def test_worker_over_its_memory_limit_returns_an_error_and_is_replaced():
+    pool = SandboxedExtractionPool(size=1, timeout=30, memory_limit_bytes=16 * MB, worker_main=sandboxed_worker_main)
+    [extracted] = pool.extract([text_file("huge.txt", "word " * (16 * MB))])
+    assert extracted.error is not None
+    assert "huge.txt could not be read" in extracted.contents
+    assert_recovered(pool)
+
+
+def test_hung_worker_times_out_and_is_replaced(pool):
+    pool.timeout = 1
+    [extracted] = pool.extract([text_file("slow.txt", "never read")])
+    assert extracted.error == "timed out after 1 seconds"
+    pool.timeout = 10
+    assert_recovered(pool)
+
+
+def test_worker_that_died_while_idle_is_replaced(pool):
+    assert_recovered(pool)
+    worker = pool._idle.get()
+    worker.process.kill()
+    worker.process.join()
+    pool._idle.put(worker)
+    assert_recovered(pool)
+
+
+def test_workers_are_recycled_after_max_jobs():
+    pool = SandboxedExtractionPool(size=1, max_jobs_per_worker=2, worker_main=sandboxed_worker_main)
+    assert_recovered(pool)
+    first = pool._idle.queue[0]
+    assert_recovered(pool)
+    assert pool._idle.queue[0] is None
+    assert not first.process.is_alive()
+    assert_recovered(pool)
+
+
+def test_workers_do_not_load_the_llm_clients(pool):
+    [extracted] = pool.extract([text_file("modules.txt", "")])
+    assert extracted.contents.split() == ["service.metrics"]
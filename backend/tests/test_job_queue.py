@@ -0,0 +1,233 @@
+import threading
+
+import pytest
+
+from service import job_queue as job_queue_module
+from service.job_queue import (
+    COMPLETED,
+    FAILED,
+    JOB_LEASE_SECONDS,
+    QUEUED,
+    RUNNING,
+    JobQueue,
+    JobWorkerPool,
+    register_handler,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def echo(payload, emit):
+    for word in payload["words"]:
+        emit({"word": word})
+    return {"count": len(payload["words"])}
+
+
+register_handler("test-echo", echo)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def queue(clock):
+    return JobQueue(":memory:", clock=clock)
+
+
+def submit(queue, words=("a", "b"), **kwargs):
+    return queue.submit("test-echo", {"words": list(words)}, **kwargs)
+
+
+def sequences(events):
+    return [event.sequence for event in events]
+
+
+def test_unknown_kind_is_rejected(queue):
+    with pytest.raises(ValueError):
+        queue.submit("no-such-kind", {})
+
+
+def test_claim_emit_and_finish(queue):
+    job_id = submit(queue, owner="user-1")
+    assert queue.get(job_id).status == QUEUED
+
+    job = queue.claim("lease-1")
+    assert (job.id, job.status, job.attempts) == (job_id, RUNNING, 1)
+    assert queue.claim("lease-2") is None
+
+    assert queue.emit(job_id, "lease-1", {"word": "a"})
+    assert queue.finish(job_id, "lease-1", result={"count": 1})
+    job = queue.get(job_id)
+    assert (job.status, job.result, job.error) == (COMPLETED, {"count": 1}, None)
+
+
+def test_jobs_are_only_visible_to_their_owner(queue):
+    job_id = submit(queue, owner="user-1")
+    assert queue.get(job_id, owner="user-1").id == job_id
+    assert queue.get(job_id, owner="user-2") is None
+
+
+def test_lease_is_kept_while_renewed(queue, clock):
+    job_id = submit(queue)
+    queue.claim("lease-1")
+    clock.advance(JOB_LEASE_SECONDS - 1)
+    queue.renew(["lease-1"])
+    clock.advance(JOB_LEASE_SECONDS - 1)
+    assert queue.claim("lease-2") is None
+    assert queue.emit(job_id, "lease-1", {"word": "a"})
+
+
+def test_expired_lease_is_claimed_again(queue, clock):
+    job_id = submit(queue)
+    queue.claim("lease-1")
+    clock.advance(JOB_LEASE_SECONDS + 1)
+
+    job = queue.claim("lease-2")
+    assert (job.id, job.attempts) == (job_id, 2)
+    # The first worker has lost the job, so nothing it does afterwards is recorded
+    assert not queue.emit(job_id, "lease-1", {"word": "late"})
+    assert not queue.finish(job_id, "lease-1", result={"count": 0})
+    assert queue.finish(job_id, "lease-2", result={"count": 2})
+    assert queue.get(job_id).result == {"count": 2}
+
+
+def test_retry_drops_the_abandoned_attempts_events(queue, clock):
+    job_id = submit(queue)
+    queue.claim("lease-1")
+    queue.emit(job_id, "lease-1", {"word": "a"})
+    queue.emit(job_id, "lease-1", {"word": "b"})
+    clock.advance(JOB_LEASE_SECONDS + 1)
+
+    queue.claim("lease-2")
+    assert queue.events(job_id) == []
+    queue.emit(job_id, "lease-2", {"word": "a"})
+    # Ids keep increasing, so a follower resuming after id 2 sees the new attempt's events
+    assert sequences(queue.events(job_id)) == [3]
+    assert [event.event for event in queue.events(job_id, after=2)] == [{"word": "a"}]
+
+
+def test_events_are_replayed_after_an_id(queue):
+    job_id = submit(queue)
+    queue.claim("lease-1")
+    for word in "abc":
+        queue.emit(job_id, "lease-1", {"word": word})
+    assert sequences(queue.events(job_id)) == [1, 2, 3]
+    assert [event.event["word"] for event in queue.events(job_id, after=1)] == ["b", "c"]
+
+    queue.finish(job_id, "lease-1", result={"count": 3})
+    assert sequences(queue.follow(job_id, after=2)) == [3]
+    assert list(queue.follow(job_id, after=3)) == []
+
+
+def test_find_active_only_finds_unfinished_jobs(queue):
+    job_id = submit(queue, dedupe_key="key")
+    assert queue.find_active("key") == job_id
+    assert queue.find_active("other key") is None
+    queue.claim("lease-1")
+    assert queue.find_active("key") == job_id
+    queue.finish(job_id, "lease-1", result={})
+    assert queue.find_active("key") is None
+
+
+def test_submit_unless_active_follows_the_active_job(queue):
+    job_id, submitted = queue.submit_unless_active("test-echo", {"words": []}, "user-1", "key")
+    assert submitted
+    assert queue.submit_unless_active("test-echo", {"words": []}, "user-1", "key") == (job_id, False)
+    queue.claim("lease-1")
+    queue.finish(job_id, "lease-1", result={})
+    new_job_id, submitted = queue.submit_unless_active("test-echo", {"words": []}, "user-1", "key")
+    assert submitted and new_job_id != job_id
+
+
+def test_identical_requests_at_once_start_one_job(tmp_path):
+    # A queue per thread, each with its own connection, like separate web workers sharing the database
+    path = str(tmp_path / "jobs.sqlite3")
+    queues = [JobQueue(path) for _ in range(8)]
+    for attempt in range(10):
+        started = threading.Barrier(len(queues))
+        results = [None] * len(queues)
+
+        def request(index):
+            started.wait()
+            results[index] = queues[index].submit_unless_active(
+                "test-echo", {"words": []}, "user-1", f"key-{attempt}")
+
+        threads = [threading.Thread(target=request, args=(index,)) for index in range(len(queues))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sum(submitted for _, submitted in results) == 1
+        assert len({job_id for job_id, _ in results}) == 1
+    assert queues[0].stats()["queued"] == 10
+
+
+def test_worker_runs_the_handler(queue):
+    job_id = submit(queue, words=("x", "y", "z"))
+    job = queue.claim("lease-1")
+    JobWorkerPool(queue, workers=1)._run(job, "lease-1")
+
+    job = queue.get(job_id)
+    assert (job.status, job.result) == (COMPLETED, {"count": 3})
+    assert [event.event for event in queue.events(job_id)] == [{"word": "x"}, {"word": "y"}, {"word": "z"}]
+
+
+def test_worker_says_a_retried_job_started_again(queue, clock):
+    job_id = submit(queue, words=("x",))
+    queue.claim("lease-1")
+    clock.advance(JOB_LEASE_SECONDS + 1)
+    job = queue.claim("lease-2")
+    JobWorkerPool(queue, workers=1)._run(job, "lease-2")
+
+    events = [event.event for event in queue.events(job_id)]
+    assert events[0]["status"] == "100"
+    assert events[1:] == [{"word": "x"}]
+    assert queue.get(job_id).status == COMPLETED
+
+
+def test_worker_gives_up_after_max_attempts(queue, clock, monkeypatch):
+    monkeypatch.setattr(job_queue_module, "JOB_MAX_ATTEMPTS", 2)
+    job_id = submit(queue)
+    for attempt in range(1, 3):
+        assert queue.claim(f"lease-{attempt}").attempts == attempt
+        clock.advance(JOB_LEASE_SECONDS + 1)
+    job = queue.claim("lease-3")
+    JobWorkerPool(queue, workers=1)._run(job, "lease-3")
+
+    job = queue.get(job_id)
+    assert job.status == FAILED
+    assert "2 attempts" in job.error
+
+
+def test_failing_handler_fails_the_job(queue):
+    def broken(payload, emit):
+        raise RuntimeError("no such file")
+
+    register_handler("test-broken", broken)
+    job_id = queue.submit("test-broken", {})
+    JobWorkerPool(queue, workers=1)._run(queue.claim("lease-1"), "lease-1")
+    job = queue.get(job_id)
+    assert (job.status, job.error) == (FAILED, "RuntimeError: no such file")
+
+
+def test_finished_jobs_expire(queue, clock):
+    job_id = submit(queue)
+    queue.claim("lease-1")
+    queue.emit(job_id, "lease-1", {"word": "a"})
+    queue.finish(job_id, "lease-1", result={})
+    clock.advance(job_queue_module.JOB_RETENTION_SECONDS + 1)
+    submit(queue)
+    assert queue.get(job_id) is None
+    assert queue.events(job_id) == []
@@ -0,0 +1,137 @@
+import asyncio
+import uuid
+
+import pytest
+
+from service import llm_router as router_module
+from service.circuit_breaker import get_breaker
+from service.llm_router import LatencyRouter
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setattr(router_module, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(router_module, "FAILOVER_ENABLED", True)
+    monkeypatch.setattr(router_module, "HEDGE_DEFAULT_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(router_module, "HEDGE_BUDGET_RATIO", 0.1)
+    monkeypatch.setattr(router_module, "HEDGE_BUDGET_BURST", 5)
+    monkeypatch.setattr(router_module, "HEDGE_MAX_IN_FLIGHT", 4)
+    # Unique names, so each test gets breakers of its own
+    suffix = uuid.uuid4().hex
+    return LatencyRouter(f"primary-{suffix}", f"secondary-{suffix}")
+
+
+class StubBackend:
+    """
+    An async backend answering after delay seconds, or raising error
+    """
+
+    def __init__(self, answer, delay=0.0, error=None):
+        self.answer = answer
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error:
+            raise self.error
+        return self.answer
+
+
+def complete(router, primary, secondary, timeout=5.0, **kwargs):
+    return asyncio.run(router.complete(primary, secondary, timeout, **kwargs))
+
+
+def test_fast_primary_is_not_hedged(router):
+    primary, secondary = StubBackend("runpod answer"), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("runpod answer", router.primary)
+    assert secondary.calls == 0
+    assert router.backends[router.primary].wins == 1
+    # Every primary request earns part of a hedge, up to the burst
+    assert router.hedge_budget == 5
+
+
+def test_slow_primary_is_hedged_and_the_loser_cancelled(router):
+    router.hedge_budget = 2
+    primary, secondary = StubBackend("runpod answer", delay=1.0), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("openai answer", router.secondary)
+    assert primary.cancelled == 1
+    assert router.hedge_budget == pytest.approx(1.1)
+    assert router.hedges_in_flight == 0
+    assert router.backends[router.secondary].wins == 1
+
+
+def test_primary_wins_a_hedge_it_answers_first(router):
+    primary, secondary = StubBackend("runpod answer", delay=0.1), StubBackend("openai answer", delay=1.0)
+    assert complete(router, primary, secondary) == ("runpod answer", router.primary)
+    assert secondary.cancelled == 1
+    assert router.hedges_in_flight == 0
+
+
+def test_no_hedge_without_budget(router):
+    router.hedge_budget = 0.5
+    primary, secondary = StubBackend("runpod answer", delay=0.2), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("runpod answer", router.primary)
+    assert secondary.calls == 0
+    assert router.hedge_budget == pytest.approx(0.6)
+
+
+def test_hedges_in_flight_are_capped(router, monkeypatch):
+    monkeypatch.setattr(router_module, "HEDGE_MAX_IN_FLIGHT", 0)
+    primary, secondary = StubBackend("runpod answer", delay=0.2), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("runpod answer", router.primary)
+    assert secondary.calls == 0
+    assert router.hedge_budget == 5
+
+
+def test_hedge_delay_follows_the_primary_p95(router, monkeypatch):
+    monkeypatch.setattr(router_module, "ROUTER_MIN_SAMPLES", 20)
+    monkeypatch.setattr(router_module, "HEDGE_MIN_DELAY_SECONDS", 5)
+    assert router.hedge_delay() == 0.05
+    router.backends[router.primary].latencies.extend(float(i) for i in range(1, 101))
+    assert router.hedge_delay() == pytest.approx(95, abs=1)
+
+
+def test_failed_primary_fails_over(router):
+    primary = StubBackend(None, error=RuntimeError("runpod is down"))
+    secondary = StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("openai answer", router.secondary)
+    assert router.backends[router.primary].errors == 1
+    assert get_breaker(router.primary).consecutive_failures == 1
+
+
+def test_empty_primary_answer_fails_over(router):
+    primary, secondary = StubBackend(""), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("openai answer", router.secondary)
+
+
+def test_primary_error_is_raised_when_both_fail(router):
+    primary = StubBackend(None, error=RuntimeError("runpod is down"))
+    secondary = StubBackend(None, error=RuntimeError("openai is down"))
+    with pytest.raises(RuntimeError, match="runpod is down"):
+        complete(router, primary, secondary)
+
+
+def test_open_primary_breaker_goes_straight_to_the_secondary(router):
+    breaker = get_breaker(router.primary)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    primary, secondary = StubBackend("runpod answer"), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("openai answer", router.secondary)
+    assert primary.calls == 0
+
+
+def test_adaptive_timeout_fails_over_and_the_minimum_allows_a_slow_call(router, monkeypatch):
+    monkeypatch.setattr(router_module, "HEDGE_ENABLED", False)
+    router.backends[router.primary].latencies.extend([0.01] * 30)
+    monkeypatch.setattr("service.circuit_breaker.ADAPTIVE_TIMEOUT_MIN_SECONDS", 0.05)
+    primary, secondary = StubBackend("runpod answer", delay=0.3), StubBackend("openai answer")
+    assert complete(router, primary, secondary) == ("openai answer", router.secondary)
+    assert complete(router, primary, secondary, primary_min_timeout=1.0) == ("runpod answer", router.primary)
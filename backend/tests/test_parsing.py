@@ -0,0 +1,67 @@
+import random
+from collections import Counter
+from io import BytesIO
+
+import docx
+
+from gpt.parsing import docx_to_text, filter_template_lines
+
+
+def filter_by_removal(text, template_lines):
+    """
+    The list.remove filter that filter_template_lines replaced, as the reference behaviour
+    """
+    lines = [line for line in text.split("\n") if line]
+    for line in template_lines:
+        if line in lines:
+            lines.remove(line)
+    return "\n".join(f"{line}\n" for line in lines)
+
+
+def test_filter_drops_blank_and_template_lines():
+    text = "Objectives\n\nWe built a sensor\n\nHypothesis\nIt works\n"
+    assert filter_template_lines(text, Counter(["Objectives", "Hypothesis"])) == "We built a sensor\n\nIt works\n"
+
+
+def test_filter_removes_one_copy_per_template_line():
+    # An answer that repeats a template line keeps it
+    assert filter_template_lines("Q1\nans\nQ1\nans2", Counter(["Q1"])) == "ans\n\nQ1\n\nans2\n"
+    # A line in both templates is removed twice
+    assert filter_template_lines("Q1\nans\nQ1\nans2", Counter(["Q1", "Q1"])) == "ans\n\nans2\n"
+
+
+def test_filter_leaves_the_index_unchanged():
+    template_line_index = Counter(["Q1"])
+    filter_template_lines("Q1\nans", template_line_index)
+    assert template_line_index == Counter(["Q1"])
+
+
+def test_filter_matches_the_list_remove_filter():
+    random.seed(0)
+    template_lines = [f"Question {index}" for index in range(30)] + ["Question 1", "Question 2"]
+    lines = template_lines * 2 + [f"Answer {index}" for index in range(200)] + [""] * 50
+    random.shuffle(lines)
+    text = "\n".join(lines)
+    assert filter_template_lines(text, Counter(template_lines)) == filter_by_removal(text, template_lines)
+
+
+def test_docx_to_text_reads_headers_body_tables_and_footers(tmp_path):
+    document = docx.Document()
+    document.sections[0].header.paragraphs[0].text = "Company header"
+    document.sections[0].footer.paragraphs[0].text = "Page footer"
+    document.add_paragraph("Objectives & outcomes")
+    paragraph = document.add_paragraph("Name\tValue ")
+    paragraph.add_run("first line").add_break()
+    paragraph.add_run("second line")
+    table = document.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "cell a"
+    table.cell(0, 1).text = "cell b"
+    path = tmp_path / "filled.docx"
+    document.save(path)
+
+    expected = (
+        "Company header\n\nObjectives & outcomes\n\nName\tValue first line\nsecond line"
+        "\n\ncell a\n\ncell b\n\nPage footer"
+    )
+    assert docx_to_text(path) == expected
+    assert docx_to_text(BytesIO(path.read_bytes())) == expected
@@ -0,0 +1,38 @@
+from gpt.prompts import CHAT_PROMPT_WITH_FILES_TEMPLATE, PromptTemplate
+
+
+def test_render_fills_placeholders_in_one_pass():
+    template = PromptTemplate("Q: <user-input>\nContext: <additional-context>\nEnd")
+    assert template.render(user_input="why?", additional_context="docs") == "Q: why?\nContext: docs\nEnd"
+
+
+def test_placeholder_like_text_in_values_is_not_substituted():
+    template = PromptTemplate("<rdti-template>|<additional-context>|<user-input>")
+    rendered = template.render(
+        rdti_template="guide mentions <user-input>",
+        additional_context="doc quotes <rdti-template> and <additional-context>",
+        user_input="does it follow <rdti-template>?",
+    )
+    assert rendered == (
+        "guide mentions <user-input>|doc quotes <rdti-template> and <additional-context>|does it follow <rdti-template>?"
+    )
+
+
+def test_placeholders_without_a_value_are_kept():
+    template = PromptTemplate("Use <citation-needed> for citations. <user-input>")
+    assert template.render(user_input="Hi") == "Use <citation-needed> for citations. Hi"
+    assert template.render() == "Use <citation-needed> for citations. <user-input>"
+
+
+def test_empty_values_are_inserted():
+    assert PromptTemplate("[<user-input>]").render(user_input="") == "[]"
+
+
+def test_user_content_appears_verbatim_in_the_chat_prompt():
+    user_input = "Summarise the <additional-context> section"
+    document = "Report <user-input> <rdti-template> " * 1000
+    rendered = CHAT_PROMPT_WITH_FILES_TEMPLATE.render(
+        user_input=user_input, rdti_template="", additional_context=document)
+    assert rendered.endswith(user_input)
+    assert document in rendered
+    assert rendered.count(user_input) == 1
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from service import response_cache as cache_module
+from service import runpod_utils
+from service.llm_router import llm_router
+from service.response_cache import ResponseCache, Source, acached_call, cached_call, cached_stream
+
+MESSAGES = [{"role": "user", "content": "What is eligible R&D?"}]
+OPENAI_SOURCE = Source("openai", "gpt-4o-mini", {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(cache_module, "response_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def cache_disabled(monkeypatch):
+    monkeypatch.setattr(cache_module, "RESPONSE_CACHE_ENABLED", False)
+
+
+def test_cached_call_answers_repeats_from_the_cache():
+    calls = []
+
+    def call():
+        calls.append(1)
+        return "answer"
+
+    assert cached_call("runpod", "pod", {}, MESSAGES, call) == ("answer", False)
+    assert cached_call("runpod", "pod", {}, MESSAGES, call) == ("answer", True)
+    assert len(calls) == 1
+
+
+def test_answer_is_cached_under_the_backend_that_produced_it(fresh_cache):
+    assert cached_call("runpod", "pod", {}, MESSAGES, lambda: ("answer", OPENAI_SOURCE)) == ("answer", False)
+
+    assert fresh_cache.get(fresh_cache.make_key("runpod", "pod", {}, MESSAGES)) is None
+    assert fresh_cache.get(fresh_cache.make_key(*OPENAI_SOURCE, MESSAGES)) == "answer"
+
+
+def test_cached_stream_caches_the_joined_chunks(fresh_cache):
+    chunks, cached = cached_stream("runpod", "pod", {}, MESSAGES, lambda: (iter(["an", "swer"]), OPENAI_SOURCE))
+
+    assert not cached
+    assert list(chunks) == ["an", "swer"]
+    assert fresh_cache.get(fresh_cache.make_key(*OPENAI_SOURCE, MESSAGES)) == "answer"
+
+
+@pytest.mark.usefixtures("cache_disabled")
+def test_disabled_cache_returns_the_response_without_its_source(fresh_cache):
+    async def call():
+        return "answer", OPENAI_SOURCE
+
+    assert cached_call("runpod", "pod", {}, MESSAGES, lambda: ("answer", OPENAI_SOURCE)) == ("answer", False)
+    assert cached_call("runpod", "pod", {}, MESSAGES, lambda: "answer") == ("answer", False)
+    assert asyncio.run(acached_call("runpod", "pod", {}, MESSAGES, call)) == ("answer", False)
+
+    chunks, cached = cached_stream("runpod", "pod", {}, MESSAGES, lambda: (iter(["an", "swer"]), OPENAI_SOURCE))
+    assert not cached
+    assert list(chunks) == ["an", "swer"]
+    assert fresh_cache.stats()["entries"] == 0
+
+
+@pytest.mark.usefixtures("cache_disabled")
+def test_disabled_cache_runpod_answers_from_openai_are_plain_text(monkeypatch):
+    async def answered_by_openai(*args, **kwargs):
+        return "answer", llm_router.secondary
+
+    monkeypatch.setattr(runpod_utils, "runpod_call_routed", answered_by_openai)
+    monkeypatch.setattr(runpod_utils, "_admitted_stream",
+                        lambda *args, **kwargs: (iter(["an", "swer"]), runpod_utils.SECONDARY_SOURCE))
+
+    assert runpod_utils.runpod_call(messages=MESSAGES, runpod_pod_id="pod") == "answer"
+    chunks, cached = runpod_utils.runpod_stream(messages=MESSAGES, runpod_pod_id="pod")
+    assert not cached
+    assert "".join(chunks) == "answer"
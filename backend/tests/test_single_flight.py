@@ -0,0 +1,156 @@
+import threading
+import time
+
+import pytest
+
+from service.single_flight import FlightFinishedError, SingleFlight
+
+
+class Upstream:
+    """
+    A stand-in LLM call that blocks until released, counting how often it is called
+    """
+
+    def __init__(self, events=("a", "b", "c"), error=None):
+        self.events = events
+        self.error = error
+        self.calls = 0
+        self.release = threading.Event()
+        self.closed = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        try:
+            self.release.wait(5)
+            for event in self.events:
+                yield event
+            if self.error:
+                raise self.error
+        finally:
+            self.closed.set()
+
+
+def subscribe_all(flights, key, upstream, subscribers):
+    """
+    Start subscribers identical requests at once and return their threads and results
+    """
+    results = [None] * subscribers
+    attached = threading.Barrier(subscribers + 1)
+
+    def request(index):
+        events = flights.stream(key, upstream)
+        attached.wait()
+        try:
+            results[index] = list(events)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(subscribers)]
+    for thread in threads:
+        thread.start()
+    attached.wait()
+    return threads, results
+
+
+def test_concurrent_identical_requests_make_one_upstream_call():
+    flights = SingleFlight("test-one-call")
+    upstream = Upstream()
+    threads, results = subscribe_all(flights, "same question", upstream, 8)
+    upstream.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert upstream.calls == 1
+    assert results == [[(1, "a"), (2, "b"), (3, "c")]] * 8
+
+
+def test_different_keys_are_not_shared():
+    flights = SingleFlight("test-keys")
+    first, second = Upstream(), Upstream()
+    first.release.set()
+    second.release.set()
+    assert list(flights.stream("question 1", first)) == list(flights.stream("question 2", second))
+    assert (first.calls, second.calls) == (1, 1)
+
+
+def test_errors_reach_every_subscriber():
+    flights = SingleFlight("test-errors")
+    upstream = Upstream(events=("a",), error=RuntimeError("runpod is down"))
+    threads, results = subscribe_all(flights, "same question", upstream, 4)
+    upstream.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert upstream.calls == 1
+    for result in results:
+        assert isinstance(result, RuntimeError)
+        assert str(result) == "runpod is down"
+
+
+def test_call_shares_the_result_and_the_error():
+    flights = SingleFlight("test-call")
+    assert flights.call("key", lambda: 42) == 42
+    with pytest.raises(ValueError):
+        flights.call("key", lambda: int("not a number"))
+
+
+def test_late_subscriber_resumes_after_an_event_id():
+    flights = SingleFlight("test-resume")
+    halfway = threading.Event()
+    calls = []
+
+    def upstream():
+        calls.append(True)
+        yield "a"
+        yield "b"
+        halfway.wait(5)
+        yield "c"
+        yield "d"
+
+    first = flights.stream("key", upstream)
+    assert [next(first), next(first)] == [(1, "a"), (2, "b")]
+    reconnected = flights.stream("key", upstream, after=2)
+    halfway.set()
+    assert list(reconnected) == [(3, "c"), (4, "d")]
+    assert list(first) == [(3, "c"), (4, "d")]
+    assert len(calls) == 1
+
+
+def test_finished_work_is_started_again_for_a_new_request():
+    flights = SingleFlight("test-restart")
+    upstream = Upstream()
+    upstream.release.set()
+    assert len(list(flights.stream("key", upstream))) == 3
+    assert list(flights.stream("key", upstream)) == [(1, "a"), (2, "b"), (3, "c")]
+    assert upstream.calls == 2
+
+
+def test_resuming_finished_work_does_not_start_it_again():
+    flights = SingleFlight("test-resume-finished")
+    upstream = Upstream()
+    upstream.release.set()
+    assert len(list(flights.stream("key", upstream))) == 3
+    with pytest.raises(FlightFinishedError):
+        flights.stream("key", upstream, after=2)
+    assert upstream.calls == 1
+
+
+def test_orphaned_work_is_stopped():
+    flights = SingleFlight("test-orphaned")
+
+    def endless():
+        try:
+            while True:
+                time.sleep(0.01)
+                yield "token"
+        finally:
+            closed.set()
+
+    closed = threading.Event()
+    events = flights.stream("key", endless)
+    next(events)
+    flight = next(iter(flights._flights.values()))
+    flight.orphan_seconds = 0.05
+    events.close()
+    assert closed.wait(5)
+    assert flights.stats()["in_flight"] == 0
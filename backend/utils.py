@@ -7,10 +7,10 @@ from typing import Tuple
 from dotenv import load_dotenv
 import boto3
 from botocore.exceptions import ClientError
-from openai import OpenAI
 from pydantic import BaseModel
 import smtplib
 from email.mime.text import MIMEText
+from service.openai_client import invoke_openai_directly, invoke_openai_directly_with_messages
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -113,40 +113,6 @@ runpod_credentials_chat = {
 }
 
 
-def invoke_openai_directly(query):
-
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=load_environment_variable("OPENAI_API_KEY"),
-    )
-
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": query,
-            }
-        ],
-        model="gpt-4o",
-    )
-
-    return chat_completion.choices[0].message.content
-
-
-def invoke_openai_directly_with_messages(messages):
-
-    client = OpenAI(
-        # This is the default and can be omitted
-        api_key=load_environment_variable("OPENAI_API_KEY"),
-    )
-
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="gpt-4o-mini",
-    )
-
-    return chat_completion.choices[0].message.content
-
 def send_email(subject, message, from_addr, to_addr):
     smtp_user = load_environment_variable("SMTP_USER") 
     smtp_pw =  load_environment_variable("SMTP_PW") 